@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tarfile
+import logging
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+class article_archive():
+
+    '''
+    A PMC OA package (.tar.gz), read in a single streaming pass.
+
+    The pass builds an index of every member and writes out only the
+    members we can use (the .nxml and images); videos, PDFs and the like
+    are decompressed past without touching the disk.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.members = dict() # file name -> size, for every file in the package
+        self.extracted = dict() # file name -> path on disk
+
+    def extract(self, directory, extensions):
+        '''
+        Writes the members whose extension is in extensions to directory,
+        flattened to their file names. Returns the extracted file names.
+        '''
+        wanted = set(extension.lower() for extension in extensions)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        archive = tarfile.open(self.path, 'r|gz') # stream, no seeking back
+        try:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                name = os.path.basename(member.name)
+                if name in self.members:
+                    logging.info('%s appears twice in %s, keeping the first' % (name, self.path))
+                    continue
+                self.members[name] = member.size
+                if name.rsplit('.', 1)[-1].lower() not in wanted:
+                    continue
+                target = os.path.join(directory, name)
+                source = archive.extractfile(member)
+                with open(target, 'wb') as out:
+                    shutil.copyfileobj(source, out)
+                self.extracted[name] = target
+        finally:
+            archive.close()
+        skipped = sum(size for name, size in self.members.iteritems() if name not in self.extracted)
+        logging.info('extracted %s of %s files from %s, %s bytes left in the archive' % (
+            len(self.extracted), len(self.members), self.path, skipped))
+        return set(self.extracted)
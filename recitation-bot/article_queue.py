@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import threading
+import logging
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+# priorities, lower goes first
+JUMPER = 0
+DETECTED = 1
+
+class article_queue():
+
+    '''
+    A blocking priority queue of doi_article jobs, shared by the producers
+    (jumpers and the detector) and the consumers.
+
+    get() blocks until there is work, so a job is picked up the moment it
+    arrives. Jumpers go ahead of detected DOIs, first come first served
+    within a priority. A DOI that is already waiting is not queued twice:
+    the two jobs are merged, keeping the higher priority.
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = list() # [priority, sequence, doi_article], doi_article is None once superseded
+        self.waiting = dict() # doi -> its live heap entry
+        self.sequence = itertools.count()
+        self.dropped_duplicates = 0
+
+    def put(self, doi_article, priority=DETECTED):
+        '''
+        Queues a job, returns False if it was merged into one already waiting
+        '''
+        doi_article.setdefault('reupload', None)
+        doi_article.setdefault('article', None)
+        doi = doi_article['doi']
+        with self.condition:
+            entry = self.waiting.get(doi)
+            if entry is None:
+                doi_article['priority'] = priority
+                self._push(doi, priority, doi_article)
+                self.condition.notify()
+                return True
+
+            self.dropped_duplicates += 1
+            queued = entry[2]
+            if doi_article['reupload']:
+                queued['reupload'] = sorted(set(queued['reupload'] or []) | set(doi_article['reupload']))
+            if queued['article'] is None:
+                queued['article'] = doi_article['article']
+            if priority < entry[0]:
+                # superseded entries are skipped when they come off the heap
+                entry[2] = None
+                queued['priority'] = priority
+                self._push(doi, priority, queued)
+            logging.info('doi %s was already waiting, merged the jobs' % doi)
+            return False
+
+    def put_many(self, doi_articles, priority=DETECTED):
+        for doi_article in doi_articles:
+            self.put(doi_article, priority)
+
+    def get(self):
+        '''
+        Blocks until a job is waiting and returns it
+        '''
+        with self.condition:
+            while not self.waiting:
+                self.condition.wait()
+            while 1: # True
+                priority, sequence, doi_article = heapq.heappop(self.heap)
+                if doi_article is not None:
+                    del self.waiting[doi_article['doi']]
+                    return doi_article
+
+    def _push(self, doi, priority, doi_article):
+        entry = [priority, next(self.sequence), doi_article]
+        heapq.heappush(self.heap, entry)
+        self.waiting[doi] = entry
+
+    def waiting_dois(self, limit):
+        '''
+        The dois of the next limit jobs, in the order they will come off
+        '''
+        with self.condition:
+            return [entry[2]['doi'] for entry in heapq.nsmallest(limit, self.waiting.values())]
+
+    def depth(self):
+        '''
+        How many jobs are waiting
+        '''
+        with self.condition:
+            return len(self.waiting)
+
+    def stats(self):
+        with self.condition:
+            jumpers = sum(1 for entry in self.waiting.itervalues() if entry[0] == JUMPER)
+            return {'depth': len(self.waiting),
+                    'jumpers': jumpers,
+                    'detected': len(self.waiting) - jumpers,
+                    'dropped_duplicates': self.dropped_duplicates}
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+'''
+Imports articles in bulk, a DOI list or everything in the PMC open access
+subset, instead of feeding them in one by one through the jumper spool:
+
+    python backfill.py --dois dois.txt       # looked up in the index oa_index.py refresh keeps
+    python backfill.py --dois dois.txt --pmc-ids PMC-ids.csv --oa-file-list oa_file_list.csv
+    python backfill.py --limit 5000          # the open access subset
+    python backfill.py --report
+
+PMCIDs and package urls come from the local index of PMC-ids.csv and
+oa_file_list.csv (see oa_index), which --pmc-ids and --oa-file-list load
+local copies of the lists into first. Jobs carry them to journal_article,
+so a backfilled article makes no idconv or oa.fcgi call. A DOI that fresh
+lists do not have is settled right away as skipped; for the rest, and
+without fresh lists, the APIs are asked as usual.
+
+The packages of the next batch are downloaded download_workers at a time
+while the current batch converts. Every outcome is appended to the
+progress file, and a rerun leaves alone what is done, skipped or rejected
+there, so a backfill can be stopped and started again at any time.
+'''
+
+import os
+import json
+import time
+import itertools
+import threading
+import argparse
+import logging
+import wget
+from multiprocessing.pool import ThreadPool
+import downloads
+import negative_cache
+import task_supervisor
+import oa_index
+from state_store import state_store
+from article_queue import article_queue, DETECTED
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+# what a progress record's status can be; the settled ones are not tried again
+DONE = 'done'
+FAILED = 'failed'
+REJECTED = 'rejected' # in the negative cache, see negative_cache.REASONS
+SKIPPED = 'skipped'
+SETTLED = (DONE, REJECTED, SKIPPED)
+
+def clean_doi(doi):
+    doi = doi.strip()
+    if doi.startswith('http://dx.doi.org/'):
+        doi = doi[len('http://dx.doi.org/'):]
+    return doi
+
+def read_dois(path):
+    '''
+    One doi per line, blank lines and # comments are left out
+    '''
+    dois = list()
+    for line in open(path):
+        line = line.split('#')[0].strip()
+        if line:
+            dois.append(clean_doi(line))
+    return dois
+
+def plan_jobs(index, dois=None):
+    '''
+    Returns the jobs for the queue and [(doi, reason)] for the dois that
+    can be settled without converting anything. Without dois, every
+    article in the open access subset that has a doi.
+    '''
+    if dois is None:
+        if not (index.fresh('pmc_ids') and index.fresh('oa_file_list')):
+            raise ValueError('the index has no fresh PMC-ids and oa_file_list to take the articles from')
+        return [{'doi': doi, 'reupload': None, 'article': None, 'pmcid': pmcid, 'package_url': url}
+                for doi, pmcid, url in index.open_access()], list()
+
+    found = index.lookup(dois)
+    # what a fresh list does not have is not there, a stale one is no proof
+    ids_fresh = index.fresh('pmc_ids')
+    packages_fresh = index.fresh('oa_file_list')
+    jobs = list()
+    skipped = list()
+    seen = set()
+    for doi in dois:
+        if doi.lower() in seen:
+            continue
+        seen.add(doi.lower())
+        job = {'doi': doi, 'reupload': None, 'article': None}
+        entry = found.get(doi.lower())
+        if entry is None:
+            if ids_fresh:
+                skipped.append((doi, 'not in PMC-ids'))
+                continue
+        elif ids_fresh: # hints from stale lists would keep the pipeline from looking
+            job['pmcid'] = entry[1]
+            if packages_fresh:
+                if not entry[2]:
+                    skipped.append((doi, 'not in the open access file list'))
+                    continue
+                job['package_url'] = entry[2]
+        jobs.append(job)
+    return jobs, skipped
+
+class progress_file():
+
+    '''
+    Append-only JSON lines, one per outcome; the last line for a doi wins
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.outcomes = dict() # doi -> its last record
+        if os.path.exists(path):
+            for line in open(path):
+                try:
+                    record = json.loads(line)
+                except ValueError: # a line cut off by a crash
+                    continue
+                self.outcomes[record['doi']] = record
+
+    def record(self, doi, status, message=None, pmcid=None):
+        record = {'doi': doi, 'status': status, 'message': message, 'pmcid': pmcid, 'time': time.time()}
+        with self.lock:
+            self.outcomes[doi] = record
+            progress = open(self.path, 'a')
+            progress.write(json.dumps(record) + '\n')
+            progress.close()
+
+    def settled(self, doi, retry_failed=True):
+        record = self.outcomes.get(doi)
+        if record is None:
+            return False
+        return record['status'] in SETTLED or (record['status'] == FAILED and not retry_failed)
+
+    def summary(self):
+        with self.lock:
+            records = self.outcomes.values()
+        statuses = dict()
+        failures = dict()
+        for record in records:
+            statuses[record['status']] = statuses.get(record['status'], 0) + 1
+            if record['status'] == FAILED:
+                message = (record['message'] or '').split(':')[0][:100]
+                failures[message] = failures.get(message, 0) + 1
+        return {'statuses': statuses, 'failures': failures}
+
+def fetch_package(job, data_dir, timeout):
+    # the same path get_targz downloads to, so it finds the package there
+    path = os.path.join(data_dir, wget.filename_from_url(job['package_url']))
+    try:
+        downloads.fetch(job['package_url'], path, timeout=timeout)
+    except downloads.DownloadError as e:
+        logging.info('predownload of %s failed, the conversion tries again: %s' % (job['package_url'], e))
+
+def run(jobs, progress, overrides=None, batch_size=200, download_workers=8, batch_timeout=3600):
+    '''
+    Converts jobs batch by batch with convert_and_upload in this process,
+    recording every outcome in progress. Returns progress.summary()
+    '''
+    overrides = dict(overrides or {})
+    data_dir = overrides.get('data_dir', '/data/project/recitation-bot/recitation-bot/data')
+    timeout = overrides.get('download_timeout', 60)
+    if all('pmcid' in job for job in jobs):
+        overrides.setdefault('prefetch_pmcids', 0) # nothing to resolve
+    negatives = negative_cache.shared()
+    outstanding = set()
+    changed = threading.Condition()
+
+    def listener(doi, success, status_msg):
+        if success:
+            progress.record(doi, DONE)
+        elif success is None and not negatives.check(doi): # passed over, e.g. converted before
+            progress.record(doi, SKIPPED, status_msg)
+        elif negatives.check(doi):
+            progress.record(doi, REJECTED, status_msg)
+        else:
+            progress.record(doi, FAILED, status_msg)
+        with changed:
+            outstanding.discard(doi)
+            changed.notify_all()
+
+    queue = article_queue()
+    task_supervisor.status_listeners.append(listener)
+    consumer = threading.Thread(target=task_supervisor.convert_and_upload,
+                                kwargs={'article_queue': queue, 'overrides': overrides})
+    consumer.daemon = True
+    consumer.start()
+    fetcher = ThreadPool(download_workers)
+    batches = [jobs[start:start + batch_size] for start in range(0, len(jobs), batch_size)]
+
+    def predownload(batch):
+        return fetcher.map_async(lambda job: fetch_package(job, data_dir, timeout),
+                                 [job for job in batch if job.get('package_url')])
+    try:
+        fetched = predownload(batches[0]) if batches else None
+        for number, batch in enumerate(batches):
+            fetched.wait()
+            if number + 1 < len(batches): # the next batch downloads while this one converts
+                fetched = predownload(batches[number + 1])
+            with changed:
+                outstanding.update(job['doi'] for job in batch)
+            queue.put_many(batch, priority=DETECTED)
+            last_change = time.time()
+            with changed:
+                while outstanding:
+                    left = len(outstanding)
+                    changed.wait(10)
+                    if len(outstanding) < left:
+                        last_change = time.time()
+                    elif time.time() - last_change > batch_timeout:
+                        logging.info('backfill batch %s gave up waiting for %s' % (number, sorted(outstanding)))
+                        break
+                outstanding.clear()
+            logging.info('backfill batch %s of %s done: %s' % (number + 1, len(batches), progress.summary()['statuses']))
+            print 'batch %s of %s done: %s' % (number + 1, len(batches), progress.summary()['statuses'])
+    finally:
+        task_supervisor.status_listeners.remove(listener)
+        fetcher.close()
+    return progress.summary()
+
+def already_settled(jobs, progress, retry_failed=True):
+    '''
+    Yields the jobs the progress file did not settle, recording as skipped
+    what was converted before and as rejected what is in the negative cache
+    on the way. A generator, so that a limit stops it early
+    '''
+    store = state_store('journal_state')
+    negatives = negative_cache.shared()
+    try:
+        for job in jobs:
+            doi = job['doi']
+            if progress.settled(doi, retry_failed):
+                continue
+            if doi in store:
+                progress.record(doi, SKIPPED, 'converted before', job.get('pmcid'))
+            elif negatives.check(doi):
+                progress.record(doi, REJECTED, negatives.check(doi)['message'], job.get('pmcid'))
+            else:
+                yield job
+    finally:
+        store.close()
+
+def report(summary):
+    for status, count in sorted(summary['statuses'].iteritems()):
+        print '%-9s %8d' % (status, count)
+    if summary['failures']:
+        print 'failures:'
+        for message, count in sorted(summary['failures'].iteritems(), key=lambda item: -item[1])[:20]:
+            print '  %6d  %s' % (count, message)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert a doi list or the whole PMC open access subset')
+    parser.add_argument('--dois', help='file with one doi per line')
+    parser.add_argument('--index', default=oa_index.DEFAULT_PATH, help='the oa_index to look articles up in')
+    parser.add_argument('--pmc-ids', help='a PMC-ids.csv(.gz) to load into the index first')
+    parser.add_argument('--oa-file-list', help='an oa_file_list.csv to load into the index first')
+    parser.add_argument('--progress', default='backfill_progress.jsonl')
+    parser.add_argument('--limit', type=int, help='at most this many new articles')
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--download-workers', type=int, default=8)
+    parser.add_argument('--batch-timeout', type=float, default=3600,
+                        help='seconds without an outcome before a batch is given up')
+    parser.add_argument('--engine', choices=['threads', 'events'], default='events')
+    parser.add_argument('--max-in-flight', type=int, default=200)
+    parser.add_argument('--cpu-processes', type=int, default=0)
+    parser.add_argument('--no-retry', action='store_true', help='leave failed dois alone')
+    parser.add_argument('--tweet', action='store_true', help='tweet every article, like the bot does')
+    parser.add_argument('--report', action='store_true', help='summarize the progress file and stop')
+    args = parser.parse_args()
+
+    progress = progress_file(args.progress)
+    if args.report:
+        report(progress.summary())
+        raise SystemExit
+    index = oa_index.oa_index(args.index)
+    for name, path in [('pmc_ids', args.pmc_ids), ('oa_file_list', args.oa_file_list)]:
+        if path:
+            print '%s: loaded %s rows' % (name, index.load_file(name, path))
+    try:
+        jobs, skipped = plan_jobs(index, read_dois(args.dois) if args.dois else None)
+    except ValueError as e:
+        parser.error(str(e))
+    for doi, reason in skipped:
+        if not progress.settled(doi):
+            progress.record(doi, SKIPPED, reason)
+    jobs = list(itertools.islice(already_settled(jobs, progress, retry_failed=not args.no_retry), args.limit or None))
+    print '%s articles to convert, %s skipped' % (len(jobs), len(skipped))
+    task_supervisor.tweet = args.tweet
+    report(run(jobs, progress,
+               overrides={'engine': args.engine,
+                          'max_in_flight': args.max_in_flight,
+                          'cpu_processes': args.cpu_processes},
+               batch_size=args.batch_size,
+               download_workers=args.download_workers,
+               batch_timeout=args.batch_timeout))
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Offline benchmarks for the conversion path, run by hand on the tools host
+before deploying, e.g.
+
+    python benchmark.py xslt /path/to/jats-to-mediawiki.xsl a.nxml b.nxml
+    python benchmark.py rewrite --images 500 --materials 100
+    python benchmark.py fetch-corpus corpus/ 10.1371/journal.pone.0012292 ...
+    python benchmark.py corpus /path/to/jats-to-mediawiki.xsl corpus/ --baseline corpus.json
+
+The corpus benchmark runs the offline stages on every .tar.gz package in a
+directory and reports time and peak memory per stage. --save-baseline
+records the result, --baseline compares against one and exits non-zero
+when a stage got slower or hungrier than --tolerance allows.
+'''
+
+import argparse
+import tempfile
+import shutil
+import time
+import re
+import os
+import sys
+import glob
+import json
+import resource
+from distutils.spawn import find_executable
+import helpers
+import commons_template
+from journal_article import journal_article, ConversionError, lxml_etree
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def bench_xslt(xsl_path, nxml_paths, repeat=3):
+    '''
+    Times xslt_it + get_mwtext_element per article for the xsltproc
+    subprocess and for the in-process lxml engine, those of them that are
+    installed.
+    Returns {engine: [seconds per article run]}.
+    '''
+    data_dir = tempfile.mkdtemp(prefix='recitation-bench-')
+    timings = dict()
+    engines = list()
+    if find_executable('xsltproc') is not None:
+        engines.append('xsltproc')
+    if lxml_etree is not None:
+        engines.append('lxml')
+    try:
+        for engine in engines:
+            parameters = {'data_dir': data_dir,
+                          'jats2mw_xsl': xsl_path,
+                          'wikisource_site': 'en',
+                          'xslt_engine': engine}
+            timings[engine] = list()
+            for run in range(repeat):
+                for nxml_path in nxml_paths:
+                    ja = journal_article(doi='10.0000/bench', article=None, parameters=parameters)
+                    ja.nxml_path = nxml_path
+                    start = time.time()
+                    ja.xslt_it()
+                    ja.get_mwtext_element()
+                    timings[engine].append(time.time() - start)
+    finally:
+        shutil.rmtree(data_dir)
+    return timings
+
+
+def report_xslt(timings):
+    for engine, seconds in sorted(timings.items()):
+        print '%-10s articles: %4d  first: %7.3fs  median: %7.3fs  max: %7.3fs' % (
+            engine, len(seconds), seconds[0], _median(seconds), max(seconds))
+
+
+def synthetic_article(images, materials, paragraphs):
+    '''
+    wikitext and metadata shaped like a big converted article, every image
+    uploaded and no supplementary material on commons
+    '''
+    metadata = {'article-title': 'A synthetic article', 'images': {}, 'equations': {}, 'tables': {},
+                'supplementary-materials': []}
+    lines = list()
+    for number in range(images):
+        image_dict = ['images', 'equations', 'tables'][number % 3]
+        image = 'bench.0000%s.g%03d' % (number // 1000, number % 1000)
+        metadata[image_dict][image] = {'uploaded_name': 'A-synthetic-article-%s.jpg' % image}
+        lines.append('[[File:%s|thumb|Figure %s. A caption with [[a link]].]]' % (image, number))
+    for number in range(materials):
+        href = 'bench.0000.s%03d.pdf' % number
+        metadata['supplementary-materials'].append({'href': href, 'url': 'http://example.org/' + href})
+        lines.append('[[File:%s|Supplementary file %s]]' % (href, number))
+    text = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor. ' * 8
+    body = list()
+    for number in range(paragraphs):
+        body.append(text)
+        if lines and number % max(1, paragraphs // len(lines)) == 0:
+            body.append(lines.pop())
+    body.extend(lines)
+    return '\n\n'.join(body), metadata
+
+
+def legacy_rewrite(wikitext, metadata):
+    '''
+    the per image and per material re.subn loops the rewrite replaced
+    '''
+    for image_dict in ['images', 'equations', 'tables']:
+        for image in metadata[image_dict].iterkeys():
+            new_file_text = r'File:' + metadata[image_dict][image]['uploaded_name'] + r'|'
+            wikitext, occurrences = re.subn(r'File:(' + image + r')\|', new_file_text, wikitext)
+    for material in metadata['supplementary-materials']:
+        new_file_text = r'[' + material['url'] + r' ' + material['href'] + r']'
+        wikitext, occurrences = re.subn(r'\[\[File:(' + material['href'] + r').*?\]\]', new_file_text, wikitext)
+    return wikitext
+
+
+def bench_rewrite(images, materials, paragraphs, repeat=3):
+    '''
+    Times the legacy loops against the one pass rewrite on a synthetic
+    article. Returns ({implementation: [seconds per run]}, size of the
+    wikitext, whether both gave the same wikitext).
+    '''
+    wikitext, metadata = synthetic_article(images, materials, paragraphs)
+    for material in metadata['supplementary-materials']:
+        # answer the commons lookups from the memo, offline
+        helpers._commons_memo[material['href'].rsplit('.', 1)[0]] = False
+    timings = {'legacy': [], 'one_pass': []}
+    for run in range(repeat):
+        start = time.time()
+        legacy = legacy_rewrite(wikitext, metadata)
+        timings['legacy'].append(time.time() - start)
+
+        ja = journal_article(doi='10.0000/bench', article=None, parameters={'wikisource_site': 'en'})
+        ja.metadata = metadata
+        ja.wikitext = wikitext
+        start = time.time()
+        ja.replace_image_names_in_wikitext()
+        ja.replace_supplementary_material_links_in_wikitext()
+        timings['one_pass'].append(time.time() - start)
+    return timings, len(wikitext), legacy == ja.image_fixed_wikitext
+
+
+def report_rewrite(timings, size, same):
+    print 'wikitext: %s characters, same result: %s' % (size, same)
+    for implementation, seconds in sorted(timings.items()):
+        print '%-10s runs: %4d  median: %9.4fs  max: %9.4fs' % (
+            implementation, len(seconds), _median(seconds), max(seconds))
+
+
+# the offline stages, in pipeline order
+CORPUS_STAGES = ['extract_targz', 'find_nxml', 'extract_metadata', 'xslt_it', 'get_mwtext_element',
+                 'replace_image_names_in_wikitext', 'replace_supplementary_material_links_in_wikitext',
+                 'commons_pages']
+
+
+def _peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _pretend_uploaded(ja):
+    '''
+    gives every image the name an upload would have, and answers the
+    commons lookups for supplementary materials from the memo, so the
+    replacement stages run offline
+    '''
+    for image_dict in ['images', 'equations', 'tables']:
+        for image, image_data in ja.metadata[image_dict].iteritems():
+            image_data['uploaded_name'] = helpers.harmonizing_name(image + '.jpg', ja.metadata['article-title'])
+    for material in ja.metadata['supplementary-materials']:
+        if 'href' in material:
+            helpers._commons_memo.setdefault(os.path.splitext(material['href'])[0], False)
+
+
+def _commons_pages(ja):
+    for image_dict in ['images', 'equations', 'tables']:
+        for image_data in ja.metadata[image_dict].itervalues():
+            commons_template.page(ja.metadata, image_data.get('caption', ''))
+
+
+def bench_corpus(xsl_path, corpus_dir, repeat=1, engine='lxml'):
+    '''
+    Runs CORPUS_STAGES on every package in corpus_dir. Returns
+    {'stages': {stage: {'seconds': [...], 'peak_growth_kb': [...], 'errors': n}},
+     'peak_rss_kb': n, 'packages': n}. peak_growth_kb is how much a stage
+    raised the process' peak resident size, most runs of a stage raise
+    it by nothing once an earlier, bigger article set the peak.
+    '''
+    packages = sorted(glob.glob(os.path.join(corpus_dir, '*.tar.gz')))
+    stages = dict((stage, {'seconds': [], 'peak_growth_kb': [], 'errors': 0}) for stage in CORPUS_STAGES)
+    data_dir = tempfile.mkdtemp(prefix='recitation-corpus-')
+    parameters = {'data_dir': data_dir,
+                  'jats2mw_xsl': xsl_path,
+                  'wikisource_site': 'en',
+                  'xslt_engine': engine}
+    try:
+        for run in range(repeat):
+            for number, package in enumerate(packages):
+                # extract_targz unpacks next to the archive, so link it in
+                link = os.path.join(data_dir, os.path.basename(package))
+                if not os.path.exists(link):
+                    os.symlink(os.path.abspath(package), link)
+                ja = journal_article(doi='10.0000/corpus.%s' % number, article=None, parameters=parameters)
+                ja.complete_path_targz = link
+                for stage in CORPUS_STAGES:
+                    if stage == 'replace_image_names_in_wikitext':
+                        _pretend_uploaded(ja)
+                    peak = _peak_rss_kb()
+                    start = time.time()
+                    try:
+                        if stage == 'commons_pages':
+                            _commons_pages(ja)
+                        else:
+                            getattr(ja, stage)()
+                    except ConversionError as e:
+                        # a missing license still leaves the metadata to go on with
+                        if not (stage == 'extract_metadata' and hasattr(ja, 'metadata')):
+                            stages[stage]['errors'] += 1
+                            print >> sys.stderr, '%s: %s failed: %s' % (package, stage, e)
+                            break
+                    stages[stage]['seconds'].append(time.time() - start)
+                    stages[stage]['peak_growth_kb'].append(_peak_rss_kb() - peak)
+                shutil.rmtree(os.path.join(data_dir, os.path.basename(package).split('.tar.gz')[0]),
+                              ignore_errors=True)
+    finally:
+        shutil.rmtree(data_dir)
+    return {'stages': stages, 'peak_rss_kb': _peak_rss_kb(), 'packages': len(packages)}
+
+
+def summarize_corpus(result):
+    '''
+    the numbers a baseline keeps: per stage median and total seconds and
+    the largest peak growth, plus the overall peak
+    '''
+    summary = {'packages': result['packages'], 'peak_rss_kb': result['peak_rss_kb'], 'stages': {}}
+    for stage, stats in result['stages'].iteritems():
+        seconds = stats['seconds']
+        summary['stages'][stage] = {'runs': len(seconds),
+                                    'errors': stats['errors'],
+                                    'median_seconds': _median(seconds) if seconds else 0.0,
+                                    'total_seconds': sum(seconds),
+                                    'max_peak_growth_kb': max(stats['peak_growth_kb'] or [0])}
+    return summary
+
+
+def report_corpus(summary):
+    print 'packages: %s  peak rss: %.1f MB' % (summary['packages'], summary['peak_rss_kb'] / 1024.0)
+    for stage in CORPUS_STAGES:
+        stats = summary['stages'][stage]
+        print '%-50s runs: %4d  errors: %3d  median: %8.4fs  total: %8.3fs  peak growth: %7.1f MB' % (
+            stage, stats['runs'], stats['errors'], stats['median_seconds'], stats['total_seconds'],
+            stats['max_peak_growth_kb'] / 1024.0)
+
+
+def compare_corpus(summary, baseline, tolerance=0.2, min_seconds=0.01):
+    '''
+    Regressions against a baseline summary, as readable lines. Stages
+    faster than min_seconds in both are too noisy to compare.
+    '''
+    regressions = list()
+    for stage, stats in summary['stages'].iteritems():
+        before = baseline['stages'].get(stage)
+        if before is None:
+            continue
+        if max(stats['median_seconds'], before['median_seconds']) >= min_seconds and \
+                stats['median_seconds'] > before['median_seconds'] * (1 + tolerance):
+            regressions.append('%s: median %.4fs, was %.4fs' % (stage, stats['median_seconds'],
+                                                                before['median_seconds']))
+        if stats['errors'] > before['errors']:
+            regressions.append('%s: %s errors, was %s' % (stage, stats['errors'], before['errors']))
+    if summary['peak_rss_kb'] > baseline['peak_rss_kb'] * (1 + tolerance):
+        regressions.append('peak rss %.1f MB, was %.1f MB' % (summary['peak_rss_kb'] / 1024.0,
+                                                              baseline['peak_rss_kb'] / 1024.0))
+    return regressions
+
+
+def fetch_corpus(corpus_dir, dois):
+    '''
+    Records the PMC packages of dois in corpus_dir, the network part of
+    the pipeline. Returns the dois that could not be fetched.
+    '''
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+    failed = list()
+    for doi in dois:
+        ja = journal_article(doi=doi, article=None, parameters={'data_dir': corpus_dir, 'wikisource_site': 'en'})
+        try:
+            ja.get_pmcid()
+            ja.get_targz()
+            print '%s -> %s' % (doi, ja.complete_path_targz)
+        except ConversionError as e:
+            print >> sys.stderr, '%s: %s' % (doi, e)
+            failed.append(doi)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='recitation-bot offline benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    xslt_parser = subparsers.add_parser('xslt', help='xsltproc subprocess vs in-process lxml')
+    xslt_parser.add_argument('xsl')
+    xslt_parser.add_argument('nxml', nargs='+')
+    xslt_parser.add_argument('--repeat', type=int, default=3)
+    rewrite_parser = subparsers.add_parser('rewrite', help='per image regex loops vs the one pass rewrite')
+    rewrite_parser.add_argument('--images', type=int, default=500)
+    rewrite_parser.add_argument('--materials', type=int, default=100)
+    rewrite_parser.add_argument('--paragraphs', type=int, default=2000)
+    rewrite_parser.add_argument('--repeat', type=int, default=3)
+    corpus_parser = subparsers.add_parser('corpus', help='offline stages on a directory of PMC packages')
+    corpus_parser.add_argument('xsl')
+    corpus_parser.add_argument('corpus_dir')
+    corpus_parser.add_argument('--repeat', type=int, default=1)
+    corpus_parser.add_argument('--engine', choices=['lxml', 'xsltproc'], default='lxml')
+    corpus_parser.add_argument('--save-baseline', metavar='JSON')
+    corpus_parser.add_argument('--baseline', metavar='JSON')
+    corpus_parser.add_argument('--tolerance', type=float, default=0.2,
+                               help='how much slower or bigger than the baseline is still fine')
+    fetch_parser = subparsers.add_parser('fetch-corpus', help='download the packages of some dois')
+    fetch_parser.add_argument('corpus_dir')
+    fetch_parser.add_argument('dois', nargs='*')
+    fetch_parser.add_argument('--doi-file', help='one doi per line')
+    args = parser.parse_args()
+
+    if args.command == 'xslt':
+        report_xslt(bench_xslt(args.xsl, args.nxml, repeat=args.repeat))
+    elif args.command == 'rewrite':
+        report_rewrite(*bench_rewrite(args.images, args.materials, args.paragraphs, repeat=args.repeat))
+    elif args.command == 'corpus':
+        summary = summarize_corpus(bench_corpus(args.xsl, args.corpus_dir, args.repeat, args.engine))
+        report_corpus(summary)
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as baseline_file:
+                json.dump(summary, baseline_file, indent=2, sort_keys=True)
+        if args.baseline:
+            with open(args.baseline) as baseline_file:
+                regressions = compare_corpus(summary, json.load(baseline_file), args.tolerance)
+            for regression in regressions:
+                print 'REGRESSION %s' % regression
+            if regressions:
+                sys.exit(1)
+    elif args.command == 'fetch-corpus':
+        dois = list(args.dois)
+        if args.doi_file:
+            dois.extend(line.strip() for line in open(args.doi_file)
+                        if line.strip() and not line.startswith('#'))
+        if fetch_corpus(args.corpus_dir, dois):
+            sys.exit(1)
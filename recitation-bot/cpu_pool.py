@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+'''
+Runs the CPU bound journal_article stages (unpacking and metadata
+extraction, the xslt, rendering the commons pages) in child processes, so
+that several articles convert at once on a multi core host instead of
+taking turns at the GIL. The I/O stages stay on the worker threads, and so
+does the wikitext rewrite, replace_image_names_in_wikitext needs the
+upload results that only the parent has.
+
+What crosses the process boundary is journal_article.checkpoint(), the
+same plain dict the checkpoints are made of, so nothing unpicklable ever
+has to travel. A group of stages goes in one trip: xslt_it and
+get_mwtext_element always go together, the lxml result tree in between
+can not be sent back.
+'''
+
+import time
+import threading
+import multiprocessing
+import logging
+from journal_article import journal_article, ConversionError
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+def _init_child():
+    # the children are forked from a process full of threads, and a lock
+    # some other thread held at that moment stays locked in the child
+    logging._lock = threading.RLock()
+    for handler in logging.getLogger().handlers:
+        handler.createLock()
+
+def run_stages(doi, parameters, state, stages):
+    '''
+    In a child: runs stages on an article rebuilt from state. Returns the
+    article's new state, {stage: seconds} for the stages that finished,
+    and (message, reason) of the error that stopped it, or None.
+    '''
+    ja = journal_article(doi=doi, article=None, parameters=parameters)
+    ja.apply(state)
+    timings = dict()
+    for stage in stages:
+        start = time.time()
+        try:
+            getattr(ja, stage)()
+        except ConversionError as e:
+            return ja.checkpoint(), timings, (str(e), e.reason)
+        except Exception as e:
+            logging.exception(e)
+            return ja.checkpoint(), timings, ('%s in %s: %s' % (type(e).__name__, stage, e), None)
+        timings[stage] = time.time() - start
+    return ja.checkpoint(), timings, None
+
+class cpu_pool():
+
+    def __init__(self, processes=2):
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes, initializer=_init_child)
+
+    def run(self, ja, stages):
+        '''
+        Runs stages of ja in a child and takes the result back into ja.
+        Returns {stage: seconds} and the ConversionError that stopped the
+        stages, or None. Blocks the calling thread, not the others.
+        '''
+        state, timings, error = self.pool.apply(run_stages, (ja.doi, ja.parameters, ja.checkpoint(), stages))
+        ja.apply(state)
+        if error is not None:
+            message, reason = error
+            error = ConversionError(message=message, doi=ja.doi, reason=reason)
+        return timings, error
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -1,79 +1,196 @@
-import MySQLdb
-import datetime
-import shelve
-import time
+import os
+import re
+import urllib
+import threading
+from article_queue import DETECTED
+from state_store import state_store
 
 import logging
 logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
 
+# el_index patterns (host reversed) for dx.doi.org and doi.org links,
+# over http and https
+DOI_INDEX_PATTERNS = ('http://org.doi.%', 'https://org.doi.%')
+
+DOI_URL = re.compile(r'^(?:https?:)?//(?:dx\.)?doi\.org/(.+)$', re.IGNORECASE)
+
 '''
 A doi_finder object connects to the Wikipedia Replica (MySQL) database,
 provides methods to get lists of DOI-article pairs including filters for
 relevant DOI-article pairs since the last check.
+
+Links are read in el_id order past a high-water mark that is kept in
+cursor_file, so every run only looks at links added since the last one.
 '''
 class doi_finder():
 
-    # Connect to database and shelf
-    def __init__(self, lang):
+    # Connect to database and store
+    def __init__(self, lang, conn=None, placeholder='%s', store=None,
+                 cursor_file='doi_detector_cursor', page_size=5000, batch_size=500):
+        '''
+        conn and placeholder let the finder run on another DB-API
+        connection, like replica_standin's SQLite one (placeholder '?')
+        '''
         #@TODO make this languag agnostic
         logging.debug('querying on lang: %s',lang)
-        host = lang+'.labsdb'
-        db = lang+'_p'
-        self.conn = MySQLdb.connect(host=host, db=db, port=3306, read_default_file='~/replica.my.cnf')
-        self.cursor = self.conn.cursor()        
-        #shelf is keyed by doi, and values is a list of pages they appear on
-        self.shelf = shelve.open('doi_detector_shelf', writeback=False)
-        self.check_time = None
+        if conn is None:
+            import MySQLdb
+            import MySQLdb.cursors
+            host = lang+'.labsdb'
+            db = lang+'_p'
+            conn = MySQLdb.connect(host=host, db=db, port=3306, read_default_file='~/replica.my.cnf')
+            # server-side cursor, rows are streamed rather than buffered
+            self.cursor_class = MySQLdb.cursors.SSCursor
+        else:
+            self.cursor_class = None
+        self.conn = conn
+        self.placeholder = placeholder
+        self.page_size = page_size
+        self.batch_size = batch_size
+        #store is keyed by doi, and values is a list of pages they appear on
+        if store is None:
+            store = state_store('doi_detector_state', migrate_from='doi_detector_shelf')
+        self.store = store
+        self.cursor_file = cursor_file
+        self.high_water_mark = self.load_high_water_mark()
 
-    # Get list of DOIs added since the last check_time
-    def get_doi_list(self):
-        # namespace difference qstring = u'''select page_title, el_to from externallinks left join page on page_id = el_from where page_namespace = 0 and el_index like 'http://org.doi.dx%' '''
-        qstring = u'''select page_title, el_to from externallinks left join page on page_id = el_from where el_index like 'http://org.doi.dx%' '''
-        if self.check_time:
-            print self.check_time
-            qstring += u'''and page_touched > '''
-            qstring += self.check_time
+    def _cursor(self):
+        if self.cursor_class is None:
+            return self.conn.cursor()
+        return self.conn.cursor(self.cursor_class)
 
-        qstring += u''';'''
-        uqstring = qstring.encode('utf-8')
+    def load_high_water_mark(self):
+        '''
+        The last el_id we have looked at. On the very first run we start
+        from the newest link rather than from the whole history.
+        '''
+        if os.path.isfile(self.cursor_file):
+            return int(open(self.cursor_file, 'r').read().strip())
+        cursor = self._cursor()
+        cursor.execute(u'''select max(el_id) from externallinks''')
+        high_water_mark = cursor.fetchone()[0] or 0
+        cursor.close()
+        logging.info('no detector cursor yet, starting at el_id %s', high_water_mark)
+        self.save_high_water_mark(high_water_mark)
+        return high_water_mark
 
-        self.cursor.execute(uqstring)
-        return self.cursor.fetchall()
+    def save_high_water_mark(self, el_id):
+        tmp_file = self.cursor_file + '.tmp'
+        cursor_file = open(tmp_file, 'w')
+        cursor_file.write(str(el_id))
+        cursor_file.close()
+        os.rename(tmp_file, self.cursor_file) # atomic, never a half written mark
+        self.high_water_mark = el_id
 
-    # Find when an article has a new citation with a DOI
-    # Update the shelf with new DOI citations
-    def find_new_doi_article_pairs(self, article_deque):
+    # Get DOI links added since the high-water mark, in bounded batches
+    def get_doi_list(self):
+        '''
+        Yields lists of at most batch_size (el_id, page_title, el_to) rows,
+        in el_id order, past the high-water mark
+        '''
+        qstring = u'''select el_id, page_title, el_to from externallinks join page on page_id = el_from where el_id > %s and (%s) order by el_id limit %s''' % (
+            self.placeholder,
+            ' or '.join(['el_index like ' + self.placeholder] * len(DOI_INDEX_PATTERNS)),
+            self.placeholder)
+        last_el_id = self.high_water_mark
         while 1: # True
-            curr = self.get_doi_list()
+            cursor = self._cursor()
+            cursor.execute(qstring, (last_el_id,) + DOI_INDEX_PATTERNS + (self.page_size,))
+            page_rows = 0
+            while 1: # True
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                page_rows += len(rows)
+                last_el_id = rows[-1][0]
+                yield rows
+            cursor.close()
+            if page_rows < self.page_size:
+                return
+
+    def doi_from_link(self, el_to):
+        match = DOI_URL.match(el_to)
+        if match is None:
+            return None
+        return urllib.unquote(match.group(1))
+
+    # Find when an article has a new citation with a DOI
+    # Update the store with new DOI citations
+    def check_once(self, article_queue):
+        '''
+        Queues the new DOI-article pairs past the high-water mark and moves
+        the mark past them, returns how many were queued
+        '''
+        found = 0
+        for rows in self.get_doi_list():
             new_additions = list()
-            logging.info('sql query returned %s items', len(curr))
-            curr = curr[:100]
-            for title, doi_str in curr:
-                try:
-                    doi = doi_str.split('http://dx.doi.org/')[1]
-                except IndexError:
+            for el_id, title, doi_str in rows:
+                doi = self.doi_from_link(doi_str)
+                if not doi:
                     continue
                 doi_article = {'doi':doi,'article':title}
-                if doi not in self.shelf.keys():
-                    self.shelf[doi] = [title]
+                title_list = self.store.get(doi)
+                if title_list is None:
+                    self.store[doi] = [title]
                     new_additions.append(doi_article)
                 else:
-                    title_list = self.shelf[doi]
                     if title not in title_list:
                         title_list.append(title)
-                        self.shelf[doi] = title_list
+                        self.store[doi] = title_list
                         new_additions.append(doi_article)
-            utc = datetime.datetime.utcnow()
-            self.check_time = utc.strftime('%Y%m%d%H%M%S')
-            logging.info('found %s new additions:', len(new_additions))
+            found += len(new_additions)
             if new_additions:
-                self.article_deque.extendleft(new_addition)
-                self.shelf.sync()
-            else:
-                time.sleep(10)
+                article_queue.put_many(new_additions, priority=DETECTED)
+            self.store.sync()
+            # only move past these links once their DOIs are queued
+            self.save_high_water_mark(rows[-1][0])
+        logging.info('found %s new additions, high-water mark at el_id %s', found, self.high_water_mark)
+        return found
+
+    def find_new_doi_article_pairs(self, article_queue, stop=None):
+        '''
+        Checks for new pairs until stop (a threading.Event) is set,
+        every 10 seconds while there are none
+        '''
+        if stop is None:
+            stop = threading.Event()
+        while not stop.is_set():
+            if not self.check_once(article_queue):
+                stop.wait(10)
 
 if __name__ == '__main__':
-    from collections import deque
-    d = deque()
-    getter = doi_finder(lang='enwiki')
-    getter.find_new_doi_article_pairs(article_deque)
+    import argparse
+    import shutil
+    import tempfile
+    from article_queue import article_queue
+    parser = argparse.ArgumentParser(description='detect DOIs newly cited on Wikipedia')
+    parser.add_argument('--lang', default='enwiki')
+    parser.add_argument('--standin', action='store_true',
+                        help='run against a local SQLite stand-in replica with sample links')
+    args = parser.parse_args()
+    queue = article_queue()
+    if args.standin:
+        import replica_standin
+        # the stand-in lives in memory, so its el_ids start over every run and
+        # the cursor and state cannot be kept from one run to the next
+        scratch = tempfile.mkdtemp()
+        conn = replica_standin.connect()
+        getter = doi_finder(lang=args.lang, conn=conn, placeholder='?',
+                            store=state_store('standin_detector_state', directory=scratch),
+                            cursor_file=os.path.join(scratch, 'standin_detector_cursor'))
+        replica_standin.add_links(conn, replica_standin.SAMPLE_LINKS)
+        stop = threading.Event()
+        detector = threading.Thread(target=getter.find_new_doi_article_pairs, args=(queue, stop))
+        detector.start()
+        try:
+            for sample in replica_standin.SAMPLE_LINKS[:-1]:
+                print queue.get()
+        finally:
+            # let the detector finish its pass before the interpreter goes away
+            stop.set()
+            detector.join()
+            getter.store.close()
+            shutil.rmtree(scratch)
+    else:
+        getter = doi_finder(lang=args.lang)
+        getter.find_new_doi_article_pairs(queue)
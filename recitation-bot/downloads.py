@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import os
+import gzip
+import time
+import requests
+import http_client
+import logging
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+CHUNK_SIZE = 64 * 1024
+
+class DownloadError(Exception):
+    pass
+
+def http_url(url):
+    '''
+    The OA service hands out ftp:// links, NCBI serves the same paths over https
+    '''
+    if url.startswith('ftp://ftp.ncbi.nlm.nih.gov/'):
+        return 'https://' + url[len('ftp://'):]
+    return url
+
+def verify_gzip(path):
+    '''
+    Reads a .gz file to the end, which checks its CRC and length
+    '''
+    try:
+        archive = gzip.open(path, 'rb')
+        try:
+            while archive.read(CHUNK_SIZE):
+                pass
+        finally:
+            archive.close()
+    except (IOError, EOFError, ValueError) as e:
+        logging.info('%s failed gzip verification: %s' % (path, e))
+        return False
+    return True
+
+def remote_size(url, timeout):
+    try:
+        response = http_client.session().head(url, timeout=timeout, allow_redirects=True)
+        return int(response.headers['content-length'])
+    except (requests.RequestException, KeyError, ValueError):
+        return None
+
+def fetch(url, path, timeout=60, retries=3, backoff=2):
+    '''
+    Downloads url to path and returns stats about the download.
+
+    The body is streamed into path + '.part'; after a dropped connection the
+    next attempt resumes it with a Range request. The file is only moved to
+    path once its size matches what the server announced and it passes
+    verify_gzip, so a file at path is always complete. A verified file that
+    is already at path, and whose size still matches the server's, is reused.
+    '''
+    url = http_url(url)
+    if os.path.isfile(path):
+        size = os.path.getsize(path)
+        if remote_size(url, timeout) in (size, None) and verify_gzip(path):
+            logging.info('reusing downloaded %s' % path)
+            return {'url': url, 'bytes': 0, 'size': size, 'seconds': 0.0,
+                    'bytes_per_second': None, 'resumed_from': 0, 'cached': True}
+        os.remove(path)
+
+    part_path = path + '.part'
+    start = time.time()
+    downloaded = 0
+    resumed_from = 0
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        headers = {'Range': 'bytes=%s-' % offset} if offset else {}
+        try:
+            # fetch() resumes on its own, so no retries inside http_client
+            response = http_client.get('download', url=url, retries=0, stream=True,
+                                       timeout=timeout, headers=headers)
+            # a streamed response holds its pooled connection until closed
+            try:
+                if offset and response.status_code == 416: # the part is no good, start over
+                    os.remove(part_path)
+                    continue
+                response.raise_for_status()
+                if offset and response.status_code == 206:
+                    resumed_from = offset
+                    mode = 'ab'
+                    expected = response.headers.get('content-range', '').rpartition('/')[2]
+                else: # the server ignored the Range header
+                    offset = 0
+                    mode = 'wb'
+                    expected = response.headers.get('content-length')
+                expected = int(expected) if expected and expected.isdigit() else None
+
+                part = open(part_path, mode)
+                try:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        part.write(chunk)
+                        downloaded += len(chunk)
+                finally:
+                    part.close()
+            finally:
+                response.close()
+
+            size = os.path.getsize(part_path)
+            if expected is not None and size != expected:
+                raise DownloadError('got %s of %s bytes' % (size, expected))
+        except (requests.RequestException, DownloadError, IOError) as e:
+            if attempt == retries:
+                raise DownloadError('%s failed after %s attempts: %s' % (url, attempt + 1, e))
+            wait = backoff ** attempt
+            logging.info('download of %s interrupted (%s), resuming in %s s' % (url, e, wait))
+            time.sleep(wait)
+            continue
+
+        if not verify_gzip(part_path):
+            os.remove(part_path)
+            raise DownloadError('%s is not a valid gzip file' % url)
+        os.rename(part_path, path)
+        seconds = time.time() - start
+        stats = {'url': url, 'bytes': downloaded, 'size': size, 'seconds': seconds,
+                 'bytes_per_second': downloaded / seconds if seconds else None,
+                 'resumed_from': resumed_from, 'cached': False}
+        logging.info('downloaded %s: %s bytes in %.1f s' % (url, downloaded, seconds))
+        return stats
+
+    raise DownloadError('%s could not be downloaded' % url)
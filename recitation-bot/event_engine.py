@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+'''
+The 'events' engine for convert_and_upload: instead of a worker thread per
+article, articles are generators of steps (see article_steps in
+task_supervisor) advanced by a single dispatcher thread. A step that would
+block, a PMC call, a download, an upload or a page put, goes to a small
+pool of I/O threads, and the dispatcher moves on to the other articles
+until it is done. So hundreds of articles can be in flight with a few
+dozen threads, while each host only ever sees its own limit of calls at
+once.
+
+Python 2 has no asyncio, the generators are the coroutines and the I/O
+threads stand in for an event loop's non-blocking sockets, since requests
+and pywikibot only come in blocking.
+'''
+
+import sys
+import time
+import Queue
+import threading
+import collections
+import logging
+from worker_pool import timed_stage, timed_in_process
+from article_queue import DETECTED
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+# the host each journal_article stage spends its time waiting on; the cpu
+# stages are limited like a host, 'local' is for the ('call', ...) steps:
+# the state stores, checkpoints and status reports
+STAGE_HOSTS = {
+    'get_pmcid': 'www.pubmedcentral.nih.gov',
+    'get_targz': 'ftp.ncbi.nlm.nih.gov',
+    'extract_targz': 'cpu',
+    'find_nxml': 'cpu',
+    'extract_metadata': 'cpu',
+    'xslt_it': 'cpu',
+    'get_mwtext_element': 'cpu',
+    'render_commons_pages': 'cpu',
+    'upload_images': 'commons.wikimedia.org',
+    'replace_image_names_in_wikitext': 'cpu',
+    'replace_supplementary_material_links_in_wikitext': 'commons.wikimedia.org',
+    'push_to_wikisource': 'wikisource.org',
+    'push_redirect_wikisource': 'wikisource.org',
+}
+
+# how many calls may be out to a host at once. get_pmcid mostly waits for
+# the resolver's next batch, so it gets more than the one request it makes
+DEFAULT_HOST_LIMITS = {
+    'www.pubmedcentral.nih.gov': 16,
+    'ftp.ncbi.nlm.nih.gov': 8,
+    'commons.wikimedia.org': 4,
+    'wikisource.org': 2,
+    'cpu': 2,
+    'local': 4,
+}
+
+def step_host(step):
+    kind, what, args = step
+    if kind == 'stage':
+        return STAGE_HOSTS[what[0]]
+    if kind == 'process':
+        return 'cpu'
+    return 'local'
+
+class event_engine():
+
+    '''
+    Takes jobs off the article queue while fewer than max_in_flight
+    articles are going, and runs their steps on io_threads threads within
+    the host limits. Like worker_pool, a second job for a DOI in flight is
+    parked until the first one is done.
+
+    Only the dispatcher thread touches the articles and the host counts,
+    the other threads talk to it through the events queue. The dispatcher
+    itself never waits on the disk or the network: the planner and the
+    code between steps only work in memory.
+    '''
+
+    def __init__(self, article_queue, planner, cpu=None, io_threads=32, max_in_flight=200, host_limits=None):
+        '''
+        planner(doi_article) returns (journal_article, steps) for a job, or
+        None when there is nothing to do
+        '''
+        self.article_queue = article_queue
+        self.planner = planner
+        self.cpu = cpu
+        self.io_threads = io_threads
+        self.max_in_flight = max_in_flight
+        self.limits = dict(DEFAULT_HOST_LIMITS)
+        if host_limits:
+            self.limits.update(host_limits)
+        self.admission = threading.Semaphore(max_in_flight)
+        self.events = Queue.Queue() # ('job', doi_article) or ('done', doi, host, result, exc_info)
+        self.calls = Queue.Queue() # steps for the I/O threads
+        self.articles = dict() # doi -> (journal_article, steps)
+        self.parked = dict() # doi -> list of jobs waiting for that doi
+        self.waiting = dict() # host -> deque of (doi, step, time asked)
+        self.busy = dict() # host -> calls out
+        self.threads = list()
+
+    def intake(self):
+        while 1: # True
+            self.admission.acquire()
+            self.events.put(('job', self.article_queue.get()))
+
+    def io(self):
+        while 1: # True
+            doi, ja, host, step, asked = self.calls.get()
+            kind, what, args = step
+            result = exc_info = None
+            try:
+                if kind == 'stage':
+                    result = timed_stage(ja, what[0], args, time.time() - asked)
+                elif kind == 'process':
+                    result = timed_in_process(ja, what, self.cpu, time.time() - asked)
+                else:
+                    result = what(*args)
+            except Exception:
+                exc_info = sys.exc_info()
+            self.events.put(('done', doi, host, result, exc_info))
+
+    def dispatch(self):
+        while 1: # True
+            event = self.events.get()
+            try:
+                if event[0] == 'job':
+                    self.begin(event[1])
+                else:
+                    self.finish(*event[1:])
+            except Exception as e: # the dispatcher must not die
+                logging.exception(e)
+
+    def begin(self, doi_article):
+        doi = doi_article['doi']
+        logging.info('queue depth: %s, articles in flight: %s' % (self.article_queue.depth(), len(self.articles)))
+        if doi in self.articles:
+            self.parked.setdefault(doi, list()).append(doi_article)
+            logging.info('doi %s is already being worked on, parked it' % doi)
+            self.admission.release()
+            return
+        try:
+            planned = self.planner(doi_article)
+        except Exception as e:
+            logging.exception(e)
+            planned = None
+        if planned is None:
+            self.admission.release()
+            return
+        self.articles[doi] = planned
+        self.advance(doi, planned[1].next)
+
+    def advance(self, doi, resume, *args):
+        '''
+        Resumes doi's steps with resume(*args), and sends the next step out
+        '''
+        try:
+            step = resume(*args)
+        except StopIteration:
+            self.end(doi)
+            return
+        except Exception as e:
+            logging.exception(e)
+            self.end(doi)
+            return
+        host = step_host(step)
+        self.waiting.setdefault(host, collections.deque()).append((doi, step, time.time()))
+        self.send_out(host)
+
+    def send_out(self, host):
+        waiting = self.waiting.get(host)
+        limit = self.limits.get(host, 1)
+        while waiting and self.busy.get(host, 0) < limit:
+            doi, step, asked = waiting.popleft()
+            self.busy[host] = self.busy.get(host, 0) + 1
+            self.calls.put((doi, self.articles[doi][0], host, step, asked))
+
+    def finish(self, doi, host, result, exc_info):
+        self.busy[host] -= 1
+        self.send_out(host)
+        steps = self.articles[doi][1]
+        if exc_info is None:
+            self.advance(doi, steps.send, result)
+        else:
+            self.advance(doi, steps.throw, *exc_info)
+
+    def end(self, doi):
+        del self.articles[doi]
+        self.admission.release()
+        for doi_article in self.parked.pop(doi, list()):
+            self.article_queue.put(doi_article, doi_article.get('priority', DETECTED))
+
+    def stats(self):
+        '''
+        Articles in flight, and calls out and waiting per host; read from
+        another thread it is only roughly right
+        '''
+        return {'in_flight': len(self.articles),
+                'busy': dict(self.busy),
+                'waiting': dict((host, len(waiting)) for host, waiting in self.waiting.items())}
+
+    def start(self):
+        for number in range(self.io_threads):
+            self.threads.append(threading.Thread(target=self.io, name='io-%s' % number))
+        self.threads.append(threading.Thread(target=self.intake, name='intake'))
+        self.threads.append(threading.Thread(target=self.dispatch, name='dispatcher'))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        logging.debug('event engine started with %s io threads, up to %s articles in flight'
+                      % (self.io_threads, self.max_in_flight))
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
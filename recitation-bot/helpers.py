@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 import logging
-import requests
+import threading
+import http_client
 
 logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
 
@@ -37,35 +39,156 @@ def title_cleaner(article_title):
     return dirty_prefix
 
 
-def find_right_extension(image, qualified_article_dir):
-    '''this is a helper to get determine what extension to use'''
-    EXTENSIONS = ['jpg', 'png','jpeg', 'JPG', 'JPEG', 'Jpeg', 'PNG', 'tif', 'tiff', 'TIF', 'TIFF', 'svg', 'SVG']
+# image references as the xslt writes them, File:name|caption
+IMAGE_LINK = re.compile(r'File:([^|\[\]\n]*)\|')
+# whole [[File:name...]] links, used for supplementary materials
+FILE_LINK = re.compile(r'\[\[File:([^|\]\n]*)[^\n]*?\]\]')
+
+def rewrite_links(pattern, text, table):
+    '''Replaces every match of pattern whose first group is a name in table
+    with table[name], in one scan of text. Returns the new text, how often
+    each name in table was found, and the names found that are not in table.'''
+    counts = dict.fromkeys(table, 0)
+    unknown = list()
+    def substitute(match):
+        name = match.group(1)
+        if name in table:
+            counts[name] += 1
+            return table[name]
+        unknown.append(name)
+        return match.group(0)
+    return pattern.sub(substitute, text), counts, unknown
+
+def rewrite_problems(counts):
+    '''The names that were not found, and those found more than once'''
+    return {'unmatched': sorted(name for name, count in counts.iteritems() if count == 0),
+            'multiple': sorted(name for name, count in counts.iteritems() if count > 1)}
+
+
+EXTENSIONS = ['jpg', 'png','jpeg', 'JPG', 'JPEG', 'Jpeg', 'PNG', 'tif', 'tiff', 'TIF', 'TIFF', 'svg', 'SVG']
+
+def find_right_extension(image, qualified_article_dir, available=None):
+    '''this is a helper to get determine what extension to use
+    available, if given, is the set of file names in the article directory
+    and is checked instead of the disk'''
+    def exists(image_file, qualified_image_location):
+        if available is not None:
+            return image_file in available
+        return os.path.isfile(qualified_image_location)
     #first check if we were give an image file as is the case for supplemental images
     if image.split('.')[-1] in EXTENSIONS:
         qualified_image_location = os.path.join(qualified_article_dir, image)
-        if os.path.isfile(qualified_image_location):
+        if exists(image, qualified_image_location):
             return image, qualified_image_location
     for extension in EXTENSIONS:
         image_file = image + '.' + extension
         qualified_image_location = os.path.join(qualified_article_dir, image_file)
-        if os.path.isfile(qualified_image_location):
+        if exists(image_file, qualified_image_location):
             return image_file, qualified_image_location
         else:
             continue
 #this means no valid extension was found and returned
     return False, False #two falses so we don't break a caller expecting muliple assignment return
 
+# find_files_in_commons answers, shared across articles
+_commons_memo = dict()
+_commons_memo_lock = threading.Lock()
+COMMONS_MEMO_SIZE = 10000
+
 def find_file_in_commons(filename):
     # Use mediawiki search api to find file with unique string (doi href)
-    results = requests.get('https://commons.wikimedia.org/w/api.php?' +
-                           'action=query' +
-                           '&list=search' +
-                           '&srnamespace=6' +
-                           '&prop=imageinfo' +
-                           '&srsearch=' + filename +
-                           '&srlimit=1' +
-                           '&format=json')
-    if results.json()[u'query'][u'searchinfo'][u'totalhits'] == 1:
-        return results.json()[u'query'][u'search'][0][u'title']
-    else:
-        return False
+    return find_files_in_commons([filename])[filename]
+
+def find_files_in_commons(filenames, article_title=None):
+    '''Looks a batch of unique strings (doi hrefs without extension) up on
+    commons, returns {filename: file title or False}. Files found are
+    memoized, names not found are asked again next time.
+
+    With the article title we first try the names OAMI would have given
+    the files, many titles per query. What is left is searched for
+    SEARCH_BATCH names at a time with an OR query, paging through all its
+    hits. A name is found when exactly one file title among them contains
+    it. A name that no title contains, but that the batch had hits for,
+    gets the old search of its own, found when it has exactly one hit, so
+    that files naming it only on their description page are still found.
+    A batch with more than MAX_BATCH_HITS hits goes to the old search for
+    every name.'''
+    with _commons_memo_lock:
+        found = dict((name, _commons_memo[name]) for name in filenames if name in _commons_memo)
+    missing = [name for name in set(filenames) if name not in found]
+    if missing and article_title:
+        found.update(_find_oami_titles(missing, article_title))
+        missing = [name for name in missing if name not in found]
+    for start in range(0, len(missing), SEARCH_BATCH):
+        found.update(_search_commons(missing[start:start + SEARCH_BATCH]))
+    with _commons_memo_lock:
+        if len(_commons_memo) > COMMONS_MEMO_SIZE:
+            _commons_memo.clear()
+        _commons_memo.update((name, title) for name, title in found.iteritems() if title)
+    return found
+
+# extensions OAMI transcoded media to
+OAMI_EXTENSIONS = ['ogv', 'oga', 'ogg', 'webm']
+TITLES_PER_QUERY = 50
+SEARCH_BATCH = 10
+MAX_BATCH_HITS = 500
+
+def _find_oami_titles(filenames, article_title):
+    '''{filename: title} for the files that exist under OAMI's name'''
+    candidates = dict()
+    for name in filenames:
+        for extension in OAMI_EXTENSIONS:
+            candidates['File:' + harmonizing_name(name + '.' + extension, article_title)] = name
+    titles = candidates.keys()
+    found = dict()
+    for start in range(0, len(titles), TITLES_PER_QUERY):
+        batch = titles[start:start + TITLES_PER_QUERY]
+        results = http_client.get('commons_api', params={'action': 'query',
+                                                         'titles': '|'.join(batch),
+                                                         'format': 'json'}, parse_json=True)
+        query = results.get(u'query', {})
+        normalized = dict((entry[u'to'], entry[u'from']) for entry in query.get(u'normalized', []))
+        for page in query.get(u'pages', {}).itervalues():
+            if u'missing' in page or u'invalid' in page:
+                continue
+            asked = normalized.get(page[u'title'], page[u'title'])
+            if asked in candidates:
+                found[candidates[asked]] = page[u'title']
+    return found
+
+def _search(srsearch, limit, offset=0):
+    results = http_client.get('commons_api', params={'action': 'query',
+                                                     'list': 'search',
+                                                     'srnamespace': 6,
+                                                     'srsearch': srsearch,
+                                                     'srlimit': limit,
+                                                     'sroffset': offset,
+                                                     'format': 'json'}, parse_json=True)
+    query = results[u'query']
+    return [hit[u'title'] for hit in query[u'search']], query[u'searchinfo'][u'totalhits']
+
+def _search_commons(filenames):
+    '''{filename: title or False} from one full text search for all of them'''
+    titles, total = _search(' OR '.join(filenames), 50)
+    if total > MAX_BATCH_HITS:
+        return dict((name, _search_one(name)) for name in filenames)
+    while len(titles) < total:
+        more, total = _search(' OR '.join(filenames), 50, len(titles))
+        if not more:
+            break
+        titles.extend(more)
+    found = dict()
+    for name in filenames:
+        matches = [title for title in titles if name.lower() in title.lower()]
+        if len(matches) == 1:
+            found[name] = matches[0]
+        elif not matches and titles: # maybe a hit for it names it elsewhere
+            found[name] = _search_one(name)
+        else:
+            found[name] = False
+    return found
+
+def _search_one(filename):
+    '''the search this used to be: found when the name has exactly one hit'''
+    titles, total = _search(filename, 1)
+    return titles[0] if total == 1 else False
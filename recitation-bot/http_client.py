@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+'''
+The one HTTP session the bot uses for the PMC and Commons APIs and for
+archive downloads. Connections are kept alive and pooled per host, every
+request has a timeout, transient failures are retried with exponential
+backoff, and latency and errors are counted per endpoint.
+
+Point ENDPOINTS at a local stub server with configure(endpoints={...}).
+'''
+
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import logging
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+ENDPOINTS = {
+    'idconv': 'http://www.pubmedcentral.nih.gov/utils/idconv/v1.0/',
+    'oa': 'http://www.pubmedcentral.nih.gov/utils/oa/oa.fcgi',
+    'commons_api': 'https://commons.wikimedia.org/w/api.php',
+    # the lists behind oa_index
+    'oa_file_list': 'https://ftp.ncbi.nlm.nih.gov/pub/pmc/oa_file_list.csv',
+    'pmc_ids': 'https://ftp.ncbi.nlm.nih.gov/pub/pmc/PMC-ids.csv.gz',
+}
+
+SETTINGS = {
+    'timeout': (10, 60), # connect, read
+    'retries': 4,
+    'backoff': 1, # seconds, doubled every retry
+    'pool_hosts': 10, # hosts to keep pools for
+    'connections_per_host': 8,
+}
+
+# status codes worth trying again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_lock = threading.Lock()
+_session = None
+_metrics = dict()
+
+def configure(endpoints=None, **settings):
+    '''
+    Overrides endpoint URLs and SETTINGS, and starts a fresh session
+    '''
+    global _session
+    with _lock:
+        if endpoints:
+            ENDPOINTS.update(endpoints)
+        SETTINGS.update(settings)
+        _session = None
+
+def session():
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=SETTINGS['pool_hosts'],
+                                  pool_maxsize=SETTINGS['connections_per_host'],
+                                  pool_block=True)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session.headers['User-Agent'] = 'recitation-bot/0.1 (https://github.com/wpoa/recitation-bot)'
+        return _session
+
+def _record(endpoint, seconds, error=False, retry=False):
+    with _lock:
+        stats = _metrics.setdefault(endpoint, {'requests': 0, 'errors': 0, 'retries': 0,
+                                               'seconds': 0.0, 'max_seconds': 0.0})
+        stats['requests'] += 1
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        if error:
+            stats['errors'] += 1
+        if retry:
+            stats['retries'] += 1
+
+def metrics():
+    '''
+    {endpoint: {requests, errors, retries, seconds, max_seconds}}
+    '''
+    with _lock:
+        return dict((endpoint, dict(stats)) for endpoint, stats in _metrics.iteritems())
+
+def get(endpoint, params=None, url=None, parse_json=False, retries=None, **kwargs):
+    '''
+    GET on one of the ENDPOINTS, or on url counted under endpoint.
+
+    Connection errors, timeouts, 429/5xx responses and (with parse_json)
+    bodies that are not JSON are retried; after the last retry the error is
+    raised. Other responses are returned as they are, or as parsed JSON.
+    '''
+    if url is None:
+        url = ENDPOINTS[endpoint]
+    if retries is None:
+        retries = SETTINGS['retries']
+    kwargs.setdefault('timeout', SETTINGS['timeout'])
+    for attempt in range(retries + 1):
+        start = time.time()
+        response = None
+        try:
+            response = session().get(url, params=params, **kwargs)
+            if response.status_code in RETRY_STATUSES:
+                response.raise_for_status()
+            if parse_json:
+                response.raise_for_status()
+                result = response.json()
+            else:
+                result = response
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError, ValueError) as e:
+            if response is not None:
+                # give the connection back to the pool, with stream=True
+                # nothing else would
+                response.close()
+            retrying = attempt < retries and not _permanent(e)
+            _record(endpoint, time.time() - start, error=True, retry=retrying)
+            if not retrying:
+                raise
+            wait = SETTINGS['backoff'] * 2 ** attempt
+            logging.info('%s request failed (%s), retrying in %s s' % (endpoint, e, wait))
+            time.sleep(wait)
+            continue
+        _record(endpoint, time.time() - start)
+        return result
+
+def _permanent(error):
+    response = getattr(error, 'response', None)
+    return isinstance(error, requests.HTTPError) and response is not None \
+        and response.status_code not in RETRY_STATUSES
@@ -1,10 +1,7 @@
 # -*- coding: utf-8 -*-
 
-import requests
 from bs4 import BeautifulSoup
 import wget
-import urllib
-import tarfile
 import os
 from subprocess import call
 import xml.etree.ElementTree as etree
@@ -16,9 +13,23 @@ import ast
 import pmc_extractor
 import commons_template
 import helpers
+import upload_index
+import downloads
+import http_client
+import pmcid_resolver
+import oa_index
+import pipeline_metrics
+from article_archive import article_archive
 import logging
 import time
+import threading
+import socket
+from multiprocessing.pool import ThreadPool
 #import mwparserfromhell
+try:
+    from lxml import etree as lxml_etree
+except ImportError: # xslt_it falls back to the xsltproc subprocess
+    lxml_etree = None
 
 logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
 
@@ -30,9 +41,11 @@ class journal_article():
     and its lifecycle to make it to Wikisource.
     '''
 
-    def __init__(self, doi, article, parameters):
+    def __init__(self, doi, article, parameters, pmcid=None, package_url=None):
         '''
-        journal_articles are represented by dois
+        journal_articles are represented by dois; when the pmcid and the
+        package url are already known (backfill jobs) the API calls for
+        them are skipped
         '''
         if doi.startswith('http://dx.doi.org/'): # NOTE: https does not resolve
             doi_parts = doi.split('http://dx.doi.org/')
@@ -40,6 +53,8 @@ class journal_article():
         self.doi = doi
         self.article = article
         self.parameters = parameters
+        self.pmcid = pmcid
+        self.package_url = package_url
 
         #use these for image uploading
         self.commons = ('commons', 'commons', 'images')
@@ -50,66 +65,76 @@ class journal_article():
         # Phases, for example: (a) downloaded article, (b) extracted article's
         # pmcid, (c) uploaded the images to commons, etc.
         self.phase = defaultdict(bool)
+        # seconds per stage, filled in by worker_pool.run_stage
+        self.stage_timings = dict()
+
+    def local_index(self):
+        # the local copy of the PMC lists, None without one, see oa_index
+        return oa_index.shared(self.parameters.get('oa_index'),
+                               self.parameters.get('oa_index_max_age', 7 * 24 * 3600))
 
     # @TODO consider deprecating this for extract_metadata()
     # Already using OAMI method of getting PMID and PMCID
     def get_pmcid(self):
-        idpayload = {'ids' : self.doi, 'format': 'json'}
-        reachable = False
-        for retries in range(5):
-            try:
-                idconverter = requests.get('http://www.pubmedcentral.nih.gov/utils/idconv/v1.0/', params=idpayload)
-                try:#if the doi wasnt in pmc you can't get the records out, if the api returned not-json the you get a value error
-                    records = idconverter.json()['records']
-                except KeyError:
-                    raise ConversionError(message='probably the doi has a typo or extra text at the front or back', doi=self.doi)
-
-                if len(records) == 1:
-                    # since we are supplying a single doi, assumes we receive only 1 record
-                    record = records[0]
-                    self.pmcid = record['pmcid']
-                else:
-                    raise ConversionError(message='not just one pmcid for a doi',doi=self.doi)
-                
-            
-
-                reachable = True
-                break
-            except ValueError as e:
-                time.sleep(2)
-        if not reachable:
-            raise ConversionError(message='usually this is because PMCs API has gone down. Try clicking this URL to see: <br /> <a href="http://www.pubmedcentral.nih.gov/utils/idconv/v1.0/?ids=%s&format=json">API link</a>' % self.doi  ,doi=self.doi)
+        if not self.pmcid: # not known up front, try the local PMC-ids
+            index = self.local_index()
+            self.pmcid = index.pmcid(self.doi) if index else None
+        if self.pmcid:
+            self.phase['get_pmcid'] = True
+            return
+        # batched with other dois and cached, see pmcid_resolver
+        try:
+            self.pmcid = pmcid_resolver.shared().resolve(self.doi)
+        except pmcid_resolver.ResolveError as e:
+            if e.reason == pmcid_resolver.NOT_IN_PMC:
+                raise ConversionError(message='the doi is not in PubMed Central', doi=self.doi, reason='not_in_pmc')
+            if e.reason == pmcid_resolver.INVALID_DOI:
+                raise ConversionError(message='probably the doi has a typo or extra text at the front or back', doi=self.doi, reason='invalid_doi')
+            raise ConversionError(message='usually this is because PMCs API has gone down. Try clicking this URL to see: <br /> <a href="%s?ids=%s&format=json">API link</a>' % (http_client.ENDPOINTS['idconv'], self.doi), doi=self.doi)
 
         self.phase['get_pmcid'] = True
 
     # @TODO consider including .zip download as well or alternative
     def get_targz(self):
-        # make request for archive file location
-        archivefile_payload = {'id' : self.pmcid}
-        archivefile_locator = requests.get('http://www.pubmedcentral.nih.gov/utils/oa/oa.fcgi', params=archivefile_payload)
-        record = BeautifulSoup(archivefile_locator.content)
-        # parse response for archive file location
-        archivefile_url = record.oa.records.record.find(format='tgz')['href']
+        archivefile_url = self.package_url
+        if not archivefile_url: # not known up front, try the local OA file list
+            index = self.local_index()
+            entry = index.package(self.pmcid) if index else None
+            archivefile_url = entry and entry['package_url']
+        if not archivefile_url:
+            # make request for archive file location
+            archivefile_payload = {'id' : self.pmcid}
+            archivefile_locator = http_client.get('oa', params=archivefile_payload)
+            record = BeautifulSoup(archivefile_locator.content)
+            # parse response for archive file location
+            try:
+                archivefile_url = record.oa.records.record.find(format='tgz')['href']
+            except (AttributeError, TypeError, KeyError): # not open access, or no tgz package
+                raise ConversionError(message='PMC has no tar.gz package for this article', doi=self.doi, reason='no_tgz')
         archivefile_name = wget.filename_from_url(archivefile_url)
         complete_path_targz = os.path.join(self.parameters["data_dir"], archivefile_name)
 
-        # @TODO For some reason, wget hangs and doesn't finish
-        # archivefile = wget.download(archivefileurl, wget.bar_thermometer)
-        # Using urllib.urlretrieve() instead of wget for now:
-
-        # Download targz
-        urllib.urlretrieve(archivefile_url, complete_path_targz)
+        # Download targz, or reuse it if we already have it (reuploads)
+        try:
+            self.download_stats = downloads.fetch(archivefile_url, complete_path_targz,
+                                                  timeout=self.parameters.get('download_timeout', 60))
+        except downloads.DownloadError as e:
+            raise ConversionError(message='could not download the article archive: %s' % e, doi=self.doi)
+        logging.info('download stats for %s: %s' % (self.doi, self.download_stats))
+        pipeline_metrics.shared().count('bytes_downloaded', self.download_stats['bytes'])
         self.complete_path_targz = complete_path_targz
 
         self.phase['get_targz'] = True
 
 
     def extract_targz(self):
+        # only the nxml and the images are written out, see article_archive
         try:
             directory_name, file_extension = self.complete_path_targz.split('.tar.gz')
             self.article_dir = directory_name
-            tar = tarfile.open(self.complete_path_targz, 'r:gz')
-            tar.extractall(self.parameters["data_dir"])
+            self.qualified_article_dir = os.path.join(self.parameters["data_dir"], self.article_dir)
+            archive = article_archive(self.complete_path_targz)
+            self.article_files = archive.extract(self.qualified_article_dir, ['nxml'] + helpers.EXTENSIONS)
 
             self.phase['extract_targz'] = True
 
@@ -118,8 +143,7 @@ class journal_article():
 
     def find_nxml(self):
         try:
-            self.qualified_article_dir = os.path.join(self.parameters["data_dir"], self.article_dir)
-            nxml_files = [file for file in os.listdir(self.qualified_article_dir) if file.endswith(".nxml")]
+            nxml_files = [file for file in self.article_files if file.endswith(".nxml")]
             if len(nxml_files) != 1:
                 raise ConversionError(message='we need exactly 1 nxml file, no more, no less', doi=self.doi)
             nxml_file = nxml_files[0]
@@ -139,12 +163,37 @@ class journal_article():
         if not any([self.metadata['article-license-url'],
                    self.metadata['article-license-text'],
                    self.metadata['article-copyright-statement']]):
-            raise ConversionError(message='no article license', doi=self.doi)
+            raise ConversionError(message='no article license', doi=self.doi, reason='no_license')
 
         self.phase['extract_metadata'] = True
 
     def xslt_it(self):
-        # Try to apply XSL transform from XML to MediaWiki markup (wikitext)
+        # Apply the XSL transform from XML to MediaWiki markup (wikitext),
+        # in process when lxml is around, with `xsltproc` as the fallback
+        if self.parameters.get('xslt_engine', 'lxml') == 'lxml' and lxml_etree is not None:
+            try:
+                self.xslt_in_process()
+                return
+            except Exception as e:
+                logging.info('in-process xslt failed for %s, falling back to xsltproc: %s' % (self.doi, e))
+        self.xslt_subprocess()
+
+    def xslt_in_process(self):
+        # the result tree goes straight to get_mwtext_element, no .mw.xml file
+        transform = compiled_stylesheet(self.parameters["jats2mw_xsl"])
+        # same parse options xsltproc uses by default
+        parser = lxml_etree.XMLParser(load_dtd=True, attribute_defaults=True,
+                                      strip_cdata=True, no_network=False)
+        result = transform(lxml_etree.parse(self.nxml_path, parser))
+        root = result.getroot()
+        if root is None:
+            raise ConversionError(message='the xslt produced an empty document', doi=self.doi)
+        self.mw_xml_root = root
+        self.mw_xml_file = None
+
+        self.phase['xslt_it'] = True
+
+    def xslt_subprocess(self):
         try:
             doi_file_name = self.doi + '.mw.xml'
             mw_xml_file = os.path.join(self.parameters["data_dir"], doi_file_name)
@@ -155,12 +204,10 @@ class journal_article():
             if not os.path.exists(mw_xml_dir):
                 os.makedirs(mw_xml_dir)
             mw_xml_file_handle = open(mw_xml_file, 'w')
-            # @TODO may use python lxml library instead of shell call to `xsltproc`
-            # http://lxml.de/xpathxslt.html#xslt
-            # Unclear if there will be a difference in performance / accuracy
             call_return = call(['xsltproc', self.parameters["jats2mw_xsl"], self.nxml_path], stdout=mw_xml_file_handle)
             if call_return == 0: #things went well
                 mw_xml_file_handle.close()
+                self.mw_xml_root = None
                 self.mw_xml_file = mw_xml_file
 
                 self.phase['xslt_it'] = True
@@ -175,54 +222,31 @@ class journal_article():
     # Alternatively, could replace bs4 with etree for performance.
     def get_mwtext_element(self):
         try:
-            tree = etree.parse(self.mw_xml_file)
-            root = tree.getroot()
+            root = getattr(self, 'mw_xml_root', None)
+            if root is None: # xsltproc wrote the result to disk
+                root = etree.parse(self.mw_xml_file).getroot()
             mwtext = root.find('mw:page/mw:revision/mw:text', namespaces={'mw':'http://www.mediawiki.org/xml/export-0.8/'})
             self.wikitext = mwtext.text
+            self.mw_xml_root = None # done with it, and it does not pickle
 
             self.phase['get_mwtext_element'] = True
 
         except:
-            raise ConversionError(message='no text element')
-
-    def upload_images(self, im_uploads):
-        #this is the upload procedure which we call in a second
-        def upload(site, metadata, image_dict):
-            for image in metadata[image_dict]:
-                image_file, qualified_image_location = helpers.find_right_extension(image, self.qualified_article_dir)
+            raise ConversionError(message='no text element', doi=self.doi)
 
-                logging.info(image_file)
+    def render_commons_pages(self):
+        # the file description pages upload_image needs, made ahead of time
+        # so that a cpu_pool child can do it along with the xslt
+        self.commons_pages = dict()
+        for image_dict in ['images', 'equations', 'tables']:
+            for image, image_data in self.metadata[image_dict].iteritems():
+                self.commons_pages['%s/%s' % (image_dict, image)] = \
+                    commons_template.page(self.metadata, image_data['caption'])
 
-                if image_file: #we found a valid image file
-                    harmonized_name = helpers.harmonizing_name(image_file, metadata['article-title'])
-                        #print harmonized_name
-                    image_page = pywikibot.ImagePage(site, harmonized_name)
-                    page_text = commons_template.page(metadata, metadata[image_dict][image]['caption'])
-                    image_page._text = page_text
-                    try:
-                        site.upload(imagepage=image_page, source_filename=qualified_image_location, 
-                                       comment='Automatic upload of media from: [[doi:' + self.doi+']]',
-                                       ignore_warnings=False)
-                                           # "ignore_warnings" means "overwrite" if True
-                        logging.info('Uploaded image %s' % image_file)
-                        metadata[image_dict][image]['uploaded_name'] = harmonized_name
-                    except pywikibot.exceptions.UploadWarning as warning:
-                        warning_string = unicode(warning)
-                        if warning_string.startswith('Uploaded file is a duplicate of '):
-                            liststring = warning_string.split('Uploaded file is a duplicate of ')[1][:-1]
-                            duplicate_list = ast.literal_eval(liststring)
-                            duplicate_name = duplicate_list[0]
-                            print 'duplicate found: ', duplicate_name
-                            logging.info('Duplicate image %s' % image_file)
-                            metadata[image_dict][image]['uploaded_name'] = duplicate_name
-                        elif warning_string.endswith('already exists.'):
-                            logging.info('Already exists image %s' % image_file)
-                            metadata[image_dict][image]['uploaded_name'] = harmonized_name
-                        else:
-                            raise
-        
-
-        #now we start calling the uploader
+    def upload_images(self, im_uploads):
+        # uploads run upload_concurrency at a time, pywikibot's put throttle
+        # still paces the writes to each site. Files whose SHA-1 is in the
+        # upload index are not sent again.
         upload_sites = list()
         sites_map = {'commons':self.commons,
                      'equations':self.equations,
@@ -230,81 +254,153 @@ class journal_article():
         for sitestr, flag in im_uploads.iteritems():
             upload_sites.append(sites_map[sitestr])
 
+        index = upload_index.shared()
+        uploads = list()
         for lang, family, image_dict in upload_sites:
-            site = pywikibot.Site(lang, family)
+            site = self.wiki_site(lang, family)
             if not site.logged_in():
                 site.login()
-
-            upload(site, self.metadata, image_dict)
+            site_hashes = list()
+            for image in self.metadata[image_dict]:
+                if 'uploaded_name' in self.metadata[image_dict][image]:
+                    continue # uploaded before a resumed run stopped
+                image_file, qualified_image_location = helpers.find_right_extension(image, self.qualified_article_dir, self.article_files)
+                logging.info(image_file)
+                if not image_file: #we did not find a valid image file
+                    continue
+                sha1 = upload_index.file_sha1(qualified_image_location)
+                site_hashes.append(sha1)
+                uploads.append((site, image_dict, image, image_file, qualified_image_location, sha1))
+            if self.parameters.get('hash_precheck') and site_hashes:
+                index.precheck(site, site_hashes)
+
+        concurrency = self.parameters.get('upload_concurrency', 4)
+        if concurrency > 1 and len(uploads) > 1:
+            pool = ThreadPool(min(concurrency, len(uploads)))
+            try:
+                # map re-raises the first upload that failed for good
+                pool.map(lambda upload: self.upload_image(*upload), uploads)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for upload in uploads:
+                self.upload_image(*upload)
+        index.sync()
 
         self.phase['upload_images'] = True
 
-    def replace_image_names_in_wikitext(self):
+    def upload_image(self, site, image_dict, image, image_file, qualified_image_location, sha1):
+        # uploads one image, retrying transient failures with backoff, and
+        # records the name it ended up with on the wiki
+        metadata = self.metadata
+        index = upload_index.shared()
+        known_name = index.lookup(site, sha1)
+        if known_name is not None:
+            logging.info('Known image %s is %s, not uploading' % (image_file, known_name))
+            metadata[image_dict][image]['uploaded_name'] = known_name
+            pipeline_metrics.shared().count('images_reused')
+            return
+        harmonized_name = helpers.harmonizing_name(image_file, metadata['article-title'])
+        page_text = getattr(self, 'commons_pages', {}).get('%s/%s' % (image_dict, image))
+        if page_text is None:
+            page_text = commons_template.page(metadata, metadata[image_dict][image]['caption'])
+        retries = self.parameters.get('upload_retries', 4)
+        for attempt in range(retries + 1):
+            image_page = self.wiki_image_page(site, harmonized_name)
+            image_page._text = page_text
+            try:
+                site.upload(imagepage=image_page, source_filename=qualified_image_location,
+                               comment='Automatic upload of media from: [[doi:' + self.doi+']]',
+                               ignore_warnings=False)
+                                   # "ignore_warnings" means "overwrite" if True
+                logging.info('Uploaded image %s' % image_file)
+                metadata[image_dict][image]['uploaded_name'] = harmonized_name
+                index.record(site, sha1, harmonized_name)
+                pipeline_metrics.shared().count('images_uploaded')
+                return
+            except pywikibot.exceptions.UploadWarning as warning:
+                warning_string = unicode(warning)
+                if warning_string.startswith('Uploaded file is a duplicate of '):
+                    liststring = warning_string.split('Uploaded file is a duplicate of ')[1][:-1]
+                    duplicate_list = ast.literal_eval(liststring)
+                    duplicate_name = duplicate_list[0]
+                    logging.info('Duplicate image %s of %s' % (image_file, duplicate_name))
+                    metadata[image_dict][image]['uploaded_name'] = duplicate_name
+                    index.record(site, sha1, duplicate_name)
+                    pipeline_metrics.shared().count('images_reused')
+                elif warning_string.endswith('already exists.'):
+                    logging.info('Already exists image %s' % image_file)
+                    metadata[image_dict][image]['uploaded_name'] = harmonized_name
+                    pipeline_metrics.shared().count('images_reused')
+                else:
+                    raise
+                return
+            except Exception as e:
+                wait = upload_retry_wait(e, attempt)
+                if wait is None or attempt == retries:
+                    raise
+                logging.info('upload of %s failed (%s), retrying in %s s' % (image_file, e, wait))
+                pipeline_metrics.shared().count('upload_retries')
+                time.sleep(wait)
 
-        def replace(metadata, image_dict, replacing_text):
-            for image in metadata[image_dict].iterkeys():
-                extensionless_re = r'File:(' + image + r')\|'
-                logging.info('extensionless re: %s' % extensionless_re)
-                try:
-                    new_file_text = r'File:' + metadata[image_dict][image]['uploaded_name'] + r'|'
-                    replacing_text, occurrences = re.subn(extensionless_re, new_file_text, replacing_text)
-                    logging.info('re stuff: %s, %s, %s' % (extensionless_re, new_file_text,  occurrences) ) 
-                    if occurrences != 1:
-                        logging.info('not one replace occurence %s, %s ' % (occurrences, image))
-                except KeyError:
-                    #the file may not have been uploaded and thus not have an uploaded name
-                    continue #on to the next image
-            return replacing_text
-        
-
-        self.image_fixed_wikitext = self.wikitext #it will become image_fixed_wikitext
+    def replace_image_names_in_wikitext(self):
+        # one table for all three kinds of image, first one wins like it did
+        # when they were replaced one dict after the other
+        table = dict()
         for lang, family, image_dict in [self.commons, self.equations, self.tables]:
-            #we don't need lang or family for this, but i keep the loop just for formalism
-            logging.info('now replacing: %s' % image_dict)
-            self.image_fixed_wikitext = replace(self.metadata, image_dict, self.image_fixed_wikitext)    
-        
+            for image, image_data in self.metadata[image_dict].iteritems():
+                #the file may not have been uploaded and thus not have an uploaded name
+                if 'uploaded_name' in image_data:
+                    table.setdefault(image, r'File:' + image_data['uploaded_name'] + r'|')
+
+        self.image_fixed_wikitext, counts, unknown = helpers.rewrite_links(helpers.IMAGE_LINK, self.wikitext, table)
+        self.rewrite_report = {'images': helpers.rewrite_problems(counts), 'unknown': unknown}
+        logging.info('replaced %s image references for %s, problems: %s' % (
+            sum(counts.itervalues()), self.doi, self.rewrite_report['images']))
+
         self.phase['replace_image_names_in_wikitext'] = True
 
     def replace_supplementary_material_links_in_wikitext(self):
-        replacing_text = self.image_fixed_wikitext
-        for material in self.metadata['supplementary-materials']:
-            extensionless_re = r'\[\[File:(' + material['href'] + r').*?\]\]'
-            try:
-                # Check if this is an OAMI-uploaded file on commons, or not
-                href_no_extension = os.path.splitext(material['href'])[0]
-                found_file = helpers.find_file_in_commons(href_no_extension)
-                if found_file:
-                    # Use commons file instead of external URL
-                    new_file_text = r'[[' + found_file + r']]'
-                else:
-                    # Use external URL to PMC file
-                    new_file_text = r'[' + material['url'] + r' ' + material['href']  + r']'
-
-                replacing_text, occurrences = re.subn(extensionless_re, new_file_text, replacing_text)
-                if occurrences != 1:
-                    print occurrences, material
-                    # print replacing_text
-            except KeyError:
-                continue #on to the next image
-        # replace the text
-        self.image_fixed_wikitext = replacing_text
+        materials = [material for material in self.metadata['supplementary-materials'] if 'href' in material]
+        # Check which materials are OAMI-uploaded files on commons, all at once
+        found_files = helpers.find_files_in_commons([os.path.splitext(material['href'])[0] for material in materials],
+                                                    self.metadata['article-title'])
+        table = dict()
+        for material in materials:
+            found_file = found_files[os.path.splitext(material['href'])[0]]
+            if found_file:
+                # Use commons file instead of external URL
+                table.setdefault(material['href'], r'[[' + found_file + r']]')
+            elif 'url' in material:
+                # Use external URL to PMC file
+                table.setdefault(material['href'], r'[' + material['url'] + r' ' + material['href'] + r']')
+
+        self.image_fixed_wikitext, counts, unknown = helpers.rewrite_links(helpers.FILE_LINK, self.image_fixed_wikitext, table)
+        report = getattr(self, 'rewrite_report', {'unknown': []})
+        report['supplementary'] = helpers.rewrite_problems(counts)
+        # what neither pass knew about
+        report['unknown'] = sorted(set(report['unknown']) & set(unknown))
+        self.rewrite_report = report
+        logging.info('replaced %s supplementary links for %s, problems: %s, unknown files: %s' % (
+            sum(counts.itervalues()), self.doi, report['supplementary'], report['unknown']))
 
         self.phase['replace_supplementary_material_links_in_wikitext'] = True
 
     def push_to_wikisource(self):
-        site = pywikibot.Site(self.parameters["wikisource_site"], "wikisource")
+        site = self.wiki_site(self.parameters["wikisource_site"], "wikisource")
         self.wikisource_title = self.parameters["wikisource_basepath"] + helpers.title_cleaner(self.metadata['article-title'])
         if len(self.wikisource_title) > 255:
                 self.wikisource_title = self.wikisource_title[:255]
-        page = pywikibot.Page(site, self.wikisource_title)
+        page = self.wiki_page(site, self.wikisource_title)
         comment = "Imported [[doi:"+self.doi+"]] from http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pmc&id="+self.pmcid+" by recitation-bot v0.1"
         page.put(newtext=self.image_fixed_wikitext, botflag=True, comment=comment)
         self.wiki_link = page.title(asLink=True)
 
         self.phase['push_to_wikisource'] = True
     def push_redirect_wikisource(self):
-        site = pywikibot.Site(self.parameters["wikisource_site"], "wikisource")
-        page = pywikibot.Page(site, self.parameters["wikisource_basepath"] + self.doi)
+        site = self.wiki_site(self.parameters["wikisource_site"], "wikisource")
+        page = self.wiki_page(site, self.parameters["wikisource_basepath"] + self.doi)
         comment = "Making a redirect"
         redirtext = '#REDIRECT [[' + self.wikisource_title +']]'
         page.put(newtext=redirtext, botflag=True, comment=comment)
@@ -312,6 +408,17 @@ class journal_article():
         self.phase['push_redirect_wikisource'] = True
 
 
+    # pywikibot by default, parameters can swap in other classes (see
+    # mock_services) to run the pipeline against a stand-in wiki
+    def wiki_site(self, lang, family):
+        return self.parameters.get('site_factory', pywikibot.Site)(lang, family)
+
+    def wiki_page(self, site, title):
+        return self.parameters.get('page_factory', pywikibot.Page)(site, title)
+
+    def wiki_image_page(self, site, title):
+        return self.parameters.get('image_page_factory', pywikibot.ImagePage)(site, title)
+
     def urlstr(self):
         https = "https://en.wikisource.org/wiki/%s" % self.wikisource_title
         safe = https.replace(' ','_')
@@ -325,16 +432,123 @@ class journal_article():
         https = "https://%s.wikisource.org/wiki/%s%s" % (lang, base, doi_end)
         return https
 
+    def checkpoint(self):
+        '''
+        What a later run needs to carry on where this one stopped, as a plain
+        dict: the completed phases and what they produced
+        '''
+        state = dict((attribute, getattr(self, attribute)) for attribute in CHECKPOINT_ATTRIBUTES
+                     if hasattr(self, attribute))
+        state['phase'] = dict(self.phase)
+        return state
+
+    def restore(self, checkpoint):
+        '''
+        Takes over a checkpoint() of an earlier run. Phases whose files are
+        gone from disk since are marked undone again, along with everything
+        after them. Returns the phases that are done and will be skipped.
+        '''
+        self.apply(checkpoint)
+
+        def rewind(phase):
+            for later in PHASES[PHASES.index(phase):]:
+                self.phase[later] = False
+
+        next_phase = self.next_phase()
+        if next_phase is None:
+            return list(PHASES)
+        if self.phase['xslt_it'] and next_phase == 'get_mwtext_element':
+            rewind('xslt_it') # an in-process result tree is not checkpointed
+            next_phase = 'xslt_it'
+        if self.phase['extract_targz'] and next_phase in FILE_PHASES:
+            article_files = [os.path.join(self.qualified_article_dir, name) for name in self.article_files]
+            if not all(os.path.isfile(path) for path in article_files):
+                rewind('extract_targz')
+        if self.phase['get_targz'] and not self.phase['extract_targz'] and \
+                not os.path.isfile(self.complete_path_targz):
+            rewind('get_targz')
+        return [phase for phase in PHASES if self.phase[phase]]
+
+    def apply(self, checkpoint):
+        '''
+        Takes over a checkpoint() as it is, e.g. what a cpu_pool child made
+        '''
+        for attribute in CHECKPOINT_ATTRIBUTES:
+            if attribute in checkpoint:
+                setattr(self, attribute, checkpoint[attribute])
+        self.phase = defaultdict(bool, checkpoint['phase'])
+
+    def next_phase(self):
+        '''
+        The first phase that is not done yet, None when all are
+        '''
+        for phase in PHASES:
+            if not self.phase[phase]:
+                return phase
+        return None
+
+    def __getstate__(self):
+        # lxml trees can not be pickled into the state store
+        state = self.__dict__.copy()
+        state.pop('mw_xml_root', None)
+        return state
+
     def htmlstr(self):
         return_string = 'See <a href="https://en.wikisource.org/wiki/%s">%s</a>\n' % (self.wikisource_title, self.wikisource_title)
         for metadata, val in self.metadata.iteritems():
             return_string += u'<p>' + unicode(metadata) + u':' + unicode(val) + u'</p>' + u'\n'
         return return_string
 
+# the phases in the order they run
+PHASES = ['get_pmcid', 'get_targz', 'extract_targz', 'find_nxml', 'extract_metadata',
+          'xslt_it', 'get_mwtext_element', 'upload_images',
+          'replace_image_names_in_wikitext', 'replace_supplementary_material_links_in_wikitext',
+          'push_to_wikisource', 'push_redirect_wikisource']
+
+# phases that read the extracted article files
+FILE_PHASES = ['find_nxml', 'extract_metadata', 'xslt_it', 'upload_images']
+
+# what checkpoint() keeps, the uploaded names are in metadata
+CHECKPOINT_ATTRIBUTES = ('pmcid', 'complete_path_targz', 'download_stats', 'article_dir',
+                         'qualified_article_dir', 'article_files', 'nxml_path', 'metadata',
+                         'mw_xml_file', 'wikitext', 'image_fixed_wikitext', 'rewrite_report',
+                         'commons_pages', 'wikisource_title', 'wiki_link')
+
+# API error codes that mean "slow down and try again"
+RETRY_API_CODES = ('maxlag', 'ratelimited', 'readonly', 'internal_api_error_DBQueryError')
+
+def upload_retry_wait(error, attempt, base=5):
+    '''
+    Seconds to wait before retrying an upload that raised error,
+    or None if it should not be retried
+    '''
+    if getattr(error, 'code', None) in RETRY_API_CODES or \
+            isinstance(error, (pywikibot.exceptions.ServerError, socket.error)):
+        return base * 2 ** attempt
+    return None
+
+# compiled stylesheets are kept per worker thread, lxml XSLT objects
+# should not be shared between threads
+_xslt_cache = threading.local()
+
+def compiled_stylesheet(xsl_path):
+    '''
+    Parses and compiles an XSL stylesheet once per thread
+    '''
+    stylesheets = getattr(_xslt_cache, 'stylesheets', None)
+    if stylesheets is None:
+        stylesheets = _xslt_cache.stylesheets = dict()
+    if xsl_path not in stylesheets:
+        stylesheets[xsl_path] = lxml_etree.XSLT(lxml_etree.parse(xsl_path))
+    return stylesheets[xsl_path]
+
 class ConversionError(Exception):
-    def __init__(self, message, doi):
+    def __init__(self, message, doi, reason=None):
         # Call the base class constructor with the parameters it needs
         Exception.__init__(self, message)
         # Store DOI as error in object
         # @TODO do something with error_doi?
         self.error_doi = doi
+        # why the doi can not be converted, when that will not change by
+        # itself (see negative_cache.REASONS)
+        self.reason = reason
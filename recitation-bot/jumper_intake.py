@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+'''
+Reads jump-the-queue requests from the append-only spool file that the
+jump_the_queue web server writes, one request per line:
+
+    10.1371/journal.pone.0012292<TAB>['reupload_text', 'reupload_images']
+
+The file is never truncated under the writer. How far it has been read is
+kept in a separate offset file, which is only moved on after the requests
+are on the queue, so a crash can at worst queue a request twice (the queue
+merges those) and never loses one. A line without its newline yet is left
+for the next read.
+
+Writers and rotate() take an flock on the spool, so a line is never
+appended to a spool that has already been moved aside and read.
+
+The standard library has no inotify, so the spool is stat()ed every
+`poll` seconds, which costs next to nothing and is much sooner than the
+old 10 s read-and-truncate loop.
+'''
+
+import os
+import re
+import ast
+import time
+import fcntl
+import logging
+from article_queue import JUMPER
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+DOI_PATTERN = re.compile(r'^10\.\d{4,9}/\S+$')
+REUPLOAD_FLAGS = ('reupload_text', 'reupload_images', 'reupload_equations', 'reupload_tables')
+
+class InvalidRequest(Exception):
+    pass
+
+def parse_line(line):
+    '''
+    The doi_article job for one spool line, or InvalidRequest
+    '''
+    doi, separator, reupload_str = line.strip().partition('\t')
+    doi = doi.strip()
+    if doi.startswith('http://dx.doi.org/'):
+        doi = doi[len('http://dx.doi.org/'):]
+    if not DOI_PATTERN.match(doi):
+        raise InvalidRequest('not a doi: %r' % doi)
+    reupload = None
+    if reupload_str.strip():
+        try:
+            reupload = ast.literal_eval(reupload_str.strip())
+        except (ValueError, SyntaxError):
+            raise InvalidRequest('reupload is not a list: %r' % reupload_str)
+        if reupload is not None:
+            if not isinstance(reupload, (list, tuple)):
+                raise InvalidRequest('reupload is not a list: %r' % reupload_str)
+            unknown = [flag for flag in reupload if flag not in REUPLOAD_FLAGS]
+            if unknown:
+                raise InvalidRequest('unknown reupload flags: %s' % unknown)
+            reupload = list(reupload)
+    return {'doi': doi, 'reupload': reupload or None, 'article': None}
+
+def append_requests(path, requests):
+    '''
+    For writers: appends (doi, reupload) requests to the spool in one
+    write, so a batch is never interleaved with another writer's lines
+    '''
+    lines = ''.join('%s\t%r\n' % (doi, list(reupload) if reupload else None) for doi, reupload in requests)
+    while 1: # True
+        spool = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(spool, fcntl.LOCK_EX)
+            # rotate() may have moved the file aside while we waited for
+            # the lock, then it is the new spool that gets the lines
+            if os.path.exists(path) and os.path.samestat(os.fstat(spool), os.stat(path)):
+                os.write(spool, lines)
+                return
+        finally:
+            os.close(spool)
+
+class jumper_intake():
+
+    def __init__(self, path, offset_path=None, poll=1.0, rotate_size=10 * 1024 * 1024):
+        '''
+        Once all of a spool bigger than rotate_size is read it is moved
+        aside and a new one is started
+        '''
+        self.path = path
+        self.offset_path = offset_path or path + '.offset'
+        self.rejected_path = path + '.rejected'
+        self.rotating_path = path + '.rotating'
+        self.poll = poll
+        self.rotate_size = rotate_size
+
+    def load_offset(self):
+        try:
+            return int(open(self.offset_path).read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def commit_offset(self, offset):
+        tmp_path = self.offset_path + '.tmp'
+        offset_file = open(tmp_path, 'w')
+        offset_file.write('%s\n' % offset)
+        offset_file.flush()
+        os.fsync(offset_file.fileno())
+        offset_file.close()
+        os.rename(tmp_path, self.offset_path)
+
+    def read_complete_lines(self, path, offset):
+        '''
+        The complete lines after offset, and the offset after them
+        '''
+        spool = open(path, 'rb')
+        try:
+            spool.seek(offset)
+            data = spool.read()
+        finally:
+            spool.close()
+        end = data.rfind('\n') + 1
+        return data[:end].splitlines(), offset + end
+
+    def take(self, lines, article_queue):
+        '''
+        Validates lines and queues the good ones in one go, returns how
+        many were queued
+        '''
+        jobs = list()
+        rejected = list()
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                jobs.append(parse_line(line))
+            except InvalidRequest as e:
+                logging.info('rejected jumper line %r: %s' % (line, e))
+                rejected.append('%s\t%s\n' % (line, e))
+        if rejected:
+            rejected_file = open(self.rejected_path, 'a')
+            rejected_file.writelines(rejected)
+            rejected_file.close()
+        article_queue.put_many(jobs, priority=JUMPER)
+        return len(jobs)
+
+    def drain(self, article_queue):
+        '''
+        Queues everything complete in the spool since the committed offset
+        '''
+        # a spool moved aside by an earlier rotate that was not finished
+        if os.path.exists(self.rotating_path):
+            lines, offset = self.read_complete_lines(self.rotating_path, self.load_offset())
+            self.take(lines, article_queue)
+            os.remove(self.rotating_path)
+            self.commit_offset(0)
+
+        if not os.path.exists(self.path):
+            return 0
+        offset = self.load_offset()
+        size = os.path.getsize(self.path)
+        if size < offset:
+            logging.info('%s is shorter than the committed offset, it was replaced, reading from the start' % self.path)
+            offset = 0
+        if size == offset:
+            return 0
+        lines, new_offset = self.read_complete_lines(self.path, offset)
+        queued = self.take(lines, article_queue)
+        if new_offset != offset:
+            self.commit_offset(new_offset)
+            logging.info('%s items found from the jumper queue' % queued)
+        if new_offset >= self.rotate_size and new_offset == os.path.getsize(self.path):
+            self.rotate(article_queue)
+        return queued
+
+    def rotate(self, article_queue):
+        # lines appended between the size check and the rename are in the
+        # moved file, drain() picks them up from there. Writers wait on the
+        # lock and then append to the new spool, see append_requests
+        spool = os.open(self.path, os.O_RDONLY)
+        try:
+            fcntl.flock(spool, fcntl.LOCK_EX)
+            os.rename(self.path, self.rotating_path)
+        finally:
+            os.close(spool)
+        self.drain(article_queue)
+        logging.info('rotated %s' % self.path)
+
+    def run(self, article_queue):
+        logging.debug('jumper intake watching %s' % self.path)
+        while 1: # True
+            try:
+                self.drain(article_queue)
+            except (IOError, OSError) as e:
+                logging.info('could not read jumpers from %s: %s' % (self.path, e))
+            time.sleep(self.poll)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='add jump-the-queue requests to the spool')
+    parser.add_argument('spool')
+    parser.add_argument('dois', nargs='+')
+    parser.add_argument('--reupload', nargs='*', choices=REUPLOAD_FLAGS, default=None)
+    args = parser.parse_args()
+    requests = [(doi, args.reupload) for doi in args.dois]
+    for doi, reupload in requests:
+        try: # refuse bad ones before writing anything
+            parse_line('%s\t%r' % (doi, reupload))
+        except InvalidRequest as e:
+            parser.error(str(e))
+    append_requests(args.spool, requests)
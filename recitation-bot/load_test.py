@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+'''
+Pushes N made up DOIs through the whole supervisor (queue, worker pool,
+every journal_article stage) against mock_services, and reports throughput
+and latency percentiles from queueing a DOI to its status report.
+
+    python load_test.py /path/to/jats-to-mediawiki.xsl --dois 200 --latency 0.05 --error-rate 0.01
+
+Everything the run writes (state stores, status pages, packages) goes to a
+temporary directory, which is removed afterwards unless --keep is given.
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import argparse
+import mock_services
+import pipeline_metrics
+import status_page
+import task_supervisor
+from article_queue import article_queue, DETECTED
+
+def percentile(values, share):
+    '''
+    nearest rank percentile of values, share between 0 and 1
+    '''
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, int(round(share * len(values) + 0.5)) - 1))
+    return values[rank]
+
+def run(xsl_path, dois=100, workers=4, latency=0.0, jitter=0.0, error_rate=0.0,
+        figures=5, not_in_pmc=0.0, timeout=3600, keep=False, cpu_processes=0, engine='threads',
+        max_in_flight=200):
+    '''
+    Returns a dict of results, see report()
+    '''
+    work_dir = tempfile.mkdtemp(prefix='recitation-load-')
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(data_dir)
+    old_dir = os.getcwd()
+    os.chdir(work_dir) # the state stores live in the working directory
+    status_page.page_base_path = os.path.join(work_dir, 'public_html') + '/'
+
+    server = mock_services.mock_server(0, latency=latency, jitter=jitter,
+                                       error_rate=error_rate, figures=figures, seed=1)
+    server.start()
+    overrides = mock_services.use_mock_wiki(server)
+    overrides.update({'data_dir': data_dir,
+                      'jats2mw_xsl': xsl_path,
+                      'workers': workers,
+                      'cpu_processes': cpu_processes,
+                      'engine': engine,
+                      'max_in_flight': max_in_flight,
+                      'metrics_file': os.path.join(work_dir, 'metrics.prom')})
+
+    queued = dict()
+    finished = dict()
+    outcomes = dict()
+    all_done = threading.Event()
+
+    def listener(doi, success, status_msg):
+        finished[doi] = time.time()
+        outcomes[doi] = (success, status_msg)
+        if len(finished) >= len(queued):
+            all_done.set()
+
+    task_supervisor.tweet = False
+    task_supervisor.status_listeners.append(listener)
+    queue = article_queue()
+    consumer = threading.Thread(target=task_supervisor.convert_and_upload,
+                                kwargs={'article_queue': queue, 'overrides': overrides})
+    consumer.daemon = True
+    try:
+        names = ['10.5555/load.%05d' % number for number in range(dois)]
+        skip_every = int(round(1 / not_in_pmc)) if not_in_pmc else 0
+        if skip_every:
+            names = [name.replace('load.', 'notinpmc.') if number % skip_every == 0 else name
+                     for number, name in enumerate(names)]
+        start = time.time()
+        for doi in names:
+            queued[doi] = time.time()
+            queue.put({'doi': doi, 'reupload': None, 'article': None}, priority=DETECTED)
+        consumer.start()
+        all_done.wait(timeout)
+        elapsed = time.time() - start
+    finally:
+        task_supervisor.status_listeners.remove(listener)
+        os.chdir(old_dir)
+        server.shutdown()
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    latencies = [finished[doi] - queued[doi] for doi in finished]
+    failures = dict()
+    for success, status_msg in outcomes.itervalues():
+        if not success:
+            failures[status_msg] = failures.get(status_msg, 0) + 1
+    return {'queued': len(queued),
+            'finished': len(finished),
+            'succeeded': len([outcome for outcome in outcomes.itervalues() if outcome[0]]),
+            'seconds': elapsed,
+            'throughput': len(finished) / elapsed if elapsed else None,
+            'latency': dict((name, percentile(latencies, share))
+                            for name, share in [('p50', 0.5), ('p95', 0.95), ('p99', 0.99)]),
+            'failures': failures,
+            'stages': pipeline_metrics.shared().snapshot()['stages'],
+            'mock': server.state.stats(),
+            'work_dir': work_dir if keep else None}
+
+def report(results):
+    print 'finished %(finished)s of %(queued)s dois (%(succeeded)s succeeded) in %(seconds).1f s' % results
+    if results['throughput']:
+        print 'throughput: %.2f articles/s' % results['throughput']
+    latency = results['latency']
+    if latency['p50'] is not None:
+        print 'latency: p50 %.2f s  p95 %.2f s  p99 %.2f s' % (latency['p50'], latency['p95'], latency['p99'])
+    print 'stages:'
+    for stage, stats in sorted(results['stages'].iteritems(), key=lambda item: -item[1]['seconds']):
+        print '  %-50s runs: %5d  failures: %4d  mean: %7.3f s  waiting: %8.1f s' % (
+            stage, stats['runs'], stats['failures'], stats['seconds'] / stats['runs'], stats['wait_seconds'])
+    if results['failures']:
+        print 'failures:'
+        for message, count in sorted(results['failures'].iteritems(), key=lambda item: -item[1])[:10]:
+            print '  %5d  %s' % (count, message)
+    print 'mock services: %s' % results['mock']
+    if results['work_dir']:
+        print 'kept %s' % results['work_dir']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load test the supervisor against mock services')
+    parser.add_argument('xsl', help='jats-to-mediawiki.xsl')
+    parser.add_argument('--dois', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--figures', type=int, default=5)
+    parser.add_argument('--not-in-pmc', type=float, default=0.0, help='share of dois PMC does not know')
+    parser.add_argument('--timeout', type=float, default=3600)
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    parser.add_argument('--cpu-processes', type=int, default=0, help='run the cpu stages in this many processes')
+    parser.add_argument('--engine', choices=['threads', 'events'], default='threads')
+    parser.add_argument('--max-in-flight', type=int, default=200, help='articles at once with --engine events')
+    args = parser.parse_args()
+    results = run(args.xsl, args.dois, args.workers, args.latency, args.jitter, args.error_rate,
+                  args.figures, args.not_in_pmc, args.timeout, args.keep, args.cpu_processes,
+                  args.engine, args.max_in_flight)
+    report(results)
+    if results['finished'] < results['queued']:
+        sys.exit(1)
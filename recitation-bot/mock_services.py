@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+'''
+A local stand-in for the services the bot talks to, for load tests:
+
+    /idconv/        PMC id converter (DOIs containing "notinpmc" are not in PMC)
+    /oa.fcgi        PMC OA service, pointing at /pub/<pmcid>.tar.gz
+    /pub/*.tar.gz   synthetic article packages (HEAD and Range supported)
+    /w/api.php      MediaWiki API: query (titles, search, allimages),
+                    upload and edit
+
+Every request waits `latency` seconds (plus up to `jitter`) and fails with
+a 503 with probability `error_rate`. pywikibot itself is not pointed here,
+that needs a whole family file and login; mock_site and mock_page below
+are what journal_article gets through its site_factory, page_factory and
+image_page_factory parameters instead, and they call /w/api.php.
+
+    python mock_services.py --port 8089 --latency 0.05 --error-rate 0.02
+'''
+
+import io
+import time
+import json
+import zlib
+import random
+import hashlib
+import struct
+import tarfile
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+import requests
+import pywikibot
+import http_client
+import logging
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+NXML_TEMPLATE = u'''<?xml version="1.0" encoding="UTF-8"?>
+<article xmlns:xlink="http://www.w3.org/1999/xlink" article-type="research-article">
+<front>
+<journal-meta><journal-title-group><journal-title>Journal of Load Testing</journal-title></journal-title-group></journal-meta>
+<article-meta>
+<article-id pub-id-type="pmc">%(pmc_number)s</article-id>
+<article-id pub-id-type="doi">%(doi)s</article-id>
+<article-categories><subj-group subj-group-type="heading"><subject>Research Article</subject></subj-group></article-categories>
+<title-group><article-title>Synthetic article %(pmcid)s</article-title></title-group>
+<contrib-group><contrib contrib-type="author"><name><surname>Doe</surname><given-names>Jane</given-names></name></contrib></contrib-group>
+<pub-date pub-type="epub"><day>1</day><month>6</month><year>2014</year></pub-date>
+<permissions><copyright-statement>Copyright Doe.</copyright-statement><license xlink:href="http://creativecommons.org/licenses/by/4.0/"><license-p>CC BY</license-p></license></permissions>
+<abstract><p>An article made up by mock_services.</p></abstract>
+</article-meta>
+</front>
+<body>
+<sec><title>Results</title>
+%(body)s
+</sec>
+</body>
+<back><ref-list><ref><mixed-citation>Nobody (2014) Nothing.</mixed-citation></ref></ref-list></back>
+</article>
+'''
+
+FIGURE_TEMPLATE = u'''<p>%(text)s</p>
+<fig id="f%(number)s"><label>Figure %(number)s</label><caption><title>Figure %(number)s</title><p>Caption of figure %(number)s.</p></caption><graphic xlink:href="%(name)s"/></fig>
+'''
+
+SUPPLEMENT_TEMPLATE = u'''<supplementary-material id="s%(number)s"><label>S%(number)s</label><caption><p>Supplement %(number)s</p></caption><media xlink:href="%(name)s.pdf" mimetype="application" mime-subtype="pdf"/></supplementary-material>
+'''
+
+def pmcid_for(doi):
+    # the same doi always gets the same pmcid
+    return 'PMC%s' % (zlib.crc32(doi.lower().encode('utf-8')) & 0xffffff)
+
+def png(name, width=64, height=64):
+    '''
+    A grey PNG, big enough to look like an image, with name in a text
+    chunk so every image has its own SHA-1
+    '''
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    rows = ''.join('\x00' + '\x80' * width for row in range(height))
+    return '\x89PNG\r\n\x1a\n' + chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) + \
+        chunk('tEXt', 'Title\x00' + name) + chunk('IDAT', zlib.compress(rows)) + chunk('IEND', '')
+
+def make_package(pmcid, doi, figures=5, supplements=1, paragraphs=20):
+    '''
+    The bytes of a .tar.gz shaped like a PMC OA package
+    '''
+    prefix = 'journal.%s' % pmcid.lower()
+    body = list()
+    text = u'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 10
+    for number in range(1, figures + 1):
+        body.append(FIGURE_TEMPLATE % {'text': text, 'number': number, 'name': '%s.g%03d' % (prefix, number)})
+    for number in range(paragraphs):
+        body.append(u'<p>%s</p>\n' % text)
+    for number in range(1, supplements + 1):
+        body.append(SUPPLEMENT_TEMPLATE % {'number': number, 'name': '%s.s%03d' % (prefix, number)})
+    nxml = NXML_TEMPLATE % {'pmc_number': pmcid[3:], 'pmcid': pmcid, 'doi': doi, 'body': u''.join(body)}
+
+    members = [('%s.nxml' % prefix, nxml.encode('utf-8'))]
+    for number in range(1, figures + 1):
+        name = '%s.g%03d.png' % (prefix, number)
+        members.append((name, png(name)))
+    for number in range(1, supplements + 1):
+        members.append(('%s.s%03d.pdf' % (prefix, number), '%PDF-1.4 mock\n'))
+    buffer = io.BytesIO()
+    archive = tarfile.open(fileobj=buffer, mode='w:gz')
+    for name, data in members:
+        info = tarfile.TarInfo('%s/%s' % (pmcid, name))
+        info.size = len(data)
+        info.mtime = 1400000000
+        archive.addfile(info, io.BytesIO(data))
+    archive.close()
+    return buffer.getvalue()
+
+class mock_state():
+
+    '''
+    What the mock wiki and PMC know, and what was asked of them
+    '''
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, figures=5, supplements=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.figures = figures
+        self.supplements = supplements
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.packages = dict() # pmcid -> tar.gz bytes
+        self.pmcid_dois = dict() # pmcid -> doi, learned from idconv
+        self.files = dict() # title -> sha1
+        self.pages = dict() # title -> text
+        self.requests = dict() # route -> count
+        self.errors = 0
+
+    def package(self, pmcid):
+        with self.lock:
+            if pmcid not in self.packages:
+                doi = self.pmcid_dois.get(pmcid, '10.0000/%s' % pmcid.lower())
+                self.packages[pmcid] = make_package(pmcid, doi, self.figures, self.supplements)
+            return self.packages[pmcid]
+
+    def delay_and_fail(self, route):
+        '''
+        Sleeps the injected latency, returns whether to fail this request
+        '''
+        with self.lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+            wait = self.latency + self.random.random() * self.jitter
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        time.sleep(wait)
+        return fail
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'errors': self.errors,
+                    'files': len(self.files), 'pages': len(self.pages)}
+
+class mock_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def route(self):
+        path = urlparse.urlparse(self.path).path
+        if path.startswith('/pub/'):
+            return 'download'
+        return {'/idconv/': 'idconv', '/oa.fcgi': 'oa', '/w/api.php': 'api'}.get(path, 'unknown')
+
+    def params(self):
+        query = urlparse.urlparse(self.path).query
+        if self.command == 'POST':
+            length = int(self.headers.get('content-length', 0))
+            body = self.rfile.read(length)
+            if self.headers.get('content-type', '').startswith('multipart/form-data'):
+                return self.multipart(body)
+            query = body
+        return dict((key, values[-1]) for key, values in urlparse.parse_qs(query).iteritems())
+
+    def multipart(self, body):
+        boundary = self.headers['content-type'].split('boundary=')[1]
+        params = dict()
+        for part in body.split('--' + boundary):
+            head, separator, value = part.partition('\r\n\r\n')
+            if not separator or 'name="' not in head:
+                continue
+            name = head.split('name="')[1].split('"')[0]
+            params[name] = value[:-2] if value.endswith('\r\n') else value
+        return params
+
+    def reply(self, status, body, content_type='text/plain', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).iteritems():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_POST(self):
+        self.do_GET()
+
+    def do_GET(self):
+        state = self.server.state
+        route = self.route()
+        params = self.params()
+        if state.delay_and_fail(route):
+            self.reply(503, 'injected error')
+            return
+        if route == 'idconv':
+            self.idconv(state, params)
+        elif route == 'oa':
+            self.oa(state, params)
+        elif route == 'download':
+            self.download(state)
+        elif route == 'api':
+            self.api(state, params)
+        else:
+            self.reply(404, 'not found')
+
+    def idconv(self, state, params):
+        records = list()
+        for doi in params.get('ids', '').split(','):
+            record = {'requested-id': doi, 'doi': doi}
+            if 'notinpmc' not in doi.lower():
+                record['pmcid'] = pmcid_for(doi)
+                with state.lock:
+                    state.pmcid_dois[record['pmcid']] = doi
+            records.append(record)
+        self.reply(200, json.dumps({'status': 'ok', 'records': records}), 'application/json')
+
+    def oa(self, state, params):
+        pmcid = params.get('id', '')
+        href = 'http://%s:%s/pub/%s.tar.gz' % (self.server.server_name, self.server.server_port, pmcid)
+        body = ('<OA><records returned-count="1"><record id="%s" license="CC BY">'
+                '<link format="tgz" href="%s"/></record></records></OA>' % (pmcid, href))
+        self.reply(200, body, 'text/xml')
+
+    def download(self, state):
+        pmcid = urlparse.urlparse(self.path).path[len('/pub/'):].split('.tar.gz')[0]
+        data = state.package(pmcid)
+        start = 0
+        status = 200
+        headers = {'Accept-Ranges': 'bytes'}
+        if self.headers.get('range', '').startswith('bytes='):
+            start = int(self.headers['range'][len('bytes='):].split('-')[0])
+            if start >= len(data):
+                self.reply(416, '')
+                return
+            status = 206
+            headers['Content-Range'] = 'bytes %s-%s/%s' % (start, len(data) - 1, len(data))
+        self.reply(status, data[start:], 'application/x-gzip', headers)
+
+    def api(self, state, params):
+        action = params.get('action')
+        if action == 'query':
+            result = self.query(state, params)
+        elif action == 'upload':
+            title = 'File:' + params.get('filename', '')
+            with state.lock:
+                duplicate = title in state.files
+                state.files[title] = params.get('sha1')
+            result = {'upload': {'result': 'Warning' if duplicate else 'Success', 'filename': params.get('filename')}}
+        elif action == 'edit':
+            with state.lock:
+                state.pages[params.get('title')] = params.get('text', '')
+            result = {'edit': {'result': 'Success', 'title': params.get('title')}}
+        else:
+            result = {'error': {'code': 'badvalue', 'info': 'unknown action %s' % action}}
+        self.reply(200, json.dumps(result), 'application/json')
+
+    def query(self, state, params):
+        query = dict()
+        with state.lock:
+            if 'titles' in params:
+                pages = dict()
+                for number, title in enumerate(params['titles'].split('|')):
+                    if title in state.files:
+                        pages[str(number + 1)] = {'title': title}
+                    else:
+                        pages[str(-number - 1)] = {'title': title, 'missing': ''}
+                query['pages'] = pages
+            if params.get('list') == 'search':
+                terms = [term.lower() for term in params.get('srsearch', '').split(' OR ')]
+                hits = sorted(title for title in state.files
+                              if any(term in title.lower() for term in terms))
+                offset = int(params.get('sroffset', 0))
+                query['search'] = [{'title': title}
+                                   for title in hits[offset:offset + int(params.get('srlimit', 10))]]
+                query['searchinfo'] = {'totalhits': len(hits)}
+            if params.get('list') == 'allimages':
+                query['allimages'] = [{'title': title} for title, sha1 in state.files.iteritems()
+                                      if sha1 == params.get('aisha1')][:1]
+        return {'query': query}
+
+class mock_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    '''
+    The stand-in server, on localhost:port (port 0 picks a free one)
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, **options):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), mock_handler)
+        self.state = mock_state(**options)
+        self.server_name = '127.0.0.1'
+
+    def base_url(self):
+        return 'http://127.0.0.1:%s' % self.server_port
+
+    def endpoints(self):
+        '''
+        http_client.ENDPOINTS pointing here
+        '''
+        return {'idconv': self.base_url() + '/idconv/',
+                'oa': self.base_url() + '/oa.fcgi',
+                'commons_api': self.base_url() + '/w/api.php'}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='mock-services')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+# the base url of the running mock api, set by use_mock_wiki
+api_url = None
+
+def use_mock_wiki(server):
+    '''
+    Points http_client and the mock wiki classes at server, and returns
+    the journal_article parameters that swap pywikibot for them
+    '''
+    global api_url
+    api_url = server.base_url() + '/w/api.php'
+    http_client.configure(endpoints=server.endpoints())
+    return {'site_factory': mock_site,
+            'page_factory': mock_page,
+            'image_page_factory': mock_page}
+
+def _api_post(params, files=None):
+    try:
+        response = http_client.session().post(api_url, data=params, files=files, timeout=60)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        # what upload_retry_wait retries
+        raise pywikibot.exceptions.ServerError(str(e))
+    return response.json()
+
+class mock_family():
+    def __init__(self, name):
+        self.name = name
+
+class mock_site():
+
+    '''
+    The bits of pywikibot.Site that journal_article and upload_index use
+    '''
+
+    def __init__(self, code, family):
+        self.code = code
+        self.family = mock_family(family)
+
+    def logged_in(self):
+        return True
+
+    def login(self):
+        pass
+
+    def upload(self, imagepage, source_filename, comment, ignore_warnings):
+        data = open(source_filename, 'rb').read()
+        result = _api_post({'action': 'upload', 'format': 'json', 'comment': comment,
+                            'filename': imagepage.title(withNamespace=False),
+                            'text': imagepage._text or '', 'sha1': hashlib.sha1(data).hexdigest()},
+                           files={'file': (imagepage.title(withNamespace=False), data)})
+        if result['upload']['result'] != 'Success' and not ignore_warnings:
+            raise pywikibot.exceptions.UploadWarning('exists', imagepage.title() + ' already exists.')
+
+    def allimages(self, sha1, total=1):
+        result = _api_post({'action': 'query', 'list': 'allimages', 'aisha1': sha1, 'format': 'json'})
+        return [mock_page(self, image['title']) for image in result['query']['allimages'][:total]]
+
+class mock_page():
+
+    '''
+    The bits of pywikibot.Page and ImagePage that journal_article uses
+    '''
+
+    def __init__(self, site, title):
+        self.site = site
+        self._title = title
+        self._text = None
+
+    def title(self, asLink=False, withNamespace=True):
+        title = self._title
+        if not withNamespace and ':' in title:
+            title = title.split(':', 1)[1]
+        return '[[%s]]' % title if asLink else title
+
+    def put(self, newtext, botflag=True, comment=''):
+        _api_post({'action': 'edit', 'title': self._title, 'text': newtext.encode('utf-8'),
+                   'summary': comment, 'format': 'json'})
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='stand-in PMC and MediaWiki services')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 503')
+    parser.add_argument('--figures', type=int, default=5, help='images per synthetic article')
+    args = parser.parse_args()
+    server = mock_server(args.port, latency=args.latency, jitter=args.jitter,
+                         error_rate=args.error_rate, figures=args.figures)
+    print 'serving on %s' % server.base_url()
+    server.serve_forever()
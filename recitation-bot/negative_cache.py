@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+'''
+DOIs we could not convert for a reason that will not go away by itself
+(not in PMC, no tar.gz package, no license), so the pipeline can skip them
+without any network I/O until they are due for a recheck.
+
+    python negative_cache.py list [--reason not_in_pmc]
+    python negative_cache.py clear [doi ...] [--reason no_tgz]
+'''
+
+import time
+import datetime
+import threading
+import logging
+from state_store import state_store
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+# ConversionError reasons worth remembering
+REASONS = ('not_in_pmc', 'invalid_doi', 'no_tgz', 'no_license')
+
+class negative_cache():
+
+    def __init__(self, store=None, recheck_after=30 * 24 * 3600):
+        '''
+        recheck_after is how many seconds a rejection stands
+        '''
+        if store is None:
+            store = state_store('negative_cache')
+        self.store = store
+        self.recheck_after = recheck_after
+
+    def check(self, doi):
+        '''
+        The rejection entry for doi, or None if there is none or it is due
+        for a recheck
+        '''
+        entry = self.store.get(doi)
+        if entry is None or time.time() - entry['checked'] > self.recheck_after:
+            return None
+        return entry
+
+    def add(self, doi, reason, message):
+        entry = self.store.get(doi) or {'first_seen': time.time(), 'times': 0}
+        entry.update({'reason': reason, 'message': message,
+                      'checked': time.time(), 'times': entry['times'] + 1})
+        self.store[doi] = entry
+        self.store.sync()
+
+    def remove(self, doi):
+        try:
+            del self.store[doi]
+        except KeyError:
+            return False
+        self.store.sync()
+        return True
+
+    def entries(self, reason=None):
+        for doi, entry in self.store.iteritems():
+            if reason is None or entry['reason'] == reason:
+                yield doi, entry
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared(recheck_after=30 * 24 * 3600):
+    '''
+    The process-wide negative cache, opened on first use
+    '''
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = negative_cache(recheck_after=recheck_after)
+        return _shared
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='list or clear rejected DOIs')
+    parser.add_argument('command', choices=['list', 'clear'])
+    parser.add_argument('dois', nargs='*', help='DOIs to clear, all of them if none are given')
+    parser.add_argument('--reason', choices=REASONS)
+    args = parser.parse_args()
+    cache = negative_cache()
+
+    def when(timestamp):
+        return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+
+    if args.command == 'list':
+        for doi, entry in sorted(cache.entries(args.reason)):
+            print '%s\t%s\tchecked %s\t%s times\t%s' % (doi, entry['reason'], when(entry['checked']),
+                                                       entry['times'], entry['message'])
+    else:
+        if args.dois:
+            dois = args.dois
+        else:
+            dois = [doi for doi, entry in cache.entries(args.reason)]
+        cleared = len([doi for doi in dois if cache.remove(doi)])
+        print 'cleared %s entries' % cleared
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+'''
+A local SQLite copy of the two lists NCBI publishes for the PMC open
+access subset, so that a DOI's PMCID and its package url are one indexed
+lookup instead of an idconv and an oa.fcgi call:
+
+    PMC-ids.csv.gz     DOI -> PMCID, for all of PMC
+    oa_file_list.csv   PMCID -> package path, license, last update
+
+    python oa_index.py refresh                  # fetch what changed and load it
+    python oa_index.py load --oa-file-list oa_file_list.csv --pmc-ids PMC-ids.csv.gz
+    python oa_index.py lookup 10.1371/journal.pone.0012292
+    python oa_index.py stats
+
+A refresh asks for each list with the ETag and Last-Modified of the last
+one, so an unchanged list costs a 304. A changed oa_file_list only
+rewrites the rows whose Last Updated moved on; rows that left the list are
+removed. Lookups treat the index as stale once a list has not been
+confirmed for max_age seconds, and journal_article falls back to the APIs
+for anything stale or missing.
+'''
+
+import os
+import csv
+import gzip
+import time
+import sqlite3
+import tempfile
+import threading
+import http_client
+import logging
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+DEFAULT_PATH = '/data/project/recitation-bot/recitation-bot/oa_index.db'
+PACKAGE_BASE = 'ftp://ftp.ncbi.nlm.nih.gov/pub/pmc/'
+
+# http_client endpoint -> the loader for that list
+LISTS = {
+    'oa_file_list': 'load_oa_file_list',
+    'pmc_ids': 'load_pmc_ids',
+}
+
+# rows per executemany, and dois per lookup query
+CHUNK_SIZE = 10000
+LOOKUP_BATCH = 500
+
+def _chunks(rows, size=CHUNK_SIZE):
+    chunk = list()
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+def _open_list(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+class oa_index():
+
+    '''
+    Lookups share one connection behind a lock, like state_store; loading
+    a list uses a connection of its own, so lookups carry on meanwhile (the
+    database is in WAL mode).
+    '''
+
+    def __init__(self, path=DEFAULT_PATH, max_age=7 * 24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.conn = self.connect()
+        self.conn.execute('create table if not exists ids (doi_key text primary key, doi text not null, pmcid text not null)')
+        self.conn.execute('create index if not exists ids_pmcid on ids (pmcid)')
+        self.conn.execute('create table if not exists packages (pmcid text primary key, url text not null, '
+                          'license text, updated text)')
+        self.conn.execute('create table if not exists lists (name text primary key, etag text, '
+                          'last_modified text, checked real, rows integer)')
+        self.conn.commit()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.text_factory = str
+        conn.execute('pragma journal_mode=wal')
+        return conn
+
+    def list_info(self, name):
+        with self.lock:
+            row = self.conn.execute('select etag, last_modified, checked, rows from lists where name = ?',
+                                    (name,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('etag', 'last_modified', 'checked', 'rows'), row))
+
+    def fresh(self, name):
+        '''
+        Whether list `name` was confirmed within max_age
+        '''
+        info = self.list_info(name)
+        return info is not None and time.time() - (info['checked'] or 0) <= self.max_age
+
+    def pmcid(self, doi):
+        '''
+        The PMCID for doi, or None if it is not in a fresh PMC-ids list
+        '''
+        if not self.fresh('pmc_ids'):
+            return None
+        with self.lock:
+            row = self.conn.execute('select pmcid from ids where doi_key = ?', (doi.lower(),)).fetchone()
+        return row[0] if row else None
+
+    def package(self, pmcid):
+        '''
+        {'package_url', 'license', 'updated'} for pmcid, or None if it is
+        not in a fresh oa_file_list
+        '''
+        if not self.fresh('oa_file_list'):
+            return None
+        with self.lock:
+            row = self.conn.execute('select url, license, updated from packages where pmcid = ?',
+                                    (pmcid,)).fetchone()
+        if row is None:
+            return None
+        return {'package_url': row[0], 'license': row[1], 'updated': row[2]}
+
+    def lookup(self, dois):
+        '''
+        {doi.lower(): (doi, pmcid, package url or None)} for those of dois
+        the index has, whether it is fresh or not
+        '''
+        found = dict()
+        keys = sorted(set(doi.lower() for doi in dois))
+        for start in range(0, len(keys), LOOKUP_BATCH):
+            batch = keys[start:start + LOOKUP_BATCH]
+            with self.lock:
+                rows = self.conn.execute('select ids.doi_key, ids.doi, ids.pmcid, packages.url from ids '
+                                         'left join packages on packages.pmcid = ids.pmcid '
+                                         'where ids.doi_key in (%s)' % ','.join('?' * len(batch)), batch).fetchall()
+            for doi_key, doi, pmcid, url in rows:
+                found[doi_key] = (doi, pmcid, url)
+        return found
+
+    def open_access(self):
+        '''
+        (doi, pmcid, package url) for every package that has a doi
+        '''
+        conn = self.connect()
+        try:
+            for row in conn.execute('select ids.doi, ids.pmcid, packages.url from packages '
+                                    'join ids on ids.pmcid = packages.pmcid order by ids.pmcid'):
+                yield row
+        finally:
+            conn.close()
+
+    def load_oa_file_list(self, lines):
+        '''
+        Upserts the rows of oa_file_list.csv by Last Updated and removes the
+        packages that are no longer listed. Returns the rows read.
+        '''
+        conn = self.connect()
+        read = 0
+        try:
+            conn.execute('create temp table listed (pmcid text primary key)')
+            changed = 0
+            for chunk in _chunks(self._oa_rows(csv.DictReader(lines))):
+                read += len(chunk)
+                before = conn.total_changes
+                conn.executemany('insert or ignore into packages (pmcid, url, license, updated) values (?, ?, ?, ?)',
+                                 chunk)
+                conn.executemany('update packages set url = ?, license = ?, updated = ? '
+                                 'where pmcid = ? and (updated is null or updated < ?)',
+                                 [(url, license, updated, pmcid, updated) for pmcid, url, license, updated in chunk])
+                changed += conn.total_changes - before
+                conn.executemany('insert or ignore into listed (pmcid) values (?)',
+                                 [(row[0],) for row in chunk])
+                conn.commit()
+            if read: # an empty download would wipe the index
+                removed = conn.execute('delete from packages where pmcid not in (select pmcid from listed)').rowcount
+                conn.commit()
+            else:
+                removed = 0
+            logging.info('oa_file_list: %s rows read, %s changes, %s packages removed'
+                         % (read, changed, removed))
+        finally:
+            conn.close()
+        return read
+
+    def _oa_rows(self, reader):
+        for row in reader:
+            pmcid = (row.get('Accession ID') or '').strip()
+            package = (row.get('File') or '').strip()
+            if not pmcid or not package:
+                continue
+            yield (pmcid, package if '://' in package else PACKAGE_BASE + package,
+                   (row.get('License') or '').strip(),
+                   (row.get('Last Updated (YYYY-MM-DD HH:MM:SS)') or '').strip())
+
+    def load_pmc_ids(self, lines):
+        '''
+        Upserts the doi -> pmcid rows of PMC-ids.csv, writing only the rows
+        that are new or whose pmcid changed, and removes the dois that are
+        no longer listed. Returns the rows read.
+
+        PMC-ids.csv has no date per row, so unlike the file list every row
+        is still read and compared with the index on each refresh.
+        '''
+        conn = self.connect()
+        read = 0
+        try:
+            conn.execute('create temp table listed (doi_key text primary key)')
+            changed = 0
+            for chunk in _chunks(self._id_rows(csv.DictReader(lines))):
+                read += len(chunk)
+                before = conn.total_changes
+                conn.executemany('insert or ignore into ids (doi_key, doi, pmcid) values (?, ?, ?)', chunk)
+                conn.executemany('update ids set doi = ?, pmcid = ? where doi_key = ? and pmcid != ?',
+                                 [(doi, pmcid, doi_key, pmcid) for doi_key, doi, pmcid in chunk])
+                changed += conn.total_changes - before
+                conn.executemany('insert or ignore into listed (doi_key) values (?)',
+                                 [(row[0],) for row in chunk])
+                conn.commit()
+            if read: # an empty download would wipe the index
+                removed = conn.execute('delete from ids where doi_key not in (select doi_key from listed)').rowcount
+                conn.commit()
+            else:
+                removed = 0
+            logging.info('PMC-ids: %s rows read, %s changes, %s removed' % (read, changed, removed))
+        finally:
+            conn.close()
+        return read
+
+    def _id_rows(self, reader):
+        for row in reader:
+            doi = (row.get('DOI') or '').strip()
+            pmcid = (row.get('PMCID') or '').strip()
+            if doi and pmcid:
+                yield (doi.lower(), doi, pmcid)
+
+    def load_file(self, name, path):
+        '''
+        Loads list `name` from a local copy, which counts as confirming it
+        '''
+        lines = _open_list(path)
+        try:
+            rows = getattr(self, LISTS[name])(lines)
+        finally:
+            lines.close()
+        self.confirm(name, None, None, rows)
+        return rows
+
+    def confirm(self, name, etag, last_modified, rows):
+        with self.lock:
+            if rows is None: # not modified, keep the row count
+                self.conn.execute('update lists set checked = ? where name = ?', (time.time(), name))
+            else:
+                self.conn.execute('insert or replace into lists (name, etag, last_modified, checked, rows) '
+                                  'values (?, ?, ?, ?, ?)', (name, etag, last_modified, time.time(), rows))
+            self.conn.commit()
+
+    def refresh(self, name, force=False):
+        '''
+        Fetches list `name` if it changed since the last refresh, and loads
+        it. Returns the rows loaded, None when it had not changed.
+        '''
+        url = http_client.ENDPOINTS[name]
+        info = self.list_info(name)
+        headers = dict()
+        if info and not force:
+            if info['etag']:
+                headers['If-None-Match'] = info['etag']
+            if info['last_modified']:
+                headers['If-Modified-Since'] = info['last_modified']
+        response = http_client.get(name, stream=True, headers=headers, timeout=(10, 300))
+        # a streamed response holds its pooled connection until closed
+        try:
+            if response.status_code == 304:
+                self.confirm(name, None, None, None)
+                logging.info('%s has not changed' % url)
+                return None
+            response.raise_for_status()
+            # the whole list is on disk before any of it goes in
+            suffix = '.gz' if url.endswith('.gz') else '.csv'
+            download = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(self.path)),
+                                                   suffix=suffix, delete=False)
+            try:
+                for chunk in response.iter_content(64 * 1024):
+                    download.write(chunk)
+                download.close()
+                lines = _open_list(download.name)
+                try:
+                    rows = getattr(self, LISTS[name])(lines)
+                finally:
+                    lines.close()
+            finally:
+                download.close()
+                os.remove(download.name)
+        finally:
+            response.close()
+        self.confirm(name, response.headers.get('etag'), response.headers.get('last-modified'), rows)
+        logging.info('loaded %s rows of %s' % (rows, url))
+        return rows
+
+    def refresh_all(self, force=False):
+        return dict((name, self.refresh(name, force)) for name in sorted(LISTS))
+
+    def stats(self):
+        with self.lock:
+            stats = {'dois': self.conn.execute('select count(*) from ids').fetchone()[0],
+                     'packages': self.conn.execute('select count(*) from packages').fetchone()[0]}
+        for name in LISTS:
+            stats[name] = self.list_info(name)
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+_shared = dict() # path -> oa_index
+_shared_lock = threading.Lock()
+
+def shared(path=DEFAULT_PATH, max_age=7 * 24 * 3600):
+    '''
+    The process-wide index at path, or None if there is none (it is only
+    made by the refresh and load commands)
+    '''
+    if not path:
+        return None
+    with _shared_lock:
+        if path not in _shared:
+            if not os.path.exists(path):
+                return None
+            _shared[path] = oa_index(path, max_age)
+        return _shared[path]
+
+def keep_fresh(path=DEFAULT_PATH, interval=24 * 3600):
+    '''
+    Starts a thread that refreshes the index at path every interval seconds
+    '''
+    def refresh():
+        while 1: # True
+            index = shared(path)
+            if index is not None:
+                for name in sorted(LISTS):
+                    try:
+                        index.refresh(name)
+                    except Exception as e: # the old rows are still good for a while
+                        logging.info('could not refresh %s: %s' % (name, e))
+            time.sleep(interval)
+    refresher = threading.Thread(target=refresh, name='oa-index-refresh')
+    refresher.daemon = True
+    refresher.start()
+    return refresher
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='the local index of the PMC open access lists')
+    parser.add_argument('command', choices=['refresh', 'load', 'lookup', 'stats'])
+    parser.add_argument('ids', nargs='*', help='dois or pmcids to look up')
+    parser.add_argument('--index', default=DEFAULT_PATH)
+    parser.add_argument('--force', action='store_true', help='refresh even if the lists have not changed')
+    parser.add_argument('--oa-file-list', help='a local oa_file_list.csv to load')
+    parser.add_argument('--pmc-ids', help='a local PMC-ids.csv(.gz) to load')
+    args = parser.parse_args()
+
+    index = oa_index(args.index)
+    if args.command == 'refresh':
+        for name, rows in sorted(index.refresh_all(args.force).iteritems()):
+            print '%s: %s' % (name, 'not modified' if rows is None else '%s rows' % rows)
+    elif args.command == 'load':
+        if not (args.oa_file_list or args.pmc_ids):
+            parser.error('give --oa-file-list and/or --pmc-ids')
+        for name, path in [('oa_file_list', args.oa_file_list), ('pmc_ids', args.pmc_ids)]:
+            if path:
+                print '%s: %s rows' % (name, index.load_file(name, path))
+    elif args.command == 'lookup':
+        for identifier in args.ids:
+            if identifier.upper().startswith('PMC'):
+                print identifier, index.package(identifier.upper())
+            else:
+                pmcid = index.pmcid(identifier)
+                print identifier, pmcid, pmcid and index.package(pmcid)
+    else:
+        for key, value in sorted(index.stats().iteritems()):
+            print '%s: %s' % (key, value)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''
+Counters and stage timings for the article pipeline, exported in the
+Prometheus text format to a file (for the node exporter's textfile
+collector, or just to look at) and optionally over HTTP at /metrics.
+
+    python pipeline_metrics.py --port 9310   # serve this process' metrics
+'''
+
+import os
+import time
+import threading
+import BaseHTTPServer
+import http_client
+import logging
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+PREFIX = 'recitation_'
+
+# what count() is called with, with their help text
+COUNTERS = {
+    'bytes_downloaded': 'Bytes of article archives downloaded',
+    'images_uploaded': 'Images uploaded to a wiki',
+    'images_reused': 'Images already on the wiki, found by hash or as a duplicate',
+    'upload_retries': 'Image uploads tried again after a transient error',
+    'articles_succeeded': 'Articles pushed to Wikisource',
+    'articles_failed': 'Articles that failed to convert',
+}
+
+class pipeline_metrics():
+
+    '''
+    Thread safe counters. Stages are timed by worker_pool.run_stage, the
+    other counters are bumped where the thing happens.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = dict() # stage -> {runs, failures, seconds, max_seconds, wait_seconds}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.failures = dict() # ConversionError message -> count
+
+    def observe_stage(self, stage, seconds, wait_seconds=0.0, failed=False):
+        with self.lock:
+            stats = self.stages.setdefault(stage, {'runs': 0, 'failures': 0, 'seconds': 0.0,
+                                                   'max_seconds': 0.0, 'wait_seconds': 0.0})
+            stats['runs'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['wait_seconds'] += wait_seconds
+            if failed:
+                stats['failures'] += 1
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def failure(self, message):
+        # the part before the first colon, details like urls and dois
+        # would make every failure its own series
+        message = message.split(':')[0].strip()[:100]
+        with self.lock:
+            self.failures[message] = self.failures.get(message, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {'uptime_seconds': time.time() - self.started,
+                    'stages': dict((stage, dict(stats)) for stage, stats in self.stages.iteritems()),
+                    'counters': dict(self.counters),
+                    'failures': dict(self.failures)}
+
+    def prometheus_text(self, article_queue=None):
+        '''
+        Everything in the Prometheus text exposition format: the stages,
+        counters and failures, the queue's stats if there is a queue, and
+        the http_client metrics per endpoint
+        '''
+        snapshot = self.snapshot()
+        lines = list()
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP %s%s %s' % (PREFIX, name, help_text))
+            lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+            for labels, value in samples:
+                lines.append('%s%s%s %s' % (PREFIX, name, _labels(labels), _number(value)))
+
+        metric('uptime_seconds', 'gauge', 'Seconds since the pipeline started',
+               [({}, snapshot['uptime_seconds'])])
+        stages = sorted(snapshot['stages'].iteritems())
+        for field, kind, help_text in [('runs', 'counter', 'Times a stage ran'),
+                                       ('failures', 'counter', 'Times a stage raised'),
+                                       ('seconds', 'counter', 'Seconds spent inside a stage'),
+                                       ('wait_seconds', 'counter', 'Seconds spent waiting for a stage slot'),
+                                       ('max_seconds', 'gauge', 'Longest single run of a stage')]:
+            name = 'stage_%s' % field + ('_total' if kind == 'counter' else '')
+            metric(name, kind, help_text, [({'stage': stage}, stats[field]) for stage, stats in stages])
+        for counter, value in sorted(snapshot['counters'].iteritems()):
+            metric(counter + '_total', 'counter', COUNTERS[counter], [({}, value)])
+        metric('conversion_failures_total', 'counter', 'Failed articles by error message',
+               [({'message': message}, value) for message, value in sorted(snapshot['failures'].iteritems())])
+        if article_queue is not None:
+            for field, value in sorted(article_queue.stats().iteritems()):
+                metric('queue_' + field, 'gauge', 'Article queue %s' % field.replace('_', ' '), [({}, value)])
+        endpoints = sorted(http_client.metrics().iteritems())
+        for field, kind in [('requests', 'counter'), ('errors', 'counter'), ('retries', 'counter'),
+                            ('seconds', 'counter'), ('max_seconds', 'gauge')]:
+            name = 'http_%s' % field + ('_total' if kind == 'counter' else '')
+            metric(name, kind, 'HTTP %s per endpoint' % field.replace('_', ' '),
+                   [({'endpoint': endpoint}, stats[field]) for endpoint, stats in endpoints])
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path, article_queue=None):
+        # renamed into place so a scrape never reads half a file
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        textfile = open(tmp_path, 'w')
+        textfile.write(self.prometheus_text(article_queue).encode('utf-8'))
+        textfile.close()
+        os.rename(tmp_path, path)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value)) for key, value in sorted(labels.iteritems()))
+
+def _escape(value):
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared():
+    '''
+    The process-wide metrics
+    '''
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = pipeline_metrics()
+        return _shared
+
+def export_textfile(path, interval=30, article_queue=None):
+    '''
+    Starts a thread that rewrites the metrics file every interval seconds
+    '''
+    def export():
+        while 1: # True
+            try:
+                shared().write_textfile(path, article_queue)
+            except (IOError, OSError) as e:
+                logging.info('could not write metrics to %s: %s' % (path, e))
+            time.sleep(interval)
+    exporter = threading.Thread(target=export, name='metrics-textfile')
+    exporter.daemon = True
+    exporter.start()
+    return exporter
+
+def serve(port, article_queue=None):
+    '''
+    Starts a thread answering GET /metrics on port
+    '''
+    class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = shared().prometheus_text(article_queue).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # scrapes do not belong in the bot log
+
+    server = BaseHTTPServer.HTTPServer(('', port), handler)
+    server_thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    server_thread.daemon = True
+    server_thread.start()
+    return server
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='serve (empty) pipeline metrics, to check a scrape setup')
+    parser.add_argument('--port', type=int, default=9310)
+    args = parser.parse_args()
+    serve(args.port)
+    print 'serving http://localhost:%s/metrics' % args.port
+    while 1: # True
+        time.sleep(3600)
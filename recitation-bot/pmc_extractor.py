@@ -5,19 +5,147 @@
 from datetime import date
 from os import listdir, path
 from sys import stderr
-from xml.etree.ElementTree import ElementTree
+from xml.etree.ElementTree import ElementTree, iterparse
 from collections import defaultdict
 import json
 import sys
 
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+
+# elements that have to be seen whole; anything outside of these (and outside
+# of <front>) is cleared as soon as its end tag has been parsed
+_COLLECTED_TAGS = ('fig', 'supplementary-material', 'inline-formula',
+                   'disp-formula', 'alternatives')
+
 def extract_metadata(target_nxml):
     """
-    Get as much metadata as we can from an nxml
+    Get as much metadata as we can from an nxml, in one streaming pass.
+
+    <front> is small, so it is kept whole until its end tag and then read by
+    the same helpers extract_metadata_tree() uses. Figures, media and
+    formulae are picked up as their end tags go by, and every finished
+    subtree is dropped so memory stays flat on articles with hundreds of
+    figures.
+    """
+    metadata = dict()
+    image_captions = defaultdict(dict)
+    supplement_captions = defaultdict(dict)
+    inline_formulae = defaultdict(dict)
+    display_formulae = defaultdict(dict)
+    tables = defaultdict(dict)
+    sup_materials = []
+    fig_materials = []
+    pending_materials = [] # materials inside <front>, waiting for the pmcid
+
+    def collect(element):
+        tag = element.tag
+        if tag == 'fig':
+            _add_image_caption(image_captions, element)
+            materials = fig_materials
+        elif tag == 'supplementary-material':
+            _add_supplementary_caption(supplement_captions, element)
+            materials = sup_materials
+        elif tag == 'inline-formula':
+            _add_filename(inline_formulae, element, 'inline-graphic')
+            return
+        elif tag == 'disp-formula':
+            _add_filename(display_formulae, element, 'graphic')
+            return
+        else: # alternatives
+            _add_filename(tables, element, 'graphic')
+            return
+        if 'pmcid' in metadata:
+            material = _get_supplementary_material(metadata['pmcid'], element)
+            if material is not None:
+                materials.append(material)
+        else:
+            pending_materials.append((materials, element))
+
+    root = None
+    stack = [] # open elements
+    held = 0 # how many of the open elements must not be cleared yet
+    for event, element in iterparse(target_nxml, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            # only the article's own <front>, a <sub-article> can have one too
+            if (element.tag == 'front' and len(stack) == 1) or element.tag in _COLLECTED_TAGS:
+                held += 1
+            stack.append(element)
+            continue
+
+        stack.pop()
+        if element.tag == 'front' and len(stack) == 1:
+            held -= 1
+            # nothing but <front> has been parsed yet, so root is a small tree
+            _add_front_metadata(metadata, ElementTree(root))
+            for materials, pending in pending_materials:
+                material = _get_supplementary_material(metadata['pmcid'], pending)
+                if material is not None:
+                    materials.append(material)
+            pending_materials = []
+        elif element.tag in _COLLECTED_TAGS:
+            held -= 1
+            collect(element)
+
+        if held == 0 and stack:
+            element.clear()
+            stack[-1].remove(element)
+
+    if 'pmcid' not in metadata: # no <front>, fail the way the tree walk does
+        _add_front_metadata(metadata, ElementTree(root))
+
+    metadata['image_captions'] = image_captions
+    metadata['supplement_captions'] = supplement_captions
+    metadata['images'] = dict(image_captions.items() + supplement_captions.items())
+    metadata['supplementary-materials'] = sup_materials + fig_materials
+    metadata['inline_formulae'] = inline_formulae
+    metadata['display_formulae'] = display_formulae
+    metadata['equations'] = dict(inline_formulae.items() + display_formulae.items())
+    metadata['tables'] = tables
+
+    return metadata
+
+
+def extract_metadata_tree(target_nxml):
+    """
+    Get as much metadata as we can from an nxml, walking a full ElementTree.
+
+    This is the reference the streaming extract_metadata() is checked
+    against, see compare_extractors().
     """
     tree = ElementTree()
     tree.parse(target_nxml)
 
     metadata = dict()
+    _add_front_metadata(metadata, tree)
+    metadata['image_captions'] = _get_image_captions(tree)
+    metadata['supplement_captions'] = _get_supplementary_captions(tree)
+    metadata['images'] = dict(metadata['image_captions'].items() + metadata['supplement_captions'].items() )
+    metadata['supplementary-materials'] = _get_supplementary_materials(tree)
+    metadata['inline_formulae'] = _get_filenames_2tags(tree, 'inline-formula', 'inline-graphic')
+    metadata['display_formulae'] = _get_filenames_2tags(tree, 'disp-formula', 'graphic')
+    metadata['equations'] = dict(metadata['inline_formulae'].items() + metadata['display_formulae'].items() )
+    metadata['tables'] = _get_filenames_2tags(tree, 'alternatives', 'graphic')
+
+    return metadata
+
+
+def compare_extractors(target_nxml):
+    """
+    Run both extractors on an nxml and return the metadata keys
+    on which they disagree.
+    """
+    streamed = extract_metadata(target_nxml)
+    walked = extract_metadata_tree(target_nxml)
+    keys = set(streamed.keys()) | set(walked.keys())
+    return sorted(key for key in keys if streamed.get(key) != walked.get(key))
+
+
+def _add_front_metadata(metadata, tree):
+    """
+    Fills in everything that comes from <front>.
+    """
     metadata['doi'] = _get_article_doi(tree)
     metadata['pmcid'] = _get_pmcid(tree)
     metadata['pmid'] = _get_pmid(tree)
@@ -30,16 +158,6 @@ def extract_metadata(target_nxml):
     metadata['article-license-url'], metadata['article-license-text'], metadata['article-copyright-statement'] = _get_article_licensing(tree)
     metadata['article-copyright-holder'] = _get_article_copyright_holder(tree)
     metadata['article-categories'] = _get_article_categories(tree)
-    metadata['image_captions'] = _get_image_captions(tree)
-    metadata['supplement_captions'] = _get_supplementary_captions(tree)
-    metadata['images'] = dict(metadata['image_captions'].items() + metadata['supplement_captions'].items() )
-    metadata['supplementary-materials'] = _get_supplementary_materials(tree)
-    metadata['inline_formulae'] = _get_filenames_2tags(tree, 'inline-formula', 'inline-graphic')
-    metadata['display_formulae'] = _get_filenames_2tags(tree, 'disp-formula', 'graphic')
-    metadata['equations'] = dict(metadata['inline_formulae'].items() + metadata['display_formulae'].items() )
-    metadata['tables'] = _get_filenames_2tags(tree, 'alternatives', 'graphic')
-
-    return metadata
 
 
 def _strip_whitespace(text):
@@ -59,12 +177,18 @@ def _get_filenames_2tags(tree, tag1, tag2):
     """
     return_captions = defaultdict(dict)
     for t1 in tree.iter(tag1):
-        t2 = t1.find(tag2)
-        file_name = t2.attrib['{http://www.w3.org/1999/xlink}href']
-        return_captions[file_name]['caption'] = file_name #we could use a list but leaving for generality in the future since the other images return a dict
+        _add_filename(return_captions, t1, tag2)
     return return_captions
 
 
+def _add_filename(return_captions, t1, tag2):
+    t2 = t1.find(tag2)
+    if t2 is None: # e.g. a formula that is only MathML
+        return
+    file_name = t2.attrib[XLINK_HREF]
+    return_captions[file_name]['caption'] = file_name #we could use a list but leaving for generality in the future since the other images return a dict
+
+
 def _get_image_captions(tree):
     """
     Given an ElementTree returns iamges as a
@@ -72,30 +196,14 @@ def _get_image_captions(tree):
     """
     fig_captions = defaultdict(dict)
     for fig in tree.iter('fig'):
-        graphic = fig.find('graphic')
-        if graphic is not None: #adding an extra check here because sometimes graphic is None
-            file_name = graphic.attrib['{http://www.w3.org/1999/xlink}href']
-            label_text = ''
-            label = fig.find('label')
-            if label is not None:
-                label_text = label.text
-                fig_captions[file_name]['label'] = label_text
-            caption = fig.find('caption/p')
-            caption_text = ''
-            if caption is not None:
-                caption_text = _strip_whitespace(''.join(caption.itertext()))
-            fig_captions[file_name]['caption'] = caption_text
+        _add_image_caption(fig_captions, fig)
     return fig_captions
 
-def _get_supplementary_captions(tree):
-    """
-    Given an ElementTree returns media as a
-    dictionary containing, file_name label and caption.
-    """
-    fig_captions = defaultdict(dict)
-    for fig in tree.iter('supplementary-material'):
-        graphic = fig.find('media')
-        file_name = graphic.attrib['{http://www.w3.org/1999/xlink}href']
+
+def _add_image_caption(fig_captions, fig):
+    graphic = fig.find('graphic')
+    if graphic is not None: #adding an extra check here because sometimes graphic is None
+        file_name = graphic.attrib[XLINK_HREF]
         label_text = ''
         label = fig.find('label')
         if label is not None:
@@ -106,8 +214,33 @@ def _get_supplementary_captions(tree):
         if caption is not None:
             caption_text = _strip_whitespace(''.join(caption.itertext()))
         fig_captions[file_name]['caption'] = caption_text
+
+
+def _get_supplementary_captions(tree):
+    """
+    Given an ElementTree returns media as a
+    dictionary containing, file_name label and caption.
+    """
+    fig_captions = defaultdict(dict)
+    for fig in tree.iter('supplementary-material'):
+        _add_supplementary_caption(fig_captions, fig)
     return fig_captions
 
+
+def _add_supplementary_caption(fig_captions, fig):
+    graphic = fig.find('media')
+    file_name = graphic.attrib[XLINK_HREF]
+    label_text = ''
+    label = fig.find('label')
+    if label is not None:
+        label_text = label.text
+        fig_captions[file_name]['label'] = label_text
+    caption = fig.find('caption/p')
+    caption_text = ''
+    if caption is not None:
+        caption_text = _strip_whitespace(''.join(caption.itertext()))
+    fig_captions[file_name]['caption'] = caption_text
+
 def _get_article_categories(tree):
     """
     Given an ElementTree, return (some) article categories.
@@ -355,19 +488,21 @@ def _get_supplementary_materials(tree):
     Given an ElementTree, returns a list of article supplementary materials.
     """
     materials = []
+    pmcid = _get_pmcid(tree)
     for sup in tree.iter('supplementary-material'):
-        material = _get_supplementary_material(tree, sup)
+        material = _get_supplementary_material(pmcid, sup)
         if material is not None:
             materials.append(material)
     for fig in tree.iter('fig'):
-        material = _get_supplementary_material(tree, fig)
+        material = _get_supplementary_material(pmcid, fig)
         if material is not None:
             materials.append(material)
     return materials
 
-def _get_supplementary_material(tree, sup):
+def _get_supplementary_material(pmcid, sup):
     """
-    Given an ElementTree returns supplementary materials as a
+    Given the article's PubMed Central ID and a <supplementary-material> or
+    <fig> element returns supplementary materials as a
     dictionary containing url, mimetype and label and caption.
     """
     result = {}
@@ -410,7 +545,7 @@ def _get_supplementary_material(tree, sup):
             result['mime-subtype'] = ''
             result['href'] = ''
         result['url'] = _get_supplementary_material_url(
-            _get_pmcid(tree),
+            pmcid,
             result['href']
         )
         return result
@@ -458,6 +593,16 @@ if __name__ == '__main__':
     #test that we can pull from the Open License Dict well
     print('Open license loaded:', len(license_url_equivalents))
     print('Copyright licenses loaded:', len(copyright_statement_url_equivalents))
+    if sys.argv[1] == '--compare':
+        # check the streaming extractor against the tree walk on a corpus
+        mismatched = 0
+        for target_nxml in sys.argv[2:]:
+            differing = compare_extractors(target_nxml)
+            if differing:
+                mismatched += 1
+                print target_nxml, 'differs on:', ', '.join(differing)
+        print '%s of %s nxml files differ' % (mismatched, len(sys.argv[2:]))
+        sys.exit(1 if mismatched else 0)
     target_nxml = sys.argv[1]
     metadata = extract_metadata(target_nxml)
     for k,v in metadata.iteritems():
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import requests
+import http_client
+import logging
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+# what a lookup can come back with, besides a pmcid
+NOT_IN_PMC = 'not_in_pmc'
+INVALID_DOI = 'invalid_doi'
+API_DOWN = 'api_down'
+
+class ResolveError(Exception):
+    def __init__(self, reason, doi):
+        Exception.__init__(self, reason)
+        self.reason = reason
+        self.doi = doi
+
+class pmcid_resolver():
+
+    '''
+    Resolves DOIs to PMCIDs with the idconv API, many DOIs per request.
+
+    resolve() blocks its caller while a background thread waits `window`
+    seconds for more DOIs to come in, then asks for up to batch_size of
+    them at once. prefetch() adds DOIs to the next batch without waiting,
+    so the supervisor can hand over what is queued. Answers, including
+    "not in PMC", are cached for ttl seconds; API failures are not cached.
+    '''
+
+    def __init__(self, window=0.5, batch_size=200, ttl=24 * 3600, timeout=300):
+        '''
+        resolve() gives up with API_DOWN after timeout seconds
+        '''
+        self.window = window
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self.condition = threading.Condition()
+        self.pending = dict() # doi.lower() -> doi, waiting for the next batch
+        self.results = dict() # doi.lower() -> (time looked up, pmcid, reason)
+        self.thread = None
+
+    def _fresh(self, key):
+        result = self.results.get(key)
+        if result is None or result[2] == API_DOWN:
+            return None
+        if time.time() - result[0] > self.ttl:
+            return None
+        return result
+
+    def _start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='pmcid-resolver')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def prefetch(self, dois):
+        '''
+        Puts dois we have no fresh answer for into the next batch
+        '''
+        with self.condition:
+            for doi in dois:
+                key = doi.lower()
+                if key not in self.pending and self._fresh(key) is None:
+                    self.pending[key] = doi
+            if self.pending:
+                self._start()
+                self.condition.notify_all()
+
+    def resolve(self, doi):
+        '''
+        Returns the PMCID for doi, or raises ResolveError with a reason
+        '''
+        key = doi.lower()
+        asked = time.time()
+        with self.condition:
+            result = self._fresh(key)
+            if result is None:
+                self.pending[key] = doi
+                self._start()
+                self.condition.notify_all()
+                while 1: # True
+                    result = self.results.get(key)
+                    if result is not None and (result[0] >= asked or self._fresh(key)):
+                        break
+                    left = asked + self.timeout - time.time()
+                    if left <= 0:
+                        logging.info('no idconv answer for %s after %s s' % (doi, self.timeout))
+                        raise ResolveError(API_DOWN, doi)
+                    self.condition.wait(left)
+        looked_up, pmcid, reason = result
+        if reason is not None:
+            raise ResolveError(reason, doi)
+        return pmcid
+
+    def _run(self):
+        while 1: # True
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+            time.sleep(self.window) # let more DOIs join the batch
+            with self.condition:
+                keys = self.pending.keys()[:self.batch_size]
+                batch = [self.pending.pop(key) for key in keys]
+            try:
+                answers = self._lookup(batch)
+            except Exception as e: # the thread must live on, or resolve() waits for nothing
+                logging.exception(e)
+                answers = dict()
+            now = time.time()
+            with self.condition:
+                for doi in batch:
+                    pmcid, reason = answers.get(doi.lower(), (None, API_DOWN))
+                    self.results[doi.lower()] = (now, pmcid, reason)
+                self.condition.notify_all()
+            logging.info('resolved %s dois in one idconv request' % len(batch))
+
+    def _lookup(self, dois):
+        '''
+        {doi.lower(): (pmcid, reason)} for a batch of dois
+        '''
+        try:
+            response = http_client.get('idconv', params={'ids': ','.join(dois), 'format': 'json'},
+                                       parse_json=True)
+        except (ValueError, requests.RequestException) as e:
+            logging.info('idconv request for %s dois failed: %s' % (len(dois), e))
+            return dict((doi.lower(), (None, API_DOWN)) for doi in dois)
+
+        if 'records' not in response:
+            # an error or rate limit body for the whole request says nothing
+            # about the dois in it, only a record can call a doi invalid
+            logging.info('idconv answered %s dois without records: %s' % (len(dois), str(response)[:200]))
+            return dict((doi.lower(), (None, API_DOWN)) for doi in dois)
+
+        answers = dict((doi.lower(), (None, NOT_IN_PMC)) for doi in dois)
+        for record in response['records']:
+            doi = record.get('requested-id') or record.get('doi')
+            if not doi or doi.lower() not in answers:
+                continue
+            if record.get('pmcid'):
+                answers[doi.lower()] = (record['pmcid'], None)
+            elif record.get('status') == 'error' and 'invalid' in record.get('errmsg', '').lower():
+                answers[doi.lower()] = (None, INVALID_DOI)
+        return answers
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared():
+    '''
+    The process-wide resolver, started on first use
+    '''
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = pmcid_resolver()
+        return _shared
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+'''
+A local SQLite stand-in for the Wikipedia replica database, with just the
+bits of the `page` and `externallinks` tables doi_finder reads. Use it to
+run the detector without access to the labsdb replicas:
+
+    conn = replica_standin.connect(links=[('Some_article', 'http://dx.doi.org/10.1/x')])
+    finder = doi_finder(lang='enwiki', conn=conn, placeholder='?')
+'''
+
+import sqlite3
+import urlparse
+
+SCHEMA = '''
+create table if not exists page (
+    page_id integer primary key,
+    page_namespace integer not null default 0,
+    page_title text not null unique
+);
+create table if not exists externallinks (
+    el_id integer primary key autoincrement,
+    el_from integer not null,
+    el_to text not null,
+    el_index text not null
+);
+create index if not exists el_index on externallinks (el_index);
+'''
+
+SAMPLE_LINKS = [
+    ('Gene', 'http://dx.doi.org/10.1186/1471-2156-10-59'),
+    ('Retrovirus', 'http://dx.doi.org/10.1186/1742-4690-2-11'),
+    ('Zoology', 'https://doi.org/10.3897/zookeys.324.5827'),
+    ('Zoology', 'https://dx.doi.org/10.3897/zookeys.364.6109'),
+    ('Gene', 'http://doi.org/10.1371/journal.pone.0012292'),
+    ('Gene', 'http://example.org/not/a/doi'),
+]
+
+
+def el_index(url):
+    '''
+    MediaWiki's externallinks.el_index form of a URL: the host reversed,
+    e.g. http://dx.doi.org/10.1/x -> http://org.doi.dx./10.1/x
+    '''
+    parts = urlparse.urlsplit(url)
+    host = '.'.join(reversed(parts.hostname.split('.'))) + '.'
+    index = '%s://%s%s' % (parts.scheme, host, parts.path)
+    if parts.query:
+        index += '?' + parts.query
+    return index
+
+
+def connect(path=':memory:', links=None):
+    '''
+    Opens (and creates if needed) a stand-in replica, optionally
+    adding (page_title, url) links to it
+    '''
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.text_factory = str # byte strings, like MySQLdb hands back
+    conn.executescript(SCHEMA)
+    if links:
+        add_links(conn, links)
+    return conn
+
+
+def add_links(conn, links):
+    '''
+    Adds (page_title, url) external links, creating pages as needed
+    '''
+    for title, url in links:
+        conn.execute('insert or ignore into page (page_title) values (?)', (title,))
+        page_id = conn.execute('select page_id from page where page_title = ?', (title,)).fetchone()[0]
+        conn.execute('insert into externallinks (el_from, el_to, el_index) values (?, ?, ?)',
+                     (page_id, url, el_index(url)))
+    conn.commit()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import os
+import glob
+import shelve
+import sqlite3
+import threading
+import cPickle as pickle
+import logging
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+class state_store():
+
+    '''
+    A dict-like store of pickled values keyed by string, kept in its own
+    SQLite file. It replaces the shelve files: membership tests and lookups
+    are single indexed queries instead of scans of shelf.keys().
+
+    Writes are committed in batches of batch_size, or on sync(). The
+    database runs in WAL mode, so other processes (status pages, CLIs) can
+    read it while the bot writes. One connection is shared by the threads
+    of this process behind a lock.
+    '''
+
+    def __init__(self, name, directory='.', batch_size=50, migrate_from=None):
+        '''
+        name is the table and file name, migrate_from an old shelve file
+        that is copied in once, the first time the store is opened
+        '''
+        self.name = name
+        self.path = os.path.join(directory, name + '.db')
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.pending = 0
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute('create table if not exists store (key text primary key, value blob not null)')
+        self.conn.execute('create table if not exists migrations (source text primary key)')
+        self.conn.commit()
+        if migrate_from:
+            self.migrate_from_shelf(migrate_from)
+
+    def __contains__(self, key):
+        with self.lock:
+            row = self.conn.execute('select 1 from store where key = ?', (key,)).fetchone()
+        return row is not None
+
+    def __getitem__(self, key):
+        with self.lock:
+            row = self.conn.execute('select value from store where key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(str(row[0]))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        blob = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.conn.execute('insert or replace into store (key, value) values (?, ?)', (key, blob))
+            self._written()
+
+    def __delitem__(self, key):
+        with self.lock:
+            cursor = self.conn.execute('delete from store where key = ?', (key,))
+            if cursor.rowcount == 0:
+                raise KeyError(key)
+            self._written()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('select count(*) from store').fetchone()[0]
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('select key from store')]
+
+    def iteritems(self):
+        for key in self.keys():
+            try:
+                yield key, self[key]
+            except KeyError: # deleted in the meantime
+                continue
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.sync()
+
+    def sync(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def migrate_from_shelf(self, shelf_path):
+        '''
+        Copies an old shelve file into the store, once
+        '''
+        with self.lock:
+            done = self.conn.execute('select 1 from migrations where source = ?', (shelf_path,)).fetchone()
+            if done or not glob.glob(shelf_path + '*'):
+                return
+            shelf = shelve.open(shelf_path, flag='r')
+            copied = 0
+            for key in shelf.keys():
+                try:
+                    value = shelf[key]
+                except Exception as e: # the class of an old pickle may be gone
+                    logging.info('could not migrate %s from %s: %s' % (key, shelf_path, e))
+                    continue
+                self.conn.execute('insert or replace into store (key, value) values (?, ?)',
+                                  (key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))))
+                copied += 1
+            shelf.close()
+            self.conn.execute('insert into migrations (source) values (?)', (shelf_path,))
+            self.conn.commit()
+            self.pending = 0
+            logging.info('migrated %s entries from %s to %s' % (copied, shelf_path, self.path))
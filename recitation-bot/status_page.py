@@ -1,16 +1,230 @@
 from jinja2 import Environment, FileSystemLoader
 import os
+import json
+import sqlite3
 import datetime
+import threading
+import time
+import logging
 
 env = Environment(loader=FileSystemLoader('/data/project/recitation-bot/recitation-bot/templates/'))
 
 status_template = env.get_template('status_page.html')
 
-def make_status_page(doi, success, error_msg, ja, inqueue):
-    success_str = 'succeeded' if success else 'failed'
+page_base_path = '/data/project/recitation-bot/public_html/'
+
+# how many reports a doi page shows, and how many outcomes the index lists
+RECENT_PER_DOI = 20
+RECENT_IN_INDEX = 200
+
+INDEX_TEMPLATE = u'''<html>
+<head><meta charset="utf-8"><title>recitation-bot: recent outcomes</title></head>
+<body>
+<h1>Recent outcomes</h1>
+<p>Generated {{ generated.strftime('%Y-%m-%d %H:%M') }} UTC</p>
+<table>
+<tr><th>time (UTC)</th><th>doi</th><th>status</th><th>title</th><th>message</th></tr>
+{% for record in records %}
+<tr>
+<td>{{ record.time.strftime('%Y-%m-%d %H:%M:%S') }}</td>
+<td><a href="{{ record.page }}">{{ record.doi }}</a></td>
+<td>{{ record.success_str }}</td>
+<td>{{ record.title or '' }}</td>
+<td>{{ record.error_msg or '' }}</td>
+</tr>
+{% endfor %}
+</table>
+</body>
+</html>
+'''
+
+index_template = env.from_string(INDEX_TEMPLATE)
+
+class status_log():
+
+    '''
+    Every status report, appended to a SQLite table indexed by doi. The
+    pages are rendered from it: a doi page shows the latest RECENT_PER_DOI
+    reports, the index the latest RECENT_IN_INDEX outcomes of all dois.
+    Pages written before there was a log are kept as they were and shown
+    under the new reports.
+
+    Of the article's metadata only the title is kept, status_page.html
+    reads the report fields and nothing else.
+    '''
+
+    def __init__(self, path='status_log.db'):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute('''create table if not exists status (
+                                 id integer primary key autoincrement,
+                                 doi text not null, time real not null, success integer,
+                                 error_msg text, inqueue integer, doiurl text,
+                                 title text, metadata text, skipped text, timings text)''')
+        # columns added since the table was first made
+        columns = [row[1] for row in self.conn.execute('pragma table_info(status)')]
+        for column in ('skipped', 'timings'):
+            if column not in columns:
+                self.conn.execute('alter table status add column %s text' % column)
+        self.conn.execute('create index if not exists status_doi on status (doi, id)')
+        self.conn.execute('create table if not exists legacy_pages (doi text primary key, html text)')
+        self.conn.commit()
+
+    def append(self, doi, success, error_msg, inqueue, doiurl, metadata, skipped=None, timings=None):
+        success = None if success is None else int(bool(success))
+        with self.lock:
+            self.conn.execute('''insert into status (doi, time, success, error_msg, inqueue, doiurl, title, skipped, timings)
+                                 values (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                              (doi, time.time(), success, error_msg, int(bool(inqueue)), doiurl,
+                               metadata.get('article-title'), ','.join(skipped or []), json.dumps(timings or {})))
+            self.conn.commit()
+
+    def last_id(self):
+        '''
+        Changes with every report, see keep_index_fresh
+        '''
+        with self.lock:
+            return self.conn.execute('select max(id) from status').fetchone()[0]
+
+    def has(self, doi):
+        with self.lock:
+            return self.conn.execute('select 1 from status where doi = ? limit 1', (doi,)).fetchone() is not None
+
+    def recent(self, doi, limit=RECENT_PER_DOI):
+        '''
+        The latest reports for doi, newest first
+        '''
+        with self.lock:
+            rows = self.conn.execute('''select doi, time, success, error_msg, inqueue, doiurl, title, skipped, timings
+                                        from status where doi = ? order by id desc limit ?''',
+                                     (doi, limit)).fetchall()
+        records = list()
+        for row in rows:
+            record = _record(row[:7])
+            record['skipped'] = row[7].split(',') if row[7] else list()
+            record['timings'] = json.loads(row[8]) if row[8] else dict()
+            records.append(record)
+        return records
+
+    def latest(self, limit=RECENT_IN_INDEX):
+        '''
+        The latest reports of all dois, newest first, without metadata
+        '''
+        with self.lock:
+            rows = self.conn.execute('''select doi, time, success, error_msg, inqueue, doiurl, title
+                                        from status order by id desc limit ?''', (limit,)).fetchall()
+        return [_record(row) for row in rows]
+
+    def keep_legacy_page(self, doi, html):
+        with self.lock:
+            self.conn.execute('insert or ignore into legacy_pages (doi, html) values (?, ?)', (doi, html))
+            self.conn.commit()
+
+    def legacy_page(self, doi):
+        with self.lock:
+            row = self.conn.execute('select html from legacy_pages where doi = ?', (doi,)).fetchone()
+        return row[0] if row else u''
+
+def _record(row):
+    doi, timestamp, success, error_msg, inqueue, doiurl, title = row
     if success is None:
         success_str = 'waiting'
-    time = datetime.datetime.utcnow()
+    else:
+        success_str = 'succeeded' if success else 'failed'
+    return {'doi': doi, 'time': datetime.datetime.utcfromtimestamp(timestamp),
+            'success': success, 'success_str': success_str, 'error_msg': error_msg,
+            'inqueue': bool(inqueue), 'doiurl': doiurl, 'title': title,
+            'page': page_url(doi)}
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared():
+    '''
+    The process-wide status log, opened on first use
+    '''
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = status_log()
+        return _shared
+
+def page_path(doi):
+    doi_split = doi.rsplit('/', 1) # split on last '/', always at least 1
+    if len(doi_split) == 1:
+        return page_base_path + doi_split[0] + '.html'
+    return page_base_path + doi_split[0] + '/' + doi_split[1] + '.html'
+
+def page_url(doi):
+    # the index sits in page_base_path, the doi pages below it
+    return page_path(doi)[len(page_base_path):]
+
+def write_atomically(path, text):
+    '''
+    Readers see the old page or the new one, never half of one
+    '''
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError: # another writer made it first
+            pass
+    tmp_path = '%s.%s.%s.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    page = open(tmp_path, 'w')
+    page.write(text.encode('utf-8'))
+    page.close()
+    os.rename(tmp_path, path)
+
+def render_doi_page(doi, log=None):
+    log = log or shared()
+    sections = list()
+    for record in log.recent(doi):
+        if record['skipped']:
+            sections.append(u'<p>resumed, skipped: %s</p>\n' % u', '.join(record['skipped']))
+        if record['timings']:
+            sections.append(u'<p>stage timings: %s</p>\n' % u', '.join(
+                u'%s %.1f s' % (stage, seconds) for stage, seconds in sorted(record['timings'].iteritems(),
+                                                                          key=lambda timing: -timing[1])))
+        sections.append(status_template.render(doi=doi, success_str=record['success_str'],
+                                               error_msg=record['error_msg'], metadata={'article-title': record['title']},
+                                               doiurl=record['doiurl'], time=record['time'],
+                                               inqueue=record['inqueue']))
+    sections.append(log.legacy_page(doi))
+    write_atomically(page_path(doi), u''.join(sections))
+
+def render_index(log=None):
+    log = log or shared()
+    output = index_template.render(records=log.latest(), generated=datetime.datetime.utcnow())
+    write_atomically(page_base_path + 'index.html', output)
+
+def keep_index_fresh(interval=30, log=None):
+    '''
+    Starts a thread that renders the index every interval seconds, when
+    there were reports since the last time; the workers only write the
+    doi pages
+    '''
+    def refresh():
+        rendered = None
+        while 1: # True
+            try:
+                current = (log or shared()).last_id()
+                if current != rendered:
+                    render_index(log)
+                    rendered = current
+            except Exception as e: # try again next time
+                logging.info('could not render the status index: %s' % e)
+            time.sleep(interval)
+    refresher = threading.Thread(target=refresh, name='status-index')
+    refresher.daemon = True
+    refresher.start()
+    return refresher
+
+def make_status_page(doi, success, error_msg, ja, inqueue, skipped=None):
+    '''
+    skipped are the phases a resumed run did not have to do again; the
+    index is left to keep_index_fresh
+    '''
     try:
         metadata = ja.metadata
     except:
@@ -19,27 +233,26 @@ def make_status_page(doi, success, error_msg, ja, inqueue):
         doiurl = ja.doiurl()
     except:
         doiurl = None #we actually check for this being empty
-    output = status_template.render(doi=doi, success_str=success_str, error_msg=error_msg, metadata=metadata, doiurl=doiurl, time=time, inqueue=inqueue)
+    timings = getattr(ja, 'stage_timings', None)
 
-    page_base_path = '/data/project/recitation-bot/public_html/'
-    doi_split = doi.rsplit('/', 1) # split on last '/', always at least 1
-    page_sub_path = doi_split[0]
-    page_file_name = doi_split[1]
-    page_dir_path = page_base_path + page_sub_path + "/"
-    page_full_path = page_dir_path + page_file_name + '.html'
-
-    old_page_content = ''
-    if os.path.isfile(page_full_path):
-        old_page_content = open(page_full_path, 'r').read()
-    elif not os.path.exists(page_dir_path):
-        os.makedirs(page_dir_path)
-    appended_output = output + old_page_content.decode('utf-8')
-    page = open(page_full_path, 'w')
-    uni_out = appended_output.encode('utf-8')
-    page.write(uni_out)
-    page.close()
+    log = shared()
+    if not log.has(doi) and os.path.isfile(page_path(doi)):
+        # a page from before the log, keep its history
+        log.keep_legacy_page(doi, open(page_path(doi), 'r').read().decode('utf-8'))
+    log.append(doi, success, error_msg, inqueue, doiurl, metadata, skipped, timings)
+    render_doi_page(doi, log)
 
 
-#test
 if __name__ == '__main__':
-    make_status_page(doi='123', success=False, error_msg='error here', ja=None, inqueue=False)
+    import argparse
+    parser = argparse.ArgumentParser(description='regenerate status pages from the status log')
+    parser.add_argument('command', choices=['index', 'page', 'test'])
+    parser.add_argument('dois', nargs='*', help='the dois to render pages for')
+    args = parser.parse_args()
+    if args.command == 'index':
+        render_index()
+    elif args.command == 'page':
+        for doi in args.dois:
+            render_doi_page(doi)
+    else:
+        make_status_page(doi='123', success=False, error_msg='error here', ja=None, inqueue=False)
@@ -1,18 +1,25 @@
 # -*- coding: utf-8 -*-
 
-from journal_article import journal_article
-import twython_access
+from journal_article import journal_article, ConversionError
 from detect_in_use_dois import doi_finder
+from worker_pool import worker_pool
+from article_queue import article_queue, JUMPER
+from jumper_intake import jumper_intake
+from cpu_pool import cpu_pool
+from event_engine import event_engine
+from state_store import state_store
+import pmcid_resolver
+import oa_index
+import negative_cache
+import pipeline_metrics
 import os
 import pywikibot
-import shelve
 import threading
-from collections import deque
 import time
 import json
 from sys import stderr
+import sys
 import logging
-import ast
 import status_page
 
 logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
@@ -29,37 +36,35 @@ faillog.addHandler(failhandler)
 4. new_additions #the doi is in use on wikipedia and we have to detect it
 '''
 
-def add_jumpers_to_deque(article_deque):
+def add_jumpers_to_queue(article_queue):
     logging.debug('jumpers thread launched')
-    while 1: # True
-        jumpers_file_name = '/data/project/recitation-bot/recitation-bot/jump_the_queue.log'
-        jumpers_file = open(jumpers_file_name,'r')
-        jumpers_contents = jumpers_file.read()
-        jumpers_file.close()
-        open(jumpers_file_name,'w').close() #blank the file
-	jumper_lines = jumpers_contents.split('\n')
-        jumper_lines = jumper_lines[:-1]#-1 because there will always be an empty line due to the way of splitting
-        logging.info('%s items found from the jumper queue', len(jumper_lines)) 
-        for doi_input in jumper_lines:
-            if doi_input: # check for empty strings
-                doi, reupload_list_str = doi_input.split('\t')
-                reupload = ast.literal_eval(reupload_list_str) 
-                article_deque.append({'doi':doi,'reupload':reupload,'article':None})
-        time.sleep(10)
-
-def add_detected_to_deque(article_deque):
+    # the jump_the_queue web server appends to this file, see jumper_intake
+    intake = jumper_intake('/data/project/recitation-bot/recitation-bot/jump_the_queue.log')
+    intake.run(article_queue)
+
+def add_detected_to_queue(article_queue):
     logging.debug('detector thread launched')
     finder = doi_finder(lang='test2wiki')
-    finder.find_new_doi_article_pairs(article_deque)
+    finder.find_new_doi_article_pairs(article_queue)
+
+# tweet about every success, load tests turn it off
+tweet = True
+
+# called with (doi, success, status_msg) after every status report, and
+# with success None for a job that was passed over without one
+status_listeners = list()
 
-def report_status(doi, ja, status_msg, success):
+def report_status(doi, ja, status_msg, success, skipped=None):
     logging.info('reporting status with success %s' % str(success))
     status_page.make_status_page(doi=doi, success=success, 
                                  error_msg=status_msg,
-                                 ja = ja, inqueue=False)
+                                 ja = ja, inqueue=False, skipped=skipped)
+    for listener in status_listeners:
+        listener(doi, success, status_msg)
 
     #log all the failures
-    if success:
+    if success and tweet:
+        import twython_access # logs in to twitter when imported
         twython_access.update_status(ja)
         logging.info('doi: %s, succeed' % doi)
     if not success:
@@ -68,44 +73,206 @@ def report_status(doi, ja, status_msg, success):
 
 
 
-def convert_and_upload(article_deque):
+def report_passed_over(doi, reason):
+    '''
+    For jobs that are left alone without a status report, converted
+    before or rejected before; only the listeners hear of them
+    '''
+    logging.info('doi %s passed over: %s' % (doi, reason))
+    for listener in status_listeners:
+        listener(doi, None, reason)
+
+def run_steps(steps, run_step):
+    '''
+    Drives a generator of steps (see article_steps) on the calling thread,
+    sending each step's result back into it
+    '''
+    try:
+        step = steps.next()
+        while 1: # True
+            try:
+                result = run_step(*step)
+            except Exception:
+                step = steps.throw(*sys.exc_info())
+            else:
+                step = steps.send(result)
+    except StopIteration:
+        pass
+
+def convert_and_upload(article_queue, overrides=None):
+    '''
+    overrides replace entries of parameters, for load tests
+    '''
+
+    def save_checkpoint(doi, curr_ja, im_uploads):
+        state = curr_ja.checkpoint()
+        state['im_uploads'] = im_uploads
+        checkpoints[doi] = state
+        checkpoints.sync()
+
+    def drop_checkpoint(doi):
+        if doi in checkpoints:
+            del checkpoints[doi]
+            checkpoints.sync()
+
+    def store_article(doi, curr_ja):
+        store[doi] = curr_ja
+        store.sync()
+        drop_checkpoint(doi) # done, nothing to resume
+
+    def record_failure(doi, curr_ja, im_uploads, e):
+        if isinstance(e, ConversionError) and e.reason in negative_cache.REASONS:
+            negatives.add(doi, e.reason, str(e))
+            drop_checkpoint(doi) # nothing to resume until it is rechecked
+        else:
+            save_checkpoint(doi, curr_ja, im_uploads) # keeps the images uploaded before the failure
+
+    def prefetch_waiting():
+        # resolve what is queued behind us in the same idconv requests
+        waiting = article_queue.waiting_dois(parameters["prefetch_pmcids"])
+        resolver.prefetch([waiting_doi for waiting_doi in waiting if not negatives.check(waiting_doi)])
+
+    def article_steps(doi_article, curr_ja):
+        '''
+        The work on one job, as a generator of steps: ('stage', [name], args)
+        for a journal_article stage, ('process', names, ()) for cpu stages that
+        go to the cpu pool in one trip, and ('call', function, args) for
+        anything else that blocks, disk included. Whoever drives it runs each
+        step and sends back its result, or throws in what the step raised;
+        that is run_steps on the worker threads, or the event_engine.
+        '''
+        logging.info(doi_article)
+        doi = doi_article['doi']
+        # known rejects are settled before any network I/O
+        rejected = yield 'call', negatives.check, (doi,)
+        if rejected:
+            logging.info('doi %s was rejected before (%s), skipping it' % (doi, rejected['reason']))
+            if doi_article['priority'] == JUMPER: # someone asked for it, tell them why
+                yield 'call', report_status, (doi, None, 'rejected before and not rechecked yet: %s' % rejected['message'], False)
+            else:
+                yield 'call', report_passed_over, (doi, 'rejected before: %s' % rejected['message'])
+            return
+        yield 'call', prefetch_waiting, ()
+        reupload = doi_article['reupload']
+        logging.debug('associated article %s' % doi_article['article'])
+        logging.info('working on doi %s and reupload was %s' % (str(doi), str(reupload)))
+        in_store = yield 'call', store.__contains__, (doi,)
+        #DOI not in store
+        if not in_store:
+            logging.info('doi %s was not in store' % doi)
+            prev_ja = None
+            im_uploads = {'commons':True, 'equations':True, 'tables':True}
+
+        #DOI was in store, but maybe we are repuploading
+        else:
+            logging.info('doi %s was in store' % doi)
+            if not reupload:
+                logging.info('doi %s is being ignored because reupload was not on' % doi)
+                yield 'call', report_passed_over, (doi, 'converted before')
+                return
+            logging.info('doi %s is being processed because a reuploade parameter was found' % doi)
+            prev_ja = yield 'call', store.get, (doi,)
+            #Default to false
+            im_uploads = {'commons':False, 'equations':False, 'tables':False}
+            im_up_map = {'reupload_images':'commons',
+                         'reupload_equations':'equations',
+                         'reupload_tables':'tables'}
+            for reup in reupload:
+                if reup != 'reupload_text': #we always redo the text
+                    im_uploads[im_up_map[reup]] = True
+            logging.info(str(im_uploads))
+
+        # a failed run of the same job left a checkpoint, carry on from there
+        skipped = list()
+        checkpoint = yield 'call', checkpoints.get, (doi,)
+        if checkpoint and checkpoint['im_uploads'] == im_uploads:
+            skipped = yield 'call', curr_ja.restore, (checkpoint,)
+            logging.info('resuming doi %s at %s, skipping %s' % (doi, curr_ja.next_phase(), skipped))
+
+        def todo(*names):
+            return [name for name in names if not curr_ja.phase[name]]
 
-    def process_journal_article(prev_ja, curr_ja, im_uploads, shelf, doi):
         try:
-            curr_ja.get_pmcid()
-            curr_ja.get_targz()
-            curr_ja.extract_targz()
+            for name in todo('get_pmcid', 'get_targz'):
+                yield 'stage', [name], ()
+                yield 'call', save_checkpoint, (doi, curr_ja, im_uploads)
+            # get the text out of xslt_it while the result tree is still in memory
+            for names in [todo('extract_targz', 'find_nxml', 'extract_metadata'),
+                          todo('xslt_it', 'get_mwtext_element')]:
+                if not names:
+                    continue
+                if cpu is None:
+                    for name in names:
+                        yield 'stage', [name], ()
+                        yield 'call', save_checkpoint, (doi, curr_ja, im_uploads)
+                    continue
+                # in one trip to a child process when there is a cpu pool
+                if 'get_mwtext_element' in names and parameters["prerender_commons_pages"]:
+                    names.append('render_commons_pages')
+                yield 'process', names, ()
+                yield 'call', save_checkpoint, (doi, curr_ja, im_uploads)
             logging.info('ja phase: %s' % str(curr_ja.phase))
-            curr_ja.find_nxml()
-            curr_ja.extract_metadata()
-            curr_ja.xslt_it()
-            
-            curr_ja.upload_images(im_uploads)
-            #is this dangerous brain surgery? im not sure.
-            if prev_ja: #that means we have a donor brain for surgery
-                surgery_map = {'commons':'images',
-                               'equations':'equations',
-                               'tables':'tables'}
-                #now we're putting in the things we didn't send to upload
-                for sitestr, flag in im_uploads.iteritems():
-                    if not flag:
-                        curr_ja.metadata[surgery_map[sitestr]] = prev_ja.metadata[surgery_map[sitestr]]
-            
-            curr_ja.get_mwtext_element()
-            curr_ja.replace_image_names_in_wikitext()
-            curr_ja.replace_supplementary_material_links_in_wikitext()
-            curr_ja.push_to_wikisource()
-            curr_ja.push_redirect_wikisource()
-            shelf[doi] = curr_ja
-            shelf.sync()
-            report_status(doi, curr_ja, None, success=True)
+
+            if not curr_ja.phase['upload_images']:
+                yield 'stage', ['upload_images'], (im_uploads,)
+                #is this dangerous brain surgery? im not sure.
+                if prev_ja: #that means we have a donor brain for surgery
+                    surgery_map = {'commons':'images',
+                                   'equations':'equations',
+                                   'tables':'tables'}
+                    #now we're putting in the things we didn't send to upload
+                    for sitestr, flag in im_uploads.iteritems():
+                        if not flag:
+                            curr_ja.metadata[surgery_map[sitestr]] = prev_ja.metadata[surgery_map[sitestr]]
+                yield 'call', save_checkpoint, (doi, curr_ja, im_uploads)
+
+            for name in todo('replace_image_names_in_wikitext',
+                             'replace_supplementary_material_links_in_wikitext',
+                             'push_to_wikisource',
+                             'push_redirect_wikisource'):
+                yield 'stage', [name], ()
+                yield 'call', save_checkpoint, (doi, curr_ja, im_uploads)
+            yield 'call', store_article, (doi, curr_ja)
+            pipeline_metrics.shared().count('articles_succeeded')
+            yield 'call', report_status, (doi, curr_ja, None, True, skipped)
         except Exception as e:
             logging.exception(e)
             logging.debug(e)
-            report_status(doi, curr_ja, str(e), success=False)
+            yield 'call', record_failure, (doi, curr_ja, im_uploads, e)
+            pipeline_metrics.shared().count('articles_failed')
+            pipeline_metrics.shared().failure(str(e) if isinstance(e, ConversionError) else type(e).__name__)
+            yield 'call', report_status, (doi, curr_ja, str(e), False, skipped)
 
-    # creates shelf store for article data (history)
-    shelf = shelve.open('journal_shelf', writeback=False)
+    def plan(doi_article):
+        '''
+        The journal_article for a job off the queue and its article_steps;
+        nothing here touches the disk or the network
+        '''
+        # backfill jobs bring the pmcid and package url along
+        try:
+            curr_ja = journal_article(doi=doi_article['doi'], article=doi_article['article'], parameters=parameters,
+                                      pmcid=doi_article.get('pmcid'), package_url=doi_article.get('package_url'))
+        except Exception as e:
+            logging.exception(e)
+            return None, failed_steps(doi_article['doi'], e)
+        return curr_ja, article_steps(doi_article, curr_ja)
+
+    def failed_steps(doi, e):
+        # the report still goes out as a step, not from whoever planned
+        yield 'call', report_status, (doi, None, str(e), False)
+
+    def handle(doi_article, pool):
+        # the threads engine: the whole article on this worker
+        curr_ja, steps = plan(doi_article)
+
+        def run_step(kind, what, args):
+            if kind == 'stage':
+                return pool.run_stage(curr_ja, what[0], *args)
+            elif kind == 'process':
+                return pool.run_in_process(curr_ja, what, cpu)
+            return what(*args)
+
+        run_steps(steps, run_step)
 
     # parameters as key-value pairs, used like static variables
     parameters = {
@@ -113,67 +280,103 @@ def convert_and_upload(article_deque):
         "jats2mw_xsl" : '/data/project/recitation-bot/JATS-to-Mediawiki/jats-to-mediawiki.xsl',
         "wikisource_site" : 'en',
         "wikisource_basepath" : 'Wikisource:WikiProject_Open_Access/Programmatic_import_from_PubMed_Central/',
-        "image_extensions": ['jpg', 'jpeg', 'png']
+        "image_extensions": ['jpg', 'jpeg', 'png'],
+        # consumer threads, and how many of them may be in each stage type
+        # at once (see worker_pool.STAGE_TYPES)
+        "workers": 4,
+        "stage_limits": {'pmc_api': 2, 'download': 4, 'cpu': 2, 'wiki_read': 4, 'wiki_write': 1},
+        # parallel image uploads per article, and retries for each image
+        "upload_concurrency": 4,
+        "upload_retries": 4,
+        # ask the wiki for the SHA-1 of files missing from the upload index
+        "hash_precheck": False,
+        # seconds without data before a download attempt is given up and resumed
+        "download_timeout": 60,
+        # how many queued dois to resolve along with the one being worked on
+        "prefetch_pmcids": 200,
+        # days before a doi rejected as not in PMC, without a tgz or without a
+        # license is looked at again
+        "negative_recheck_days": 30,
+        # prometheus text file with stage timings and counters, rewritten
+        # every metrics_interval seconds, and a port to serve /metrics on
+        "metrics_file": '/data/project/recitation-bot/public_html/metrics.prom',
+        "metrics_interval": 30,
+        "metrics_port": None,
+        # seconds between renders of the status index, see status_page
+        "status_index_interval": 30,
+        # child processes for the cpu bound stages (see cpu_pool), 0 keeps
+        # them on the worker threads; with a pool the commons file pages
+        # can be rendered there too
+        "cpu_processes": 0,
+        "prerender_commons_pages": True,
+        # 'threads' takes each article start to end on one of the workers,
+        # 'events' keeps up to max_in_flight articles going from a single
+        # dispatcher thread, with io_threads for the calls that block and a
+        # limit per host instead of the stage limits (see event_engine)
+        "engine": 'threads',
+        "io_threads": 32,
+        "max_in_flight": 200,
+        "host_limits": None, # for event_engine.DEFAULT_HOST_LIMITS
+        # local copy of PMC-ids and the OA file list, asked before idconv and
+        # oa.fcgi while it is younger than oa_index_max_age and refreshed every
+        # oa_index_refresh seconds; made with `python oa_index.py refresh`
+        "oa_index": oa_index.DEFAULT_PATH,
+        "oa_index_max_age": 7 * 24 * 3600,
+        "oa_index_refresh": 24 * 3600
     }
 
-    # main loop
-    while 1: # True
-        try:
-            doi_article = article_deque.pop()
-            logging.info(doi_article)
-            doi = doi_article['doi']
-            reupload = doi_article['reupload']
-            article = doi_article['article']
-            curr_ja = journal_article(doi=doi, article=article, parameters=parameters)
-            logging.debug('associated article %s' % article)
-            logging.info('working on doi %s and reupload was %s' % (str(doi), str(reupload)))
-            #DOI not in shelf
-            if doi not in shelf.keys():
-                logging.info('doi %s was not in shelf' % doi)
-                prev_ja = None
-                im_uploads = {'commons':True, 'equations':True, 'tables':True}
-                process_journal_article(prev_ja=prev_ja, curr_ja=curr_ja, im_uploads=im_uploads, shelf=shelf, doi=doi)           
-
-#DOI was in shelf, but maybe we are repuploading
-            else:
-                logging.info('doi %s was in shelf' % doi)
-                if not reupload:
-                    logging.info('doi %s is being ignored because reupload was not on' % doi)
-                else:
-                    logging.info('doi %s is being processed because a reuploade parameter was found' % doi)
-                    prev_ja = shelf[doi]
-                    #Default to false
-                    im_uploads = {'commons':False, 'equations':False, 'tables':False}
-                    im_up_map = {'reupload_images':'commons',
-                                 'reupload_equations':'equations',
-                                 'reupload_tables':'tables'}
-                    for reup in reupload:
-                        if reup != 'reupload_text': #we always redo the text
-                            im_uploads[im_up_map[reup]] = True
-                    logging.info(str(im_uploads))
-                    process_journal_article(prev_ja=prev_ja, curr_ja=curr_ja, im_uploads=im_uploads, shelf=shelf, doi=doi)
-                    
-        
-        except IndexError: #nothing in the deque
-            logging.info('nothing in deque sleepytime')
-            time.sleep(10)
-            continue
-    shelf.close()
-
-
-
-#The main threads
-article_deque = deque()
-jump_producer = threading.Thread(target=add_jumpers_to_deque, kwargs={'article_deque':article_deque})
-detect_producer = threading.Thread(target=add_detected_to_deque, kwargs={'article_deque':article_deque})
-consumer = threading.Thread(target=convert_and_upload, kwargs={'article_deque':article_deque})
-
-jump_producer.start()
-detect_producer.start()
-consumer.start()
-logging.debug('all threads started')
-
-jump_producer.join()
-detect_producer.join()
-consumer.join()
-print('finished') #this should never be reached if all loops are suffiicently infinite.
+    parameters.update(overrides or {})
+
+    # forked before the workers start, the cpu limit is the pool size
+    cpu = None
+    if parameters["cpu_processes"]:
+        cpu = cpu_pool(parameters["cpu_processes"])
+        parameters["stage_limits"] = dict(parameters["stage_limits"], cpu=parameters["cpu_processes"])
+        parameters["host_limits"] = dict(parameters["host_limits"] or {}, cpu=parameters["cpu_processes"])
+
+    # store for article data (history), shared by the workers
+    store = state_store('journal_state', migrate_from='journal_shelf')
+    # where unfinished articles got to, see journal_article.checkpoint
+    checkpoints = state_store('checkpoints')
+    resolver = pmcid_resolver.shared()
+    negatives = negative_cache.shared(recheck_after=parameters["negative_recheck_days"] * 24 * 3600)
+
+    if parameters["engine"] == 'events':
+        pool = event_engine(article_queue, plan, cpu=cpu,
+                            io_threads=parameters["io_threads"],
+                            max_in_flight=parameters["max_in_flight"],
+                            host_limits=parameters["host_limits"])
+    else:
+        pool = worker_pool(article_queue, handle,
+                           workers=parameters["workers"],
+                           stage_limits=parameters["stage_limits"])
+    pipeline_metrics.export_textfile(parameters["metrics_file"], parameters["metrics_interval"], article_queue)
+    if parameters["metrics_port"]:
+        pipeline_metrics.serve(parameters["metrics_port"], article_queue)
+    status_page.keep_index_fresh(parameters["status_index_interval"])
+    if oa_index.shared(parameters["oa_index"], parameters["oa_index_max_age"]) is not None:
+        oa_index.keep_fresh(parameters["oa_index"], parameters["oa_index_refresh"])
+    pool.start()
+    pool.join()
+    store.close()
+    if cpu is not None:
+        cpu.close()
+
+
+
+if __name__ == '__main__':
+    #The main threads
+    queue = article_queue()
+    jump_producer = threading.Thread(target=add_jumpers_to_queue, kwargs={'article_queue':queue})
+    detect_producer = threading.Thread(target=add_detected_to_queue, kwargs={'article_queue':queue})
+    consumer = threading.Thread(target=convert_and_upload, kwargs={'article_queue':queue})
+
+    jump_producer.start()
+    detect_producer.start()
+    consumer.start()
+    logging.debug('all threads started')
+
+    jump_producer.join()
+    detect_producer.join()
+    consumer.join()
+    print('finished') #this should never be reached if all loops are suffiicently infinite.
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import threading
+import logging
+from state_store import state_store
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+def file_sha1(path, chunk_size=1024 * 1024):
+    '''
+    Hex SHA-1 of a file, the same digest MediaWiki keeps for uploads
+    '''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as image:
+        for chunk in iter(lambda: image.read(chunk_size), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class upload_index():
+
+    '''
+    Maps the SHA-1 of every file we have uploaded (or found already
+    uploaded) to its file name on each wiki, so a file we already have
+    is never sent again.
+    '''
+
+    def __init__(self, store=None):
+        if store is None:
+            store = state_store('upload_hashes')
+        self.store = store
+
+    def _key(self, site, sha1):
+        return '%s:%s:%s' % (site.family.name, site.code, sha1)
+
+    def lookup(self, site, sha1):
+        '''
+        The file name (without namespace) of sha1 on site, or None
+        '''
+        return self.store.get(self._key(site, sha1))
+
+    def record(self, site, sha1, file_name):
+        self.store[self._key(site, sha1)] = file_name
+
+    def precheck(self, site, hashes):
+        '''
+        Asks the wiki about every hash we do not know yet and records the
+        files it already has. Returns how many were found.
+        '''
+        found = 0
+        for sha1 in set(hashes):
+            if self.lookup(site, sha1) is not None:
+                continue
+            for image_page in site.allimages(sha1=sha1, total=1):
+                self.record(site, sha1, image_page.title(withNamespace=False))
+                found += 1
+        self.sync()
+        logging.info('hash precheck found %s of %s files already on %s' % (found, len(hashes), site))
+        return found
+
+    def sync(self):
+        self.store.sync()
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared():
+    '''
+    The process-wide upload index, opened on first use
+    '''
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = upload_index()
+        return _shared
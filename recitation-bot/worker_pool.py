@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import logging
+import pipeline_metrics
+from article_queue import DETECTED
+
+logging.basicConfig(filename='/data/project/recitation-bot/public_html/recitation-bot-log.html', format='%(asctime)s %(message)s', level=logging.DEBUG)
+
+# which concurrency limit each journal_article stage counts against
+STAGE_TYPES = {
+    'get_pmcid': 'pmc_api',
+    'get_targz': 'download',
+    'extract_targz': 'cpu',
+    'find_nxml': 'cpu',
+    'extract_metadata': 'cpu',
+    'xslt_it': 'cpu',
+    'get_mwtext_element': 'cpu',
+    'render_commons_pages': 'cpu',
+    'upload_images': 'wiki_write',
+    'replace_image_names_in_wikitext': 'cpu',
+    'replace_supplementary_material_links_in_wikitext': 'wiki_read',
+    'push_to_wikisource': 'wiki_write',
+    'push_redirect_wikisource': 'wiki_write',
+}
+
+# how many workers may be inside a stage type at once
+DEFAULT_STAGE_LIMITS = {
+    'pmc_api': 2,
+    'download': 4,
+    'cpu': 2,
+    'wiki_read': 4,
+    'wiki_write': 1,
+}
+
+class worker_pool():
+
+    '''
+    A pool of consumer threads eating from the article queue.
+
+    Every journal_article stage run through run_stage() holds a slot of its
+    stage type, so a slow download only ties up a download slot while other
+    workers carry on with XSLT or wiki writes. A DOI is only ever worked on
+    by one worker: a second job for a DOI in flight is parked and put back
+    on the queue once the first one is done.
+    '''
+
+    def __init__(self, article_queue, handler, workers=4, stage_limits=None):
+        '''
+        handler(doi_article, pool) does the work for one job off the queue
+        '''
+        self.article_queue = article_queue
+        self.handler = handler
+        self.workers = workers
+        limits = dict(DEFAULT_STAGE_LIMITS)
+        if stage_limits:
+            limits.update(stage_limits)
+        self.gates = dict((stage_type, threading.BoundedSemaphore(limit))
+                          for stage_type, limit in limits.iteritems())
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.parked = dict() # doi -> list of jobs waiting for that doi
+        self.threads = list()
+
+    def run_stage(self, ja, stage, *args):
+        '''
+        Runs journal_article stage `stage` within its stage type's limit,
+        timing the wait for the slot and the stage itself
+        '''
+        asked = time.time()
+        with self.gates[STAGE_TYPES[stage]]:
+            return timed_stage(ja, stage, args, time.time() - asked)
+
+    def run_in_process(self, ja, stages, cpu):
+        '''
+        Runs cpu stages of ja in one trip to a cpu_pool child, within the
+        cpu limit, and records their timings like run_stage does
+        '''
+        asked = time.time()
+        with self.gates['cpu']:
+            timed_in_process(ja, stages, cpu, time.time() - asked)
+
+    def claim(self, doi_article):
+        '''
+        Marks the job's DOI as in flight, or parks the job if it already is.
+        Returns whether the caller may go ahead with it.
+        '''
+        doi = doi_article['doi']
+        with self.lock:
+            if doi in self.in_flight:
+                self.parked.setdefault(doi, list()).append(doi_article)
+                logging.info('doi %s is already being worked on, parked it' % doi)
+                return False
+            self.in_flight.add(doi)
+            return True
+
+    def release(self, doi):
+        with self.lock:
+            self.in_flight.discard(doi)
+            parked = self.parked.pop(doi, list())
+        for doi_article in parked:
+            self.article_queue.put(doi_article, doi_article.get('priority', DETECTED))
+
+    def work(self):
+        while 1: # True
+            doi_article = self.article_queue.get()
+            logging.info('queue depth: %s' % self.article_queue.depth())
+            if not self.claim(doi_article):
+                continue
+            try:
+                self.handler(doi_article, self)
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                self.release(doi_article['doi'])
+
+    def start(self):
+        for number in range(self.workers):
+            worker = threading.Thread(target=self.work, name='worker-%s' % number)
+            worker.daemon = True
+            worker.start()
+            self.threads.append(worker)
+        logging.debug('%s workers started' % self.workers)
+
+    def join(self):
+        for worker in self.threads:
+            worker.join()
+
+def timed_stage(ja, stage, args=(), waited=0.0):
+    '''
+    Runs a stage and records how long it took, and how long it waited for
+    its turn, in ja.stage_timings and the pipeline metrics
+    '''
+    start = time.time()
+    failed = True
+    try:
+        result = getattr(ja, stage)(*args)
+        failed = False
+        return result
+    finally:
+        seconds = time.time() - start
+        ja.stage_timings[stage] = seconds
+        pipeline_metrics.shared().observe_stage(stage, seconds, waited, failed)
+
+def timed_in_process(ja, stages, cpu, waited=0.0):
+    '''
+    timed_stage for a group of stages run in a cpu_pool child
+    '''
+    start = time.time()
+    timings, error = cpu.run(ja, stages)
+    metrics = pipeline_metrics.shared()
+    for stage in stages:
+        if stage in timings:
+            seconds = timings[stage]
+            ja.stage_timings[stage] = seconds
+            metrics.observe_stage(stage, seconds, waited)
+        elif error is not None: # the stage that failed, the rest did not run
+            metrics.observe_stage(stage, time.time() - start - sum(timings.values()),
+                                  waited, failed=True)
+            break
+        waited = 0.0 # only the first stage waited for the slot
+    if error is not None:
+        raise error
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+'''
+backfill's planning and bookkeeping, and a predownload that fails, against
+the lists in tests/lists and a local BaseHTTPServer
+'''
+
+import os
+import sys
+import gzip
+import shutil
+import StringIO
+import tempfile
+import itertools
+import threading
+import unittest
+import BaseHTTPServer
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'recitation-bot'))
+import backfill
+import http_client
+import negative_cache
+import oa_index
+from state_store import state_store
+
+LISTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lists')
+
+def make_index(directory):
+    index = oa_index.oa_index(os.path.join(directory, 'oa_index.db'))
+    index.load_file('pmc_ids', os.path.join(LISTS_DIR, 'PMC-ids.csv'))
+    index.load_file('oa_file_list', os.path.join(LISTS_DIR, 'oa_file_list.csv'))
+    return index
+
+class plan_jobs_test(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.index = make_index(self.scratch)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.scratch)
+
+    def test_fresh_lists(self):
+        jobs, skipped = backfill.plan_jobs(self.index, ['10.1371/journal.pone.0012292',
+                                                        '10.1371/JOURNAL.PONE.0012292', # the same doi
+                                                        '10.1038/nature10836', # not open access
+                                                        '10.5555/not.in.pmc'])
+        self.assertEqual(jobs, [{'doi': '10.1371/journal.pone.0012292', 'reupload': None, 'article': None,
+                                 'pmcid': 'PMC2943916',
+                                 'package_url': oa_index.PACKAGE_BASE + 'oa_package/0c/8b/PMC2943916.tar.gz'}])
+        self.assertEqual(skipped, [('10.1038/nature10836', 'not in the open access file list'),
+                                   ('10.5555/not.in.pmc', 'not in PMC-ids')])
+
+    def test_stale_lists_are_no_proof(self):
+        self.index.max_age = -1
+        jobs, skipped = backfill.plan_jobs(self.index, ['10.1371/journal.pone.0012292', '10.5555/not.in.pmc'])
+        # no hints, the pipeline asks the APIs
+        self.assertEqual([sorted(job) for job in jobs], [['article', 'doi', 'reupload']] * 2)
+        self.assertEqual(skipped, [])
+
+    def test_open_access_subset(self):
+        jobs, skipped = backfill.plan_jobs(self.index)
+        self.assertEqual(sorted(job['pmcid'] for job in jobs), ['PMC2753358', 'PMC2943916', 'PMC554975'])
+        self.index.max_age = -1
+        self.assertRaises(ValueError, backfill.plan_jobs, self.index)
+
+class progress_file_test(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.path = os.path.join(self.scratch, 'progress.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def test_resume(self):
+        progress = backfill.progress_file(self.path)
+        progress.record('10.1/a', backfill.FAILED, 'ConversionError: no tgz')
+        progress.record('10.1/b', backfill.SKIPPED, 'converted before')
+        progress.record('10.1/a', backfill.DONE) # the last record wins
+        progress.record('10.1/c', backfill.FAILED, 'timeout: read')
+        # a crash in the middle of a line
+        open(self.path, 'a').write('{"doi": "10.1/d", "sta')
+
+        progress = backfill.progress_file(self.path)
+        self.assertEqual(progress.outcomes['10.1/a']['status'], backfill.DONE)
+        self.assertNotIn('10.1/d', progress.outcomes)
+        self.assertTrue(progress.settled('10.1/a'))
+        self.assertTrue(progress.settled('10.1/b'))
+        self.assertFalse(progress.settled('10.1/c'))
+        self.assertTrue(progress.settled('10.1/c', retry_failed=False))
+        self.assertFalse(progress.settled('10.1/d'))
+        self.assertEqual(progress.summary(), {'statuses': {'done': 1, 'skipped': 1, 'failed': 1},
+                                              'failures': {'timeout': 1}})
+
+class already_settled_test(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.old_dir = os.getcwd()
+        os.chdir(self.scratch) # journal_state is opened in the working directory
+        self.old_negatives = negative_cache._shared
+        negative_cache._shared = negative_cache.negative_cache(state_store('negative_cache', directory=self.scratch))
+        self.progress = backfill.progress_file(os.path.join(self.scratch, 'progress.jsonl'))
+
+    def tearDown(self):
+        negative_cache._shared.store.close()
+        negative_cache._shared = self.old_negatives
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.scratch)
+
+    def test_limit_while_iterating(self):
+        jobs = [{'doi': '10.1/%s' % number, 'reupload': None, 'article': None} for number in range(8)]
+        self.progress.record('10.1/0', backfill.DONE)
+        store = state_store('journal_state')
+        store['10.1/1'] = 'converted'
+        store['10.1/6'] = 'converted'
+        store.close()
+        negative_cache._shared.add('10.1/2', 'no_tgz', 'no tar.gz package')
+
+        todo = list(itertools.islice(backfill.already_settled(jobs, self.progress), 2))
+        self.assertEqual([job['doi'] for job in todo], ['10.1/3', '10.1/4'])
+        self.assertEqual(self.progress.outcomes['10.1/1']['status'], backfill.SKIPPED)
+        self.assertEqual(self.progress.outcomes['10.1/2']['status'], backfill.REJECTED)
+        # nothing past the limit was looked at
+        self.assertNotIn('10.1/6', self.progress.outcomes)
+
+        todo = list(backfill.already_settled(jobs, self.progress))
+        self.assertEqual([job['doi'] for job in todo], ['10.1/3', '10.1/4', '10.1/5', '10.1/7'])
+        self.assertEqual(self.progress.outcomes['10.1/6']['status'], backfill.SKIPPED)
+
+def gzipped(text):
+    buffer = StringIO.StringIO()
+    archive = gzip.GzipFile(fileobj=buffer, mode='wb')
+    archive.write(text)
+    archive.close()
+    return buffer.getvalue()
+
+class package_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    package = gzipped('a package')
+
+    def do_GET(self):
+        if self.path.startswith('/missing/'):
+            self.send_response(404)
+            body = 'not here'
+        elif self.path.startswith('/busy/'):
+            self.send_response(503)
+            body = 'busy'
+        else:
+            self.send_response(200)
+            body = self.package
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class predownload_test(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), package_handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.saved = dict(http_client.SETTINGS)
+        http_client.configure(connections_per_host=2)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        http_client.configure(**self.saved)
+        shutil.rmtree(self.scratch)
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.server.server_port, path)
+
+    def test_failed_batch_does_not_hold_up_the_next(self):
+        fetcher = ThreadPool(8)
+        bad = [{'doi': '10.1/%s' % number,
+                'package_url': self.url('/%s/PMC%s.tar.gz' % (['missing', 'busy'][number % 2], number))}
+               for number in range(8)]
+        good = [{'doi': '10.1/ok', 'package_url': self.url('/ok/PMC99.tar.gz')}]
+        try:
+            for batch in [bad, good]:
+                # the failures are logged and left to the conversion
+                fetched = fetcher.map_async(lambda job: backfill.fetch_package(job, self.scratch, 5), batch)
+                fetched.wait(30)
+                self.assertTrue(fetched.ready())
+                fetched.get()
+        finally:
+            fetcher.close()
+        self.assertTrue(os.path.isfile(os.path.join(self.scratch, 'PMC99.tar.gz')))
+        self.assertFalse(os.path.exists(os.path.join(self.scratch, 'PMC0.tar.gz')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+doi_finder against the SQLite stand-in replica
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'recitation-bot'))
+import replica_standin
+from detect_in_use_dois import doi_finder
+from article_queue import article_queue
+from state_store import state_store
+
+class doi_finder_test(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.conn = replica_standin.connect()
+        self.cursor_file = os.path.join(self.scratch, 'cursor')
+        self.store = state_store('detector_state', directory=self.scratch)
+        self.finder = self.new_finder()
+        self.queue = article_queue()
+
+    def tearDown(self):
+        self.store.close()
+        self.conn.close()
+        shutil.rmtree(self.scratch)
+
+    def new_finder(self):
+        return doi_finder(lang='enwiki', conn=self.conn, placeholder='?',
+                          store=self.store, cursor_file=self.cursor_file, page_size=2, batch_size=1)
+
+    def queued(self):
+        return [self.queue.get() for number in range(self.queue.depth())]
+
+    def el_ids(self):
+        return [row[0] for row in self.conn.execute('select el_id from externallinks order by el_id')]
+
+    def test_starts_at_the_newest_link(self):
+        replica_standin.add_links(self.conn, [('Gene', 'http://dx.doi.org/10.1/old')])
+        os.remove(self.cursor_file)
+        finder = self.new_finder()
+        self.assertEqual(finder.high_water_mark, self.el_ids()[-1])
+        self.assertEqual(finder.check_once(self.queue), 0)
+
+    def test_http_and_https_links(self):
+        replica_standin.add_links(self.conn, replica_standin.SAMPLE_LINKS)
+        self.assertEqual(self.finder.check_once(self.queue), 5)
+        found = set((doi_article['doi'], doi_article['article']) for doi_article in self.queued())
+        self.assertEqual(found, set([('10.1186/1471-2156-10-59', 'Gene'),
+                                     ('10.1186/1742-4690-2-11', 'Retrovirus'),
+                                     ('10.3897/zookeys.324.5827', 'Zoology'), # https://doi.org
+                                     ('10.3897/zookeys.364.6109', 'Zoology'), # https://dx.doi.org
+                                     ('10.1371/journal.pone.0012292', 'Gene')]))
+
+    def test_cursor_advances(self):
+        replica_standin.add_links(self.conn, replica_standin.SAMPLE_LINKS[:2])
+        self.finder.check_once(self.queue)
+        self.queued()
+        mark = self.el_ids()[-1]
+        self.assertEqual(self.finder.high_water_mark, mark)
+        self.assertEqual(int(open(self.cursor_file).read()), mark)
+
+        # nothing new, nothing queued and the mark stays
+        self.assertEqual(self.finder.check_once(self.queue), 0)
+        self.assertEqual(self.finder.high_water_mark, mark)
+
+        # only what was added since is read, also by a finder started later
+        replica_standin.add_links(self.conn, [('Gene', 'https://doi.org/10.1/new'),
+                                              ('Retrovirus', 'http://dx.doi.org/10.1186/1471-2156-10-59')])
+        finder = self.new_finder()
+        self.assertEqual(finder.high_water_mark, mark)
+        self.assertEqual(finder.check_once(self.queue), 2)
+        self.assertEqual([(doi_article['doi'], doi_article['article']) for doi_article in self.queued()],
+                         [('10.1/new', 'Gene'), ('10.1186/1471-2156-10-59', 'Retrovirus')])
+        self.assertEqual(finder.high_water_mark, self.el_ids()[-1])
+        self.assertEqual(self.store['10.1186/1471-2156-10-59'], ['Gene', 'Retrovirus'])
+
+if __name__ == '__main__':
+    unittest.main()
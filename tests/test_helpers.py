@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+'''
+What find_files_in_commons counts as found, with the commons search
+answered from a few files instead of the API
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'recitation-bot'))
+import helpers
+
+# file title -> the text of its description page
+FILES = {
+    'File:A-study-pone.0070001.g001.jpg': 'Figure 1 of the study',
+    'File:A-study-pone.0070001.g002.jpg': 'Figure 2 of the study',
+    'File:Renamed upload.jpg': 'Uploaded from pone.0070001.g003, renamed',
+    'File:Cropped one.jpg': 'Cropped from pone.0070001.g004',
+    'File:Cropped two.jpg': 'Also cropped from pone.0070001.g004',
+    'File:Twice-pone.0070001.g005.jpg': 'one copy',
+    'File:Twice-pone.0070001.g005.png': 'the other copy',
+}
+
+class find_files_in_commons_test(unittest.TestCase):
+
+    def setUp(self):
+        self.searches = list()
+        self.real_search = helpers._search
+        helpers._search = self.search
+        helpers._commons_memo.clear()
+
+    def tearDown(self):
+        helpers._search = self.real_search
+        helpers._commons_memo.clear()
+
+    def search(self, srsearch, limit, offset=0):
+        # full text: a term matches the title or the description page
+        self.searches.append(srsearch)
+        terms = [term.lower() for term in srsearch.split(' OR ')]
+        hits = sorted(title for title, text in FILES.iteritems()
+                      if any(term in (title + ' ' + text).lower() for term in terms))
+        return hits[offset:offset + limit], len(hits)
+
+    def test_found(self):
+        names = ['pone.0070001.g001', 'pone.0070001.g002', 'pone.0070001.g003',
+                 'pone.0070001.g004', 'pone.0070001.g005', 'pone.0070001.g006']
+        self.assertEqual(helpers.find_files_in_commons(names), {
+            # one title has the name
+            'pone.0070001.g001': 'File:A-study-pone.0070001.g001.jpg',
+            'pone.0070001.g002': 'File:A-study-pone.0070001.g002.jpg',
+            # only the description page has it, and its own search has one hit
+            'pone.0070001.g003': 'File:Renamed upload.jpg',
+            # two description pages, two titles: ambiguous
+            'pone.0070001.g004': False,
+            'pone.0070001.g005': False,
+            'pone.0070001.g006': False,
+        })
+        # the batch, and the names no title had
+        self.assertEqual(sorted(self.searches[1:]), ['pone.0070001.g003', 'pone.0070001.g004', 'pone.0070001.g006'])
+
+    def test_no_hits_is_one_search(self):
+        names = ['pone.0099999.g001', 'pone.0099999.g002']
+        self.assertEqual(helpers.find_files_in_commons(names), {'pone.0099999.g001': False,
+                                                                'pone.0099999.g002': False})
+        self.assertEqual(len(self.searches), 1)
+
+    def test_misses_are_not_memoized(self):
+        helpers.find_files_in_commons(['pone.0070001.g001', 'pone.0070001.g006'])
+        self.searches = list()
+        FILES['File:Late-pone.0070001.g006.jpg'] = 'uploaded since'
+        try:
+            self.assertEqual(helpers.find_files_in_commons(['pone.0070001.g001', 'pone.0070001.g006']),
+                             {'pone.0070001.g001': 'File:A-study-pone.0070001.g001.jpg',
+                              'pone.0070001.g006': 'File:Late-pone.0070001.g006.jpg'})
+            self.assertEqual(self.searches, ['pone.0070001.g006'])
+        finally:
+            del FILES['File:Late-pone.0070001.g006.jpg']
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+'''
+http_client against a local BaseHTTPServer that answers from a script of
+(status, body) responses per path
+'''
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'recitation-bot'))
+import requests
+import http_client
+import downloads
+
+class scripted_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # path -> list of (status, body), the last one is repeated
+    scripts = dict()
+    hits = dict()
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        scripted_handler.hits[path] = scripted_handler.hits.get(path, 0) + 1
+        script = scripted_handler.scripts[path]
+        status, body = script.pop(0) if len(script) > 1 else script[0]
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class http_client_test(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), scripted_handler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.saved = dict(http_client.SETTINGS)
+        http_client.configure(retries=2, backoff=0, timeout=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        http_client.configure(**cls.saved)
+
+    def serve(self, path, *script):
+        scripted_handler.scripts[path] = list(script)
+        scripted_handler.hits[path] = 0
+        return 'http://127.0.0.1:%s%s' % (self.server.server_port, path)
+
+    def test_retries_429_and_5xx(self):
+        url = self.serve('/flaky', (429, 'slow down'), (503, 'busy'), (200, json.dumps({'ok': 1})))
+        self.assertEqual(http_client.get('flaky', url=url, parse_json=True), {'ok': 1})
+        self.assertEqual(scripted_handler.hits['/flaky'], 3)
+
+    def test_gives_up_after_the_last_retry(self):
+        url = self.serve('/down', (500, 'broken'))
+        self.assertRaises(requests.HTTPError, http_client.get, 'down', url=url)
+        self.assertEqual(scripted_handler.hits['/down'], 3) # retries=2
+
+    def test_4xx_is_permanent(self):
+        url = self.serve('/missing', (404, 'not here'))
+        self.assertRaises(requests.HTTPError, http_client.get, 'missing', url=url, parse_json=True)
+        self.assertEqual(scripted_handler.hits['/missing'], 1)
+        # without parse_json the response is handed back as it is
+        response = http_client.get('missing', url=url)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(scripted_handler.hits['/missing'], 2)
+
+    def test_non_json_bodies(self):
+        url = self.serve('/html', (200, '<html>maintenance</html>'), (200, json.dumps([1, 2])))
+        self.assertEqual(http_client.get('html', url=url, parse_json=True), [1, 2])
+        self.assertEqual(scripted_handler.hits['/html'], 2)
+        url = self.serve('/html', (200, '<html>maintenance</html>'))
+        self.assertRaises(ValueError, http_client.get, 'html', url=url, parse_json=True)
+        # not asked for json, the body is fine as it is
+        self.assertEqual(http_client.get('html', url=url).text, '<html>maintenance</html>')
+
+    def test_metrics_per_endpoint(self):
+        ok = self.serve('/counted', (200, '{}'))
+        flaky = self.serve('/counted_flaky', (502, 'bad gateway'), (200, '{}'))
+        for number in range(3):
+            http_client.get('counted', url=ok, parse_json=True)
+        http_client.get('counted_flaky', url=flaky, parse_json=True)
+        metrics = http_client.metrics()
+        self.assertEqual((metrics['counted']['requests'], metrics['counted']['errors'],
+                          metrics['counted']['retries']), (3, 0, 0))
+        self.assertEqual((metrics['counted_flaky']['requests'], metrics['counted_flaky']['errors'],
+                          metrics['counted_flaky']['retries']), (2, 1, 1))
+        self.assertTrue(metrics['counted']['max_seconds'] <= metrics['counted']['seconds'])
+
+    def test_failures_give_their_connections_back(self):
+        # with pool_block a connection that is never given back leaves the
+        # next request waiting for one forever, so they run on a thread
+        # that is only waited for so long
+        http_client.configure(connections_per_host=2)
+        down = self.serve('/stream_down', (503, 'busy'))
+        missing = self.serve('/package_missing', (404, 'not here'))
+        ok = self.serve('/after', (200, '{}'))
+        scratch = tempfile.mkdtemp()
+        answers = list()
+
+        def requests_to_one_host():
+            for number in range(3):
+                self.assertRaises(requests.HTTPError, http_client.get, 'stream_down', url=down, stream=True)
+                self.assertRaises(downloads.DownloadError, downloads.fetch, missing,
+                                  os.path.join(scratch, 'package.tar.gz'), timeout=5, retries=0)
+            answers.append(http_client.get('after', url=ok, parse_json=True))
+        try:
+            worker = threading.Thread(target=requests_to_one_host)
+            worker.daemon = True
+            worker.start()
+            worker.join(20)
+            self.assertEqual(answers, [{}])
+        finally:
+            http_client.configure(connections_per_host=self.saved['connections_per_host'])
+            shutil.rmtree(scratch)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''
+jumper_intake reading the spool while writers append to it and it is
+rotated under them
+'''
+
+import os
+import sys
+import fcntl
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'recitation-bot'))
+import jumper_intake
+
+class list_queue():
+    '''
+    Stands in for the article_queue, keeps the dois in the order they came
+    '''
+    def __init__(self):
+        self.dois = list()
+
+    def put_many(self, jobs, priority):
+        self.dois.extend(job['doi'] for job in jobs)
+
+class jumper_intake_test(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.path = os.path.join(self.scratch, 'jump_the_queue.log')
+        self.queue = list_queue()
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def test_drain_and_rotate(self):
+        intake = jumper_intake.jumper_intake(self.path, rotate_size=50)
+        jumper_intake.append_requests(self.path, [('10.5555/a', None), ('10.5555/b', ['reupload_text'])])
+        open(self.path, 'a').write('not a doi\n10.5555/c') # the last line is not finished yet
+        self.assertEqual(intake.drain(self.queue), 2)
+        open(self.path, 'a').write('\n')
+        self.assertEqual(intake.drain(self.queue), 1)
+        self.assertEqual(self.queue.dois, ['10.5555/a', '10.5555/b', '10.5555/c'])
+        # over rotate_size and all read, a new spool is started
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(intake.rotating_path))
+        self.assertEqual(intake.load_offset(), 0)
+        self.assertTrue('not a doi' in open(intake.rejected_path).read())
+
+    def test_writer_waiting_during_rotation(self):
+        intake = jumper_intake.jumper_intake(self.path)
+        jumper_intake.append_requests(self.path, [('10.5555/before', None)])
+        intake.drain(self.queue)
+
+        # the writer opens the spool while rotate() holds it
+        held = os.open(self.path, os.O_RDONLY)
+        fcntl.flock(held, fcntl.LOCK_EX)
+        writer = threading.Thread(target=jumper_intake.append_requests, args=(self.path, [('10.5555/during', None)]))
+        writer.daemon = True
+        writer.start()
+        writer.join(0.5)
+        self.assertTrue(writer.is_alive())
+        os.rename(self.path, intake.rotating_path)
+        os.close(held)
+        writer.join(10)
+        self.assertFalse(writer.is_alive())
+
+        intake.drain(self.queue)
+        self.assertFalse(os.path.exists(intake.rotating_path))
+        intake.drain(self.queue)
+        self.assertEqual(self.queue.dois, ['10.5555/before', '10.5555/during'])
+
+    def test_concurrent_writers(self):
+        intake = jumper_intake.jumper_intake(self.path, rotate_size=200)
+        dois = dict()
+
+        def writes(name):
+            dois[name] = ['10.5555/%s.%s' % (name, number) for number in range(300)]
+            for doi in dois[name]:
+                jumper_intake.append_requests(self.path, [(doi, None)])
+
+        writers = [threading.Thread(target=writes, args=(name,)) for name in 'abcd']
+        for writer in writers:
+            writer.daemon = True
+            writer.start()
+        while any(writer.is_alive() for writer in writers):
+            intake.drain(self.queue)
+        intake.drain(self.queue)
+        intake.drain(self.queue)
+        self.assertEqual(sorted(self.queue.dois), sorted(sum(dois.values(), [])))
+
+if __name__ == '__main__':
+    unittest.main()
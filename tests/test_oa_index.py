@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+'''
+oa_index loading the lists in tests/lists, changed copies of them, and a
+refresh from a local BaseHTTPServer
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'recitation-bot'))
+import http_client
+import oa_index
+
+LISTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lists')
+
+def fixture(name):
+    return os.path.join(LISTS_DIR, name)
+
+class oa_index_test(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.index = oa_index.oa_index(os.path.join(self.scratch, 'oa_index.db'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.scratch)
+
+    def changed_copy(self, name, replace=(), drop=()):
+        '''
+        The fixture `name` with the lines containing a drop string left out
+        and the (old, new) strings of replace swapped
+        '''
+        lines = [line for line in open(fixture(name)) if not any(text in line for text in drop)]
+        text = ''.join(lines)
+        for old, new in replace:
+            text = text.replace(old, new)
+        path = os.path.join(self.scratch, name)
+        open(path, 'w').write(text)
+        return path
+
+    def test_file_list_upserts_by_last_updated(self):
+        self.assertEqual(self.index.load_file('oa_file_list', fixture('oa_file_list.csv')), 3)
+        self.assertEqual(self.index.package('PMC2943916'),
+                         {'package_url': oa_index.PACKAGE_BASE + 'oa_package/0c/8b/PMC2943916.tar.gz',
+                          'license': 'CC BY', 'updated': '2013-03-08 10:11:59'})
+        path = self.changed_copy('oa_file_list.csv', replace=[
+            # an older row does not win
+            ('0c/8b/PMC2943916.tar.gz', 'old/PMC2943916.tar.gz'),
+            ('2013-03-08 10:11:59', '2011-01-01 00:00:00'),
+            # a newer one does
+            ('7f/1e/PMC2753358.tar.gz', 'new/PMC2753358.tar.gz'),
+            ('PMC2753358,2012-11-20 08:01:02', 'PMC2753358,2014-05-05 05:05:05')])
+        self.index.load_file('oa_file_list', path)
+        self.assertEqual(self.index.package('PMC2943916')['package_url'],
+                         oa_index.PACKAGE_BASE + 'oa_package/0c/8b/PMC2943916.tar.gz')
+        self.assertEqual(self.index.package('PMC2753358'),
+                         {'package_url': oa_index.PACKAGE_BASE + 'oa_package/new/PMC2753358.tar.gz',
+                          'license': 'CC BY', 'updated': '2014-05-05 05:05:05'})
+
+    def test_file_list_removes_what_left_it(self):
+        self.index.load_file('oa_file_list', fixture('oa_file_list.csv'))
+        self.index.load_file('oa_file_list', self.changed_copy('oa_file_list.csv', drop=['PMC554975']))
+        self.assertEqual(self.index.package('PMC554975'), None)
+        self.assertEqual(self.index.stats()['packages'], 2)
+
+    def test_pmc_ids_updates_and_removes(self):
+        self.assertEqual(self.index.load_file('pmc_ids', fixture('PMC-ids.csv')), 4) # the row without a doi is left out
+        self.assertEqual(self.index.pmcid('10.1186/1471-2156-10-59'), 'PMC2753358')
+        self.assertEqual(self.index.pmcid('10.1038/NATURE10836'), 'PMC3290703')
+        path = self.changed_copy('PMC-ids.csv', replace=[(',PMC2753358,', ',PMC9999999,')], drop=['nature10836'])
+        self.index.load_file('pmc_ids', path)
+        self.assertEqual(self.index.pmcid('10.1186/1471-2156-10-59'), 'PMC9999999')
+        self.assertEqual(self.index.pmcid('10.1038/nature10836'), None)
+        self.assertEqual(self.index.stats()['dois'], 3)
+
+    def test_empty_lists_do_not_wipe_the_index(self):
+        self.index.load_file('pmc_ids', fixture('PMC-ids.csv'))
+        self.index.load_file('oa_file_list', fixture('oa_file_list.csv'))
+        for name, csv_name in [('pmc_ids', 'PMC-ids.csv'), ('oa_file_list', 'oa_file_list.csv')]:
+            header = open(fixture(csv_name)).readline()
+            path = os.path.join(self.scratch, 'empty-' + csv_name)
+            open(path, 'w').write(header)
+            self.assertEqual(self.index.load_file(name, path), 0)
+        stats = self.index.stats()
+        self.assertEqual((stats['dois'], stats['packages']), (4, 3))
+
+    def test_max_age(self):
+        self.assertFalse(self.index.fresh('pmc_ids'))
+        self.index.load_file('pmc_ids', fixture('PMC-ids.csv'))
+        self.index.load_file('oa_file_list', fixture('oa_file_list.csv'))
+        self.assertTrue(self.index.fresh('pmc_ids') and self.index.fresh('oa_file_list'))
+        self.assertEqual(self.index.pmcid('10.1371/journal.pone.0012292'), 'PMC2943916')
+
+        self.index.max_age = -1
+        self.assertFalse(self.index.fresh('pmc_ids') or self.index.fresh('oa_file_list'))
+        self.assertEqual(self.index.pmcid('10.1371/journal.pone.0012292'), None)
+        self.assertEqual(self.index.package('PMC2943916'), None)
+        # lookup answers whatever the age, plan_jobs asks fresh() itself
+        found = self.index.lookup(['10.1371/JOURNAL.pone.0012292', '10.1038/nature10836', '10.5555/nothing'])
+        self.assertEqual(found, {
+            '10.1371/journal.pone.0012292': ('10.1371/journal.pone.0012292', 'PMC2943916',
+                                             oa_index.PACKAGE_BASE + 'oa_package/0c/8b/PMC2943916.tar.gz'),
+            '10.1038/nature10836': ('10.1038/nature10836', 'PMC3290703', None)})
+
+class list_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    status = 200
+
+    def do_GET(self):
+        if list_handler.status != 200:
+            body = 'unavailable'
+            self.send_response(list_handler.status)
+        elif self.headers.get('if-none-match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        else:
+            body = open(fixture('oa_file_list.csv')).read()
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class refresh_test(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.index = oa_index.oa_index(os.path.join(self.scratch, 'oa_index.db'))
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), list_handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.saved_settings = dict(http_client.SETTINGS)
+        self.saved_endpoints = dict(http_client.ENDPOINTS)
+        http_client.configure(endpoints={'oa_file_list': 'http://127.0.0.1:%s/oa_file_list.csv' % self.server.server_port},
+                              retries=0, connections_per_host=1)
+
+    def tearDown(self):
+        list_handler.status = 200
+        self.server.shutdown()
+        self.server.server_close()
+        http_client.configure(endpoints=self.saved_endpoints, **self.saved_settings)
+        self.index.close()
+        shutil.rmtree(self.scratch)
+
+    def test_refresh(self):
+        results = list()
+
+        def refreshes():
+            list_handler.status = 404 # not retried, the response comes back to refresh
+            for number in range(3):
+                try:
+                    self.index.refresh('oa_file_list')
+                except Exception as e:
+                    results.append(type(e).__name__)
+            list_handler.status = 200
+            results.append(self.index.refresh('oa_file_list'))
+            results.append(self.index.refresh('oa_file_list')) # 304
+        # a connection that is not given back leaves the next refresh waiting for ever
+        worker = threading.Thread(target=refreshes)
+        worker.daemon = True
+        worker.start()
+        worker.join(20)
+        self.assertEqual(results, ['HTTPError'] * 3 + [3, None])
+        self.assertTrue(self.index.fresh('oa_file_list'))
+        # no downloads left over
+        self.assertEqual([name for name in os.listdir(self.scratch) if name.endswith('.csv')], [])
+
+if __name__ == '__main__':
+    unittest.main()
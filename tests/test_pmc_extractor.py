@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+'''
+The streaming extract_metadata has to agree with the tree walk,
+run with python -m unittest discover tests from the repository root
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'recitation-bot'))
+import pmc_extractor
+
+NXML_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nxml')
+
+def fixture(name):
+    return os.path.join(NXML_DIR, name)
+
+class compare_extractors_test(unittest.TestCase):
+
+    def test_fixtures_agree(self):
+        for name in sorted(os.listdir(NXML_DIR)):
+            self.assertEqual(pmc_extractor.compare_extractors(fixture(name)), [], name)
+
+    def test_front_material_gets_the_pmcid(self):
+        # the material in <front> is parsed before the pmcid is known
+        metadata = pmc_extractor.extract_metadata(fixture('front_material.nxml'))
+        urls = [material['url'] for material in metadata['supplementary-materials']]
+        self.assertIn('http://www.ncbi.nlm.nih.gov/pmc/articles/PMC3500002/bin/1741-7007-11-2-S1.xls', urls)
+
+    def test_sub_article_front_is_not_the_article_front(self):
+        metadata = pmc_extractor.extract_metadata(fixture('sub_article.nxml'))
+        self.assertEqual(metadata['doi'], '10.7554/eLife.00003')
+        self.assertEqual(metadata['pmcid'], '4100003')
+        self.assertEqual(metadata['article-title'], 'An article with a decision letter')
+        # figures of the sub-article are still collected
+        self.assertEqual(sorted(metadata['image_captions']), ['elife00003f001', 'elife00003f002'])
+
+if __name__ == '__main__':
+    unittest.main()
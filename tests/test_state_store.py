@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+'''
+state_store, the SQLite store behind journal_state, checkpoints and the
+negative cache
+'''
+
+import os
+import sys
+import shelve
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'recitation-bot'))
+from state_store import state_store
+
+class state_store_test(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.opened = list()
+
+    def tearDown(self):
+        for store in self.opened:
+            try:
+                store.close()
+            except Exception: # closed by the test
+                pass
+        shutil.rmtree(self.scratch)
+
+    def open(self, name='journal_state', **kwargs):
+        store = state_store(name, directory=self.scratch, **kwargs)
+        self.opened.append(store)
+        return store
+
+    def test_dict_like(self):
+        store = self.open()
+        value = {'phase': {'get_pmcid': True}, 'pmcid': 'PMC2943916', 'sizes': [1, 2.5, None]}
+        store['10.1371/journal.pone.0012292'] = value
+        self.assertTrue('10.1371/journal.pone.0012292' in store)
+        self.assertFalse('10.1371/other' in store)
+        self.assertEqual(store['10.1371/journal.pone.0012292'], value)
+        self.assertEqual(store.get('10.1371/other', 'default'), 'default')
+        self.assertRaises(KeyError, lambda: store['10.1371/other'])
+
+        store['10.1371/journal.pone.0012292'] = 'replaced'
+        store['10.1186/1471-2156-10-59'] = ['Gene']
+        self.assertEqual(len(store), 2)
+        self.assertEqual(sorted(store.keys()), ['10.1186/1471-2156-10-59', '10.1371/journal.pone.0012292'])
+        self.assertEqual(dict(store.iteritems())['10.1371/journal.pone.0012292'], 'replaced')
+
+        del store['10.1371/journal.pone.0012292']
+        self.assertFalse('10.1371/journal.pone.0012292' in store)
+        self.assertRaises(KeyError, store.__delitem__, '10.1371/journal.pone.0012292')
+
+    def test_batched_commits(self):
+        writer = self.open(batch_size=3)
+        reader = self.open()
+        writer['a'] = 1
+        writer['b'] = 2
+        # not committed yet, another connection does not see them
+        self.assertFalse('a' in reader)
+        writer['c'] = 3 # the third write commits the batch
+        self.assertEqual([reader.get(key) for key in 'abc'], [1, 2, 3])
+        writer['d'] = 4
+        self.assertFalse('d' in reader)
+        writer.sync()
+        self.assertEqual(reader['d'], 4)
+        writer['e'] = 5
+        writer.close() # commits what is pending
+        self.assertEqual(reader['e'], 5)
+        # and it is all there when opened again
+        self.assertEqual(len(self.open()), 5)
+
+    def test_migration_from_shelf(self):
+        shelf_path = os.path.join(self.scratch, 'journal_shelf')
+        shelf = shelve.open(shelf_path)
+        shelf['10.1/a'] = {'title': 'A'}
+        shelf['10.1/b'] = ['Gene', 'Retrovirus']
+        shelf.close()
+
+        store = self.open(migrate_from=shelf_path)
+        self.assertEqual(store['10.1/a'], {'title': 'A'})
+        self.assertEqual(store['10.1/b'], ['Gene', 'Retrovirus'])
+        store['10.1/a'] = {'title': 'A, converted again'}
+        store.close()
+
+        # only once, later writes are not overwritten by the old shelf
+        store = self.open(migrate_from=shelf_path)
+        self.assertEqual(store['10.1/a'], {'title': 'A, converted again'})
+        self.assertEqual(len(store), 2)
+
+    def test_no_shelf_to_migrate(self):
+        store = self.open(migrate_from=os.path.join(self.scratch, 'missing_shelf'))
+        self.assertEqual(len(store), 0)
+
+if __name__ == '__main__':
+    unittest.main()